@@ -16,6 +16,10 @@ from ckanext.subscribe import (
     email_verification,
     email_auth,
     notification,
+    bulk,
+    resource_activity,
+    saved_search,
+    webhook,
 )
 
 log = logging.getLogger(__name__)
@@ -35,8 +39,34 @@ def subscribe_signup(context, data_dict):
         about (specify only one of: dataset_id or group_id or organization_id)
     :param organization_id: Organization name or id to get notifications
         about (specify only one of: dataset_id or group_id or organization_id)
+    :param resource_id: Resource id to get notifications about - only the
+        activity on its dataset that changed the resource is notified about
+        (specify instead of dataset_id, group_id or organization_id)
+    :param query: Saved search - get notifications about any (public) dataset
+        that matches it, e.g. 'tags:covid res_format:CSV organization:org-x'.
+        The fields are tags, organization, groups and res_format, and a
+        dataset has to match all the terms. (specify instead of dataset_id,
+        group_id or organization_id)
     :param frequency: Frequency of notifications to receive. One of:
-        'immediate', 'daily', 'weekly' (optional, default=immediate)
+        'immediate', 'hourly', 'daily', 'weekly', 'monthly' (optional,
+        default=immediate)
+    :param activity_types: Only notify about activity of these types, e.g.
+        ['new package']. A list or comma-separated string. (optional,
+        default=all types)
+    :param timezone: Time zone to send daily, weekly and monthly
+        notifications in, e.g. 'Europe/London' (optional, default=the site's
+        notification time zone)
+    :param webhook_url: POST the notifications as JSON to this URL, instead
+        of emailing them. The email address is still used to verify and
+        manage the subscription. The host must be on a public address. An
+        existing subscription's webhook can't be changed by signing up again
+        - use subscribe_update. (optional)
+    :param webhook_secret: Secret (at least 16 characters) to sign the
+        webhook POSTs with (optional, default=a random secret, which is
+        returned)
+    :param include_child_organizations: For an organization subscription,
+        also notify about the datasets of its child organizations, their
+        children etc (ckanext-hierarchy) (optional, default=False)
     :param skip_verification: Doesn't send email - instead it marks the
         subscription as verified. Can be used by sysadmins only.
         (optional, default=False)
@@ -52,12 +82,24 @@ def subscribe_signup(context, data_dict):
     data = {
         'email': data_dict['email'],
         'frequency': data_dict.get('frequency', Frequency.IMMEDIATE.value),
+        'activity_types': data_dict.get('activity_types'),
+        'timezone': data_dict.get('timezone'),
+        'webhook_url': data_dict.get('webhook_url'),
+        'webhook_secret': data_dict.get('webhook_secret'),
     }
+    if data['webhook_url'] and not data['webhook_secret']:
+        data['webhook_secret'] = webhook.create_secret()
     if data_dict.get('dataset_id'):
         data['object_type'] = 'dataset'
         dataset_obj = model.Package.get(data_dict['dataset_id'])
         data['object_id'] = dataset_obj.id
         data['object_name'] = dataset_obj.name
+    elif data_dict.get('resource_id'):
+        data['object_type'] = 'resource'
+        data['object_id'] = data['object_name'] = data_dict['resource_id']
+    elif data_dict.get('query'):
+        data['object_type'] = 'query'
+        data['object_id'] = data['object_name'] = data_dict['query']
     else:
         group_obj = model.Group.get(data_dict.get('group_id') or
                                     data_dict.get('organization_id'))
@@ -67,6 +109,10 @@ def subscribe_signup(context, data_dict):
             data['object_type'] = 'group'
         data['object_id'] = group_obj.id
         data['object_name'] = group_obj.name
+    # only applies to organizations
+    data['include_child_organizations'] = \
+        data['object_type'] == 'organization' and \
+        bool(data_dict.get('include_child_organizations'))
 
     # must be unique combination of email/object_type/object_id
     existing = model.Session.query(Subscription) \
@@ -76,14 +122,33 @@ def subscribe_signup(context, data_dict):
         .first()
     if existing:
         # reuse existing subscription
+        if 'webhook_url' in data_dict and (
+                data['webhook_url'] != existing.webhook_url or
+                (data_dict.get('webhook_secret') and
+                 data_dict['webhook_secret'] != existing.webhook_secret)):
+            # anyone can sign up, so changing where an existing
+            # subscription's notifications go needs the manage code, through
+            # subscribe_update
+            raise p.toolkit.ValidationError({'webhook_url': [
+                "The webhook of an existing subscription can't be changed by "
+                "signing up again"]})
         subscription = existing
         subscription.frequency = data['frequency']
+        if 'activity_types' in data_dict:
+            subscription.activity_types = data['activity_types']
+        if 'timezone' in data_dict:
+            subscription.timezone = data['timezone']
+        if 'include_child_organizations' in data_dict:
+            subscription.include_child_organizations = \
+                data['include_child_organizations']
     else:
         # create subscription object
         if p.toolkit.check_ckan_version(max_version='2.8.99'):
             rev = model.repo.new_revision()
             rev.author = context['user']
         subscription = dictization.subscription_save(data, context)
+        if subscription.object_type == 'query':
+            saved_search.index_subscription(subscription)
         model.repo.commit()
 
     # send 'confirm your request' email
@@ -100,9 +165,43 @@ def subscribe_signup(context, data_dict):
 
     subscription_dict = dictization.dictize_subscription(subscription, context)
     subscription_dict['object_name'] = data['object_name']
+    if subscription.webhook_url and not existing:
+        # the one time the secret is shown
+        subscription_dict['webhook_secret'] = subscription.webhook_secret
     return subscription_dict
 
 
+def subscribe_signup_bulk(context, data_dict):
+    '''Signup many email addresses at once e.g. to import a list of
+    subscribers. The subscriptions are validated and saved in batches, with
+    one commit for each batch (see ckanext.subscribe.bulk_batch_size), so a
+    row's errors don't stop the others being saved.
+
+    :param subscriptions: list of dicts, each with the parameters of
+        subscribe_signup (email, dataset_id etc, apart from skip_verification)
+    :param skip_verification: Doesn't send emails - instead it marks the
+        subscriptions as verified. (optional, default=False)
+
+    :returns: the result for each subscription, in order - a dict with:
+        row (its index), status ('created', 'updated' or 'error'), and then
+        id (the subscription id) or error (the validation errors). For a
+        webhook subscription, webhook_secret is also given. If the
+        verification email couldn't be sent, email_error says why.
+    :rtype: list of dictionaries
+
+    '''
+    _check_access('subscribe_signup_bulk', context, data_dict)
+
+    subscriptions = p.toolkit.get_or_bust(data_dict, 'subscriptions')
+    if not isinstance(subscriptions, list):
+        raise p.toolkit.ValidationError(
+            {'subscriptions': ['Must be a list']})
+    skip_verification = p.toolkit.asbool(
+        data_dict.get('skip_verification', False))
+    return list(bulk.signup(subscriptions, context,
+                            skip_verification=skip_verification))
+
+
 def subscribe_verify(context, data_dict):
     '''Verify (confirm) a subscription
 
@@ -152,7 +251,22 @@ def subscribe_update(context, data_dict):
 
     :param id: Subscription id to update
     :param frequency: Frequency of notifications to receive. One of:
-        'immediate', 'daily', 'weekly' (optional, default=unchanged)
+        'immediate', 'hourly', 'daily', 'weekly', 'monthly' (optional,
+        default=unchanged)
+    :param activity_types: Only notify about activity of these types, e.g.
+        ['new package']. A list or comma-separated string - empty means all
+        types. (optional, default=unchanged)
+    :param timezone: Time zone to send daily, weekly and monthly
+        notifications in, e.g. 'Europe/London' - empty means the site's
+        notification time zone. (optional, default=unchanged)
+    :param webhook_url: POST the notifications to this URL, instead of
+        emailing them - empty means email them. (optional, default=unchanged)
+    :param webhook_secret: Secret to sign the webhook POSTs with (optional,
+        default=unchanged, or a random secret, which is returned, if a
+        webhook_url is set for the first time)
+    :param include_child_organizations: For an organization subscription,
+        whether to also notify about the datasets of its child organizations
+        (optional, default=unchanged)
 
     :returns: the updated subscription
     :rtype: dictionary
@@ -169,9 +283,28 @@ def subscribe_update(context, data_dict):
         if not data_dict.get(key):
             continue
         setattr(subscription, key, data_dict[key])
+    # activity_types can be set empty, meaning all types
+    if 'activity_types' in data_dict:
+        subscription.activity_types = data_dict['activity_types']
+    if 'timezone' in data_dict:
+        subscription.timezone = data_dict['timezone']
+    if 'webhook_url' in data_dict:
+        subscription.webhook_url = data_dict['webhook_url']
+    if 'include_child_organizations' in data_dict:
+        subscription.include_child_organizations = \
+            subscription.object_type == 'organization' and \
+            bool(data_dict['include_child_organizations'])
+    new_secret = data_dict.get('webhook_secret')
+    if subscription.webhook_url and not (new_secret or
+                                         subscription.webhook_secret):
+        new_secret = webhook.create_secret()
+    if new_secret:
+        subscription.webhook_secret = new_secret
     model.repo.commit()
 
     subscription_dict = dictization.dictize_subscription(subscription, context)
+    if new_secret:
+        subscription_dict['webhook_secret'] = new_secret
     return subscription_dict
 
 
@@ -188,16 +321,31 @@ def subscribe_list_subscriptions(context, data_dict):
     email = p.toolkit.get_or_bust(data_dict, 'email')
 
     subscription_objs = \
-        model.Session.query(Subscription, model.Package, model.Group) \
+        model.Session.query(Subscription, model.Package, model.Group,
+                            model.Resource) \
         .filter_by(email=email) \
         .outerjoin(model.Package, Subscription.object_id == model.Package.id) \
         .outerjoin(model.Group, Subscription.object_id == model.Group.id) \
+        .outerjoin(model.Resource,
+                   Subscription.object_id == model.Resource.id) \
         .all()
     subscriptions = []
-    for subscription_obj, package, group in subscription_objs:
+    for subscription_obj, package, group, resource in subscription_objs:
         subscription = \
             dictization.dictize_subscription(subscription_obj, context)
-        if package:
+        if resource:
+            subscription['object_name'] = resource.id
+            subscription['object_title'] = \
+                resource_activity.get_resource_title(resource)
+            subscription['object_link'] = \
+                resource_activity.get_resource_link(resource)
+        elif subscription_obj.object_type == 'query':
+            subscription['object_name'] = subscription_obj.object_id
+            subscription['object_title'] = \
+                saved_search.get_query_title(subscription_obj.object_id)
+            subscription['object_link'] = \
+                saved_search.get_search_url(subscription_obj.object_id)
+        elif package:
             subscription['object_name'] = package.name
             subscription['object_title'] = package.title
             if IS_CKAN_29_OR_HIGHER:
@@ -233,9 +381,13 @@ def subscribe_unsubscribe(context, data_dict):
         about (specify only one of: dataset_id or group_id or organization_id)
     :param organization_id: Organization name or id to unsubscribe from
         about (specify only one of: dataset_id or group_id or organization_id)
+    :param resource_id: Resource id to unsubscribe from (instead of
+        dataset_id, group_id or organization_id)
+    :param query: Saved search to unsubscribe from (instead of dataset_id,
+        group_id or organization_id)
 
-    :returns: (object_name, object_type) where object_type is: dataset, group
-        or organization
+    :returns: (object_name, object_type) where object_type is: dataset, group,
+        organization, resource or query
     :rtype: (str, str)
 
     '''
@@ -252,6 +404,12 @@ def subscribe_unsubscribe(context, data_dict):
         dataset_obj = model.Package.get(data_dict['dataset_id'])
         data['object_id'] = dataset_obj.id
         data['object_name'] = dataset_obj.name
+    elif data_dict.get('resource_id'):
+        data['object_type'] = 'resource'
+        data['object_id'] = data['object_name'] = data_dict['resource_id']
+    elif data_dict.get('query'):
+        data['object_type'] = 'query'
+        data['object_id'] = data['object_name'] = data_dict['query']
     else:
         group_obj = model.Group.get(data_dict.get('group_id') or
                                     data_dict.get('organization_id'))
@@ -269,6 +427,7 @@ def subscribe_unsubscribe(context, data_dict):
     if not subscription:
         raise p.toolkit.ObjectNotFound(
             'That user is not subscribed to that object')
+    saved_search.unindex_subscriptions([subscription.id])
     model.Session.delete(subscription)
     model.repo.commit()
 
@@ -287,22 +446,37 @@ def subscribe_unsubscribe_all(context, data_dict):
 
     _check_access('subscribe_unsubscribe_all', context, data_dict)
 
-    data = {
-        'email': p.toolkit.get_or_bust(data_dict, 'email'),
-        'user': context['user']
-    }
+    email = p.toolkit.get_or_bust(data_dict, 'email')
 
-    subscriptions = model.Session.query(Subscription) \
-        .filter_by(email=data['email']) \
-        .all()
-    if not subscriptions:
+    # deleted with one statement, rather than loading each subscription
+    counts = bulk.delete_subscriptions([email])
+    if not counts['subscriptions']:
+        model.Session.rollback()
         raise p.toolkit.ObjectNotFound(
             'That user has no subscriptions')
-    for subscription in subscriptions:
-        model.Session.delete(subscription)
     model.repo.commit()
 
 
+def subscribe_unsubscribe_bulk(context, data_dict):
+    '''Unsubscribe many email addresses from all notifications e.g. those in
+    a bounce report. They are dealt with in batches, with one commit for each
+    batch (see ckanext.subscribe.bulk_batch_size).
+
+    :param emails: list of email addresses to unsubscribe
+
+    :returns: counts of: emails (the distinct addresses given),
+        unsubscribed_emails (the addresses that had subscriptions) and
+        subscriptions (the number deleted)
+    :rtype: dictionary
+    '''
+    _check_access('subscribe_unsubscribe_bulk', context, data_dict)
+
+    emails = p.toolkit.get_or_bust(data_dict, 'emails')
+    if not isinstance(emails, list):
+        raise p.toolkit.ValidationError({'emails': ['Must be a list']})
+    return dict(bulk.unsubscribe(emails))
+
+
 @validate(schema.request_manage_code_schema)
 def subscribe_request_manage_code(context, data_dict):
     '''Request a code for managing existing subscriptions. Causes a email to be
@@ -338,7 +512,21 @@ def subscribe_request_manage_code(context, data_dict):
 def subscribe_send_any_notifications(context, data_dict):
     '''Check for activity and for any subscribers, send emails with the
     notifications.
+
+    :returns: counters of the notification work done by this process, e.g.
+        skipped_cycles - the number of times there was no new activity, so
+        the subscriptions were not checked
+        active_cycles - the number of times there was new activity
+        suppressed_activities - the number of activities left out because
+        they were by an ignored user (see ignore_activity_from_users)
+        sent_emails, failed_emails - the number of notification emails sent,
+        and that could not be sent
+        rate_limit_wait_seconds - time spent waiting for the mail rate limits
+        abandoned_emails - the number of emails given up on, after failing
+        ckanext.subscribe.delivery_max_attempts times
+        sent_webhooks, failed_webhooks, abandoned_webhooks - the same, for
+        the subscriptions with a webhook
+    :rtype: dictionary
     '''
-    notification.send_any_immediate_notifications()
-    notification.send_weekly_notifications_if_its_time_to()
-    notification.send_daily_notifications_if_its_time_to()
+    notification.send_any_notifications()
+    return dict(notification.metrics)
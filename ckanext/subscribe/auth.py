@@ -18,6 +18,12 @@ def subscribe_signup(context, data_dict):
     elif group_id:
         group = model.Group.get(group_id)
         check_access('group_show', context, {'id': group.id})
+    elif data_dict.get('resource_id'):
+        check_access('resource_show', context,
+                     {'id': data_dict['resource_id']})
+    elif data_dict.get('query'):
+        # only public datasets are matched
+        pass
     else:
         return {'success': False,
                 'msg': _('No object specified')}
@@ -32,6 +38,11 @@ def subscribe_signup(context, data_dict):
     return {'success': True}
 
 
+def subscribe_signup_bulk(context, data_dict):
+    # sysadmins only
+    return {'success': False}
+
+
 @auth_allow_anonymous_access
 def subscribe_verify(context, data_dict):
     return {'success': True}
@@ -52,6 +63,11 @@ def subscribe_unsubscribe_all(context, data_dict):
     return {'success': False}
 
 
+def subscribe_unsubscribe_bulk(context, data_dict):
+    # sysadmins only
+    return {'success': False}
+
+
 @auth_allow_anonymous_access
 def subscribe_manage(context, data_dict):
     # code auth is done in the action function, to allow you to request a code
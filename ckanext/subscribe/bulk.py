@@ -0,0 +1,462 @@
+# encoding: utf-8
+
+'''
+Bulk signup and unsubscribe.
+
+Bulk signup is for importing a list of subscribers (e.g. from another
+newsletter system) in one go, rather than calling subscribe_signup for each of
+them.
+
+The rows are dealt with in batches (of ckanext.subscribe.bulk_batch_size,
+default 1000). For each batch, the rows are validated, the datasets, groups,
+organizations and resources that they refer to are looked up with one query
+for each type of object, and the subscriptions that already exist with one
+more. Then the new subscriptions are inserted with one multi-row INSERT, the
+existing ones are updated with one executemany UPDATE, and the batch is
+committed. Unless verification is skipped, the verification emails for the
+batch are then sent with the mailer's send_batch().
+
+The rows are read, and the results returned, a batch at a time, so a large
+import can be streamed e.g. from a CSV file (see the import-subscriptions
+command).
+
+Bulk unsubscribe removes all the subscriptions of a list of email addresses,
+e.g. from a bounce report or a batch of GDPR erasure requests (see the
+unsubscribe-bulk command). Each batch of addresses is dealt with by a DELETE
+... WHERE email IN (...) of the subscriptions (and one each of their saved
+search index terms and of the notifications to them awaiting a retry), and
+one commit.
+'''
+
+import collections
+import datetime
+import itertools
+import uuid
+
+import ckan.plugins as p
+from ckan import model
+from ckan.model.types import make_uuid
+from sqlalchemy import select, bindparam, or_
+
+from ckanext.subscribe import (
+    email_verification,
+    mailer,
+    saved_search,
+    schema,
+    webhook,
+)
+from ckanext.subscribe import model as subscribe_model
+from ckanext.subscribe.model import Subscription, Frequency, Delivery
+
+log = __import__('logging').getLogger(__name__)
+config = p.toolkit.config
+
+
+def get_batch_size():
+    return p.toolkit.asint(
+        config.get('ckanext.subscribe.bulk_batch_size', 1000))
+
+
+def get_batches(iterable, batch_size):
+    '''Yields lists of the iterable's items, of up to batch_size items, only
+    reading each batch as it is needed.
+    '''
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def signup(rows, context, skip_verification=False, batch_size=None):
+    '''Signs up the subscribers in the rows, a batch at a time.
+
+    :param rows: iterable of dicts, each with the parameters of
+        subscribe_signup (email, dataset_id etc - not skip_verification)
+    :param skip_verification: mark the subscriptions as verified, rather than
+        emailing the subscribers to verify them
+    :param batch_size: the number of rows in each batch (optional,
+        default=ckanext.subscribe.bulk_batch_size)
+
+    :returns: iterator of the results, one for each row, in order (see
+        signup_batch)
+    '''
+    first_row = 0
+    for batch in get_batches(rows, batch_size or get_batch_size()):
+        for result in signup_batch(batch, context, first_row=first_row,
+                                   skip_verification=skip_verification):
+            yield result
+        first_row += len(batch)
+
+
+def signup_batch(rows, context, first_row=0, skip_verification=False):
+    '''Signs up the subscribers in the rows, with one commit.
+
+    :param rows: list of dicts, each with the parameters of subscribe_signup
+    :param first_row: the number of the first row, for the results
+
+    :returns: list of the results, one for each row - dicts with: row (its
+        number), status ('created', 'updated' or 'error'), and then either
+        id (the subscription's id) or error (the errors, by field). For a
+        webhook subscription, webhook_secret is also given. If the
+        verification email couldn't be sent, email_error says why.
+    '''
+    results = [{'row': first_row + i} for i in range(len(rows))]
+
+    # validate
+    valid = []  # of (result, data_dict)
+    for result, row in zip(results, rows):
+        if not isinstance(row, dict):
+            result.update(status='error',
+                          error={'row': ['Must be a dictionary']})
+            continue
+        data_dict, errors = p.toolkit.navl_validate(
+            row, schema.bulk_subscribe_schema(), context)
+        if errors:
+            result.update(status='error', error=errors)
+        else:
+            valid.append((result, data_dict))
+
+    # look up the objects
+    objects = resolve_objects([data_dict for _, data_dict in valid])
+    keyed = []  # of (result, data_dict, key)
+    for (result, data_dict), (object_type, object_id, error) in \
+            zip(valid, objects):
+        if error:
+            result.update(status='error', error=error)
+        else:
+            keyed.append((result, data_dict,
+                          (data_dict['email'], object_type, object_id)))
+
+    # decide what to insert and update
+    existing = get_existing_subscriptions([key for _, _, key in keyed])
+    inserts = {}  # {key: values}
+    updates = {}  # {key: values}
+    for result, data_dict, key in keyed:
+        if key in inserts or key in updates:
+            # signed up again, further up the batch
+            values = inserts.get(key) or updates[key]
+            update_values(values, data_dict, skip_verification)
+            result['status'] = 'updated'
+        elif key in existing:
+            values = dict(existing[key])
+            update_values(values, data_dict, skip_verification)
+            updates[key] = values
+            result['status'] = 'updated'
+        else:
+            values = create_values(key, data_dict, skip_verification)
+            inserts[key] = values
+            result['status'] = 'created'
+        result['id'] = values['id']
+        if values['webhook_url']:
+            # as subscribe_signup returns it
+            result['webhook_secret'] = values['webhook_secret']
+
+    save(list(inserts.values()), list(updates.values()))
+    model.Session.commit()
+
+    if not skip_verification:
+        errors = send_verification_emails(
+            [values['id'] for values in
+             list(inserts.values()) + list(updates.values())])
+        for result in results:
+            if result.get('id') in errors:
+                result['email_error'] = errors[result['id']]
+    return results
+
+
+def resolve_objects(data_dicts):
+    '''Looks up the objects that the subscriptions are to, with one query for
+    each type of object.
+
+    :returns: list of (object_type, object_id, error), one for each data_dict,
+        where error is None, or the errors by field if the object doesn't
+        exist
+    '''
+    dataset_refs = set(data_dict['dataset_id'] for data_dict in data_dicts
+                       if data_dict.get('dataset_id'))
+    group_refs = set(data_dict.get('group_id') or
+                     data_dict.get('organization_id')
+                     for data_dict in data_dicts
+                     if data_dict.get('group_id') or
+                     data_dict.get('organization_id'))
+    resource_ids = set(data_dict['resource_id'] for data_dict in data_dicts
+                       if data_dict.get('resource_id'))
+
+    # {name or id: id} - an id takes precedence over a name, as in
+    # Package.get()
+    datasets = {}
+    if dataset_refs:
+        Package = model.Package
+        found = model.Session.query(Package.id, Package.name) \
+            .filter(or_(Package.id.in_(dataset_refs),
+                        Package.name.in_(dataset_refs))) \
+            .all()
+        datasets.update((name, id_) for id_, name in found)
+        datasets.update((id_, id_) for id_, name in found)
+    # {name or id: (object_type, id)}
+    groups = {}
+    if group_refs:
+        Group = model.Group
+        found = model.Session.query(Group.id, Group.name,
+                                    Group.is_organization) \
+            .filter(or_(Group.id.in_(group_refs),
+                        Group.name.in_(group_refs))) \
+            .all()
+        for id_, name, is_organization in found:
+            groups[name] = \
+                ('organization' if is_organization else 'group', id_)
+        for id_, name, is_organization in found:
+            groups[id_] = \
+                ('organization' if is_organization else 'group', id_)
+    resources = set()
+    if resource_ids:
+        resources = set(
+            id_ for (id_,) in model.Session.query(model.Resource.id)
+            .filter(model.Resource.id.in_(resource_ids))
+            .filter(model.Resource.state == 'active'))
+
+    objects = []
+    for data_dict in data_dicts:
+        if data_dict.get('dataset_id'):
+            if data_dict['dataset_id'] in datasets:
+                objects.append(
+                    ('dataset', datasets[data_dict['dataset_id']], None))
+            else:
+                objects.append((None, None, {
+                    'dataset_id': ['Not found: Dataset']}))
+        elif data_dict.get('resource_id'):
+            if data_dict['resource_id'] in resources:
+                objects.append(('resource', data_dict['resource_id'], None))
+            else:
+                objects.append((None, None, {
+                    'resource_id': ['That resource ID does not exist.']}))
+        elif data_dict.get('query'):
+            # query_validator has checked it
+            objects.append(('query', data_dict['query'], None))
+        else:
+            key = 'group_id' if data_dict.get('group_id') \
+                else 'organization_id'
+            if data_dict[key] in groups:
+                objects.append(groups[data_dict[key]] + (None,))
+            else:
+                objects.append((None, None, {key: ['Not found: Group']}))
+    return objects
+
+
+def get_existing_subscriptions(keys):
+    '''Returns the subscriptions that already exist, with one query.
+
+    :param keys: list of (email, object_type, object_id)
+    :returns: {key: row of the subscription table}
+    '''
+    if not keys:
+        return {}
+    table = subscribe_model.subscription_table
+    keys = set(keys)
+    rows = model.Session.execute(
+        select([table])
+        .where(table.c.email.in_(set(key[0] for key in keys)))
+        .where(table.c.object_id.in_(set(key[2] for key in keys))))
+    existing = {}
+    for row in rows:
+        key = (row['email'], row['object_type'], row['object_id'])
+        if key in keys:
+            existing[key] = row
+    return existing
+
+
+def create_values(key, data_dict, skip_verification):
+    '''Returns the column values of a new subscription (as subscribe_signup
+    creates it).
+    '''
+    email, object_type, object_id = key
+    values = {
+        'id': str(uuid.uuid4()),
+        'email': email,
+        'object_type': object_type,
+        'object_id': object_id,
+        'created': datetime.datetime.utcnow(),
+        'frequency': data_dict.get('frequency', Frequency.IMMEDIATE.value),
+        'activity_types': data_dict.get('activity_types'),
+        'timezone': data_dict.get('timezone'),
+        'webhook_url': data_dict.get('webhook_url'),
+        'webhook_secret': data_dict.get('webhook_secret'),
+        # only applies to organizations
+        'include_child_organizations':
+            object_type == 'organization' and
+            bool(data_dict.get('include_child_organizations')),
+        'verified': False,
+    }
+    if values['webhook_url'] and not values['webhook_secret']:
+        values['webhook_secret'] = webhook.create_secret()
+    set_verification(values, skip_verification)
+    return values
+
+
+def update_values(values, data_dict, skip_verification):
+    '''Updates the column values of an existing subscription, as signing up
+    to it again with subscribe_signup does.
+    '''
+    values['frequency'] = data_dict.get('frequency',
+                                        Frequency.IMMEDIATE.value)
+    for key in ('activity_types', 'timezone'):
+        if key in data_dict:
+            values[key] = data_dict[key]
+    if 'include_child_organizations' in data_dict:
+        values['include_child_organizations'] = \
+            values['object_type'] == 'organization' and \
+            bool(data_dict['include_child_organizations'])
+    if 'webhook_url' in data_dict:
+        new_webhook = (data_dict['webhook_url'],
+                       data_dict.get('webhook_secret'))
+        if new_webhook[0] and not new_webhook[1]:
+            if new_webhook[0] == values['webhook_url'] and \
+                    values['webhook_secret']:
+                # same webhook - keep its secret
+                new_webhook = (new_webhook[0], values['webhook_secret'])
+            else:
+                new_webhook = (new_webhook[0], webhook.create_secret())
+        if new_webhook != (values['webhook_url'], values['webhook_secret']):
+            values['webhook_url'], values['webhook_secret'] = new_webhook
+            # the notifications would go somewhere new, so need the owner of
+            # the email address to confirm it
+            values['verified'] = False
+    set_verification(values, skip_verification)
+
+
+def set_verification(values, skip_verification):
+    if skip_verification:
+        values['verified'] = True
+    else:
+        values['verification_code'] = \
+            email_verification.make_code()
+        values['verification_code_expires'] = \
+            datetime.datetime.now() + email_verification.CODE_EXPIRY
+
+
+def save(inserts, updates):
+    '''Inserts and updates the subscriptions (and indexes the new saved
+    searches), with a statement for each.
+
+    :param inserts: list of the column values of new subscriptions
+    :param updates: list of the column values of existing subscriptions
+    '''
+    table = subscribe_model.subscription_table
+    if inserts:
+        columns = set(column for values in inserts for column in values)
+        model.Session.execute(table.insert().values([
+            dict((column, values.get(column)) for column in columns)
+            for values in inserts]))
+    if updates:
+        columns = set(column for values in updates for column in values) - \
+            set(['id'])
+        model.Session.execute(
+            table.update().where(table.c.id == bindparam('subscription_id')),
+            [dict([(column, values.get(column)) for column in columns] +
+                  [('subscription_id', values['id'])])
+             for values in updates])
+    query_terms = [
+        {'id': make_uuid(), 'subscription_id': values['id'], 'term': term}
+        for values in inserts if values['object_type'] == 'query'
+        for term in saved_search.get_index_terms(
+            saved_search.parse_query(values['object_id']))]
+    if query_terms:
+        model.Session.execute(
+            subscribe_model.query_term_table.insert().values(query_terms))
+    # caller needs to do:
+    #   model.Session.commit()
+
+
+def send_verification_emails(subscription_ids):
+    '''Sends the subscriptions' verification emails, in one batch.
+
+    :returns: {subscription_id: error} for the emails that couldn't be sent
+    '''
+    if not subscription_ids:
+        return {}
+    subscriptions = model.Session.query(Subscription) \
+        .filter(Subscription.id.in_(subscription_ids)) \
+        .all()
+    messages = []
+    for subscription in subscriptions:
+        subject, plain_text_body, html_body = \
+            email_verification.get_verification_email_contents(subscription)
+        messages.append((mailer.create_message(
+            recipient_name=subscription.email,
+            recipient_email=subscription.email,
+            subject=subject,
+            body=plain_text_body,
+            body_html=html_body,
+            headers={}), subscription.email))
+    errors = {}
+    for subscription, (_, error) in zip(subscriptions,
+                                        mailer.send_batch(messages)):
+        if error:
+            log.error('Could not email verification code to {}: {}'.format(
+                subscription.email, error))
+            errors[subscription.id] = str(error)
+    return errors
+
+
+def unsubscribe(emails, batch_size=None):
+    '''Deletes all the subscriptions of the email addresses, a batch at a
+    time, with one commit for each batch.
+
+    :param emails: iterable of email addresses
+    :param batch_size: the number of addresses in each batch (optional,
+        default=ckanext.subscribe.bulk_batch_size)
+
+    :returns: the counts (see delete_subscriptions), in total
+    :rtype: collections.Counter
+    '''
+    counts = collections.Counter()
+    for batch in get_batches(emails, batch_size or get_batch_size()):
+        batch_counts = delete_subscriptions(batch)
+        model.Session.commit()
+        log.info('Unsubscribed {unsubscribed_emails} of {emails} email '
+                 'addresses ({subscriptions} subscriptions)'
+                 .format(**batch_counts))
+        counts.update(batch_counts)
+    return counts
+
+
+def delete_subscriptions(emails):
+    '''Deletes all the subscriptions of the email addresses, along with
+    their saved search index terms, and the failed notification emails to
+    them that are awaiting a retry. There is a statement for each table,
+    however many addresses there are.
+
+    :param emails: list of email addresses
+
+    :returns: counts of: emails (the distinct addresses given),
+        unsubscribed_emails (the addresses that had subscriptions) and
+        subscriptions (the number deleted)
+    :rtype: dict
+    '''
+    emails = set(emails)
+    if not emails:
+        return {'emails': 0, 'unsubscribed_emails': 0, 'subscriptions': 0}
+    table = subscribe_model.subscription_table
+    query_term_table = subscribe_model.query_term_table
+    delivery_table = subscribe_model.delivery_table
+    model.Session.execute(
+        query_term_table.delete().where(
+            query_term_table.c.subscription_id.in_(
+                select([table.c.id]).where(table.c.email.in_(emails)))))
+    model.Session.execute(
+        delivery_table.delete()
+        .where(delivery_table.c.email.in_(emails))
+        .where(delivery_table.c.status == Delivery.FAILED))
+    deleted = model.Session.execute(
+        table.delete()
+        .where(table.c.email.in_(emails))
+        .returning(table.c.email)).fetchall()
+    # caller needs to do:
+    #   model.Session.commit()
+    return {
+        'emails': len(emails),
+        'unsubscribed_emails': len(set(email for (email,) in deleted)),
+        'subscriptions': len(deleted),
+    }
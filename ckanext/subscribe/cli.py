@@ -12,21 +12,120 @@ def initdb():
     setup()
 
 
+def create_activity_index():
+    from ckanext.subscribe.model import create_activity_timestamp_index
+    if create_activity_timestamp_index():
+        print('Activity timestamp index created')
+    else:
+        print('The activity table already has an index on its timestamp')
+
+
 def send_any_notifications(repeatedly):
     log = __import__('logging').getLogger(__name__)
 
     while True:
-        p.toolkit.get_action('subscribe_send_any_notifications')({
+        metrics = p.toolkit.get_action('subscribe_send_any_notifications')({
             'model': model,
             'ignore_auth': True},
             {}
         )
+        log.debug('Metrics: {}'.format(metrics))
         if not repeatedly:
             break
         log.debug('Repeating in 10s')
         time.sleep(10)
 
 
+def run_worker():
+    from ckanext.subscribe.worker import Worker
+    Worker().run()
+
+
+def backfill(since, slice_length, frequency_names):
+    from ckanext.subscribe import notification
+    from ckanext.subscribe.model import Frequency
+    from ckan.lib.email_notifications import string_to_timedelta
+
+    since = parse_datetime(since)
+    slice_length = string_to_timedelta(slice_length)
+    frequencies = [Frequency[name.upper()].value for name in frequency_names]
+    notification.backfill(since, slice_length, frequencies=frequencies)
+
+
+def parse_datetime(datetime_str):
+    for format_ in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(datetime_str, format_)
+        except ValueError:
+            pass
+    raise ValueError('Could not parse date/time "{}" - use format: '
+                     'YYYY-MM-DD HH:MM'.format(datetime_str))
+
+
+def benchmark_fanout():
+    from ckanext.subscribe import fanout
+    results = fanout.benchmark()
+    print('Activity/subscription pairs: {}'.format(results['pairs']))
+    print('Pure-Python fan-out: {:.3f}s'.format(results['python']))
+    if results['vectorized'] is None:
+        print('Vectorized fan-out: unavailable (NumPy is not installed)')
+    else:
+        print('Vectorized fan-out: {:.3f}s'.format(results['vectorized']))
+
+
+def import_subscriptions(filename, skip_verification):
+    import csv
+    import io
+    import six
+    from ckanext.subscribe import bulk
+
+    def read_rows(csv_file):
+        for row in csv.DictReader(csv_file):
+            # empty cells are left out, so they get the defaults
+            yield dict((six.ensure_text(key), six.ensure_text(value))
+                       for key, value in row.items() if key and value)
+
+    if six.PY2:
+        csv_file = open(filename, 'rb')
+    else:
+        csv_file = io.open(filename, encoding='utf-8', newline='')
+    context = {'model': model, 'session': model.Session, 'user': ''}
+    counts = dict(created=0, updated=0, error=0)
+    with csv_file:
+        for result in bulk.signup(read_rows(csv_file), context,
+                                  skip_verification=skip_verification):
+            counts[result['status']] += 1
+            # row numbers are of the data rows, after the header
+            if result['status'] == 'error':
+                print('Row {}: {}'.format(result['row'] + 1, result['error']))
+            elif result.get('email_error'):
+                print('Row {}: could not send verification email: {}'.format(
+                    result['row'] + 1, result['email_error']))
+    print('Subscriptions created: {created} updated: {updated} '
+          'errors: {error}'.format(**counts))
+
+
+def unsubscribe_bulk(filename):
+    import io
+    from ckanext.subscribe import bulk
+
+    def read_emails(emails_file):
+        for line in emails_file:
+            # one address per line - blank lines and comment lines (starting
+            # with "#") are skipped. "#" is allowed in an address.
+            email = line.strip()
+            if email and not email.startswith('#'):
+                yield email
+
+    with io.open(filename, encoding='utf-8') as emails_file:
+        counts = bulk.unsubscribe(read_emails(emails_file))
+    print('Email addresses: {emails} unsubscribed: {unsubscribed_emails} '
+          'subscriptions deleted: {subscriptions}'.format(
+              emails=counts['emails'],
+              unsubscribed_emails=counts['unsubscribed_emails'],
+              subscriptions=counts['subscriptions']))
+
+
 def create_test_activity(object_id):
     if p.toolkit.check_ckan_version(max_version='2.8.99'):
         model.repo.new_revision()
@@ -69,12 +168,24 @@ if not IS_CKAN_29_OR_HIGHER:
             subscribe initdb
                 Initialize the the ckanext-subscribe's database table
 
+            subscribe create-activity-index
+                Create an index on the activity table's timestamp, if it has
+                none, which the notifications need. On PostgreSQL it is built
+                without blocking writes to the table (CREATE INDEX
+                CONCURRENTLY).
+
             subscribe send-any-notifications [-r]
                 Check for activity and for any subscribers, send emails with the
                 notifications.
                 Option:
                   -r --repeatedly - does it repeatedly every 10s
 
+            subscribe worker
+                Run continuously, sending notifications as they become due.
+                It sleeps until the next notifications are due, or it is
+                woken by activity (see ckanext.subscribe.worker.wake_source),
+                and it exits cleanly on SIGTERM.
+
             subscribe create-test-activity {package-name|group-name|org-name}
                 Create some activity for testing purposes, for a given existing
                 object.
@@ -83,6 +194,37 @@ if not IS_CKAN_29_OR_HIGHER:
                 Delete any test activity (i.e. clean up after doing
                 'create-test-activity'). Works for test activity on all objects.
 
+            subscribe backfill --since=DATETIME [--slice=DURATION] [--frequency=FREQUENCY]
+                Send notifications for all activity since a given time (e.g.
+                "2020-01-24 09:00"), to recover after an outage. It works
+                through the activity in time slices (default "1:00:00", i.e.
+                an hour), recording progress after each one, so it can be
+                resumed if interrupted. Pause the regular
+                send-any-notifications while it runs.
+                Option:
+                  --frequency - only backfill this frequency (immediate,
+                                hourly, daily, weekly or monthly)
+
+            subscribe benchmark-fanout
+                Time the pure-Python and vectorized (NumPy) fan-out of
+                activities to subscribers, using synthetic data.
+
+            subscribe import-subscriptions FILENAME [--skip-verification]
+                Sign up the subscribers listed in a CSV file, with a column
+                for each parameter of subscribe_signup (email, dataset_id
+                etc). They are saved in batches, and the rows with errors are
+                listed.
+                Option:
+                  --skip-verification - mark the subscriptions as verified,
+                                        rather than emailing the subscribers
+                                        to verify them
+
+            subscribe unsubscribe-bulk FILENAME
+                Unsubscribe the email addresses listed in a file (one per
+                line) from all their subscriptions e.g. after a bounce report.
+                They are deleted in batches, and the numbers unsubscribed are
+                reported.
+
         '''
 
         summary = __doc__.split('\n')[0]
@@ -93,6 +235,17 @@ if not IS_CKAN_29_OR_HIGHER:
             self.parser.add_option('-r', '--repeatedly', dest='repeatedly',
                                    action='store_true', default=False,
                                    help='Repeat every 10s')
+            self.parser.add_option('--since', dest='since',
+                                   help='Backfill activity since this time')
+            self.parser.add_option('--slice', dest='slice',
+                                   default='1:00:00',
+                                   help='Length of each backfill time slice')
+            self.parser.add_option('--frequency', dest='frequency',
+                                   help='Frequency to backfill')
+            self.parser.add_option('--skip-verification',
+                                   dest='skip_verification',
+                                   action='store_true', default=False,
+                                   help='Mark the subscriptions as verified')
             super(subscribeCommand, self).__init__(name)
 
         def command(self):
@@ -105,10 +258,17 @@ if not IS_CKAN_29_OR_HIGHER:
                 self._load_config()
                 initdb()
                 print('DB tables created')
+            elif self.args[0] == 'create-activity-index':
+                self._load_config()
+                create_activity_index()
             elif self.args[0] == 'send-any-notifications':
                 self._load_config()
                 initdb()
                 send_any_notifications(self.options.repeatedly)
+            elif self.args[0] == 'worker':
+                self._load_config()
+                initdb()
+                run_worker()
             elif self.args[0] == 'create-test-activity':
                 self._load_config()
                 object_id = self.args[1]
@@ -116,6 +276,29 @@ if not IS_CKAN_29_OR_HIGHER:
             elif self.args[0] == 'delete-test-activity':
                 self._load_config()
                 delete_test_activity()
+            elif self.args[0] == 'backfill':
+                self._load_config()
+                initdb()
+                if not self.options.since:
+                    self.parser.error('--since must be specified')
+                backfill(self.options.since, self.options.slice,
+                         [self.options.frequency]
+                         if self.options.frequency else [])
+            elif self.args[0] == 'benchmark-fanout':
+                benchmark_fanout()
+            elif self.args[0] == 'import-subscriptions':
+                self._load_config()
+                initdb()
+                if len(self.args) < 2:
+                    self.parser.error('The CSV filename must be specified')
+                import_subscriptions(self.args[1],
+                                     self.options.skip_verification)
+            elif self.args[0] == 'unsubscribe-bulk':
+                self._load_config()
+                initdb()
+                if len(self.args) < 2:
+                    self.parser.error('The filename must be specified')
+                unsubscribe_bulk(self.args[1])
             else:
                 self.parser.error('Unrecognized command')
 
@@ -123,6 +306,8 @@ if not IS_CKAN_29_OR_HIGHER:
 if IS_CKAN_29_OR_HIGHER:
     import click
 
+    from ckanext.subscribe.model import Frequency
+
     @click.group(name='subscribe')
     @click.help_option('-h', '--help')
     @click.pass_context
@@ -133,6 +318,11 @@ if IS_CKAN_29_OR_HIGHER:
     def initd_cmd():
         initdb()
 
+    @subscribe.command('create-activity-index',
+                       short_help="Create an index on the activity table's timestamp, if it has none.")
+    def create_activity_index_cmd():
+        create_activity_index()
+
     @subscribe.command('send-any-notifications',
                        short_help="Check for activity and for any subscribers, send emails with the notifications.")
     @click.option('-r', '--repeatedly',
@@ -141,6 +331,12 @@ if IS_CKAN_29_OR_HIGHER:
     def send_any_notifications_cmd(repeatedly):
         send_any_notifications(repeatedly)
 
+    @subscribe.command('worker',
+                       short_help="Run continuously, sending notifications as they become due.")
+    def worker_cmd():
+        initdb()
+        run_worker()
+
     @subscribe.command('create-test-activity',
                        short_help="Create some activity for testing purposes, for a given existing object.")
     @click.argument('object_id')
@@ -152,3 +348,36 @@ if IS_CKAN_29_OR_HIGHER:
                                   "Works for test activity on all objects.")
     def delete_test_activity_cmd():
         delete_test_activity()
+
+    @subscribe.command('backfill',
+                       short_help="Send notifications for all activity since a given time, to recover after an outage.")
+    @click.option('--since', required=True,
+                  help='Backfill activity since this time, e.g. "2020-01-24 09:00"')
+    @click.option('--slice', 'slice_length', default='1:00:00',
+                  help='Length of each time slice (default: "1:00:00")')
+    @click.option('--frequency', multiple=True,
+                  type=click.Choice([f.name.lower() for f in Frequency]),
+                  help='Only backfill this frequency (default: all)')
+    def backfill_cmd(since, slice_length, frequency):
+        backfill(since, slice_length, frequency)
+
+    @subscribe.command('benchmark-fanout',
+                       short_help="Time the pure-Python and vectorized (NumPy) fan-out of activities to subscribers.")
+    def benchmark_fanout_cmd():
+        benchmark_fanout()
+
+    @subscribe.command('import-subscriptions',
+                       short_help="Sign up the subscribers listed in a CSV file, in batches.")
+    @click.argument('filename', type=click.Path(exists=True))
+    @click.option('--skip-verification', is_flag=True,
+                  help='Mark the subscriptions as verified, rather than emailing the subscribers to verify them')
+    def import_subscriptions_cmd(filename, skip_verification):
+        initdb()
+        import_subscriptions(filename, skip_verification)
+
+    @subscribe.command('unsubscribe-bulk',
+                       short_help="Unsubscribe the email addresses listed in a file (one per line), in batches.")
+    @click.argument('filename', type=click.Path(exists=True))
+    def unsubscribe_bulk_cmd(filename):
+        initdb()
+        unsubscribe_bulk(filename)
@@ -17,14 +17,17 @@ from ckan.plugins.toolkit import (
 from ckan.lib.mailer import MailerException
 
 from ckanext.subscribe import email_auth
+from ckanext.subscribe import feed as subscribe_feed
 from ckanext.subscribe import model as subscribe_model
 from ckanext.subscribe.constants import IS_CKAN_29_OR_HIGHER
 
 if not IS_CKAN_29_OR_HIGHER:
     from ckan.common import _ as ugettext
+    from ckan.common import response
     from ckan.lib.base import BaseController
 else:
     from ckan.common import ugettext
+    from flask import make_response
 
 
 log = __import__('logging').getLogger(__name__)
@@ -52,6 +55,8 @@ class _SubscribeController:
             'dataset_id': cls.get_value_from_request_data('dataset'),
             'group_id': cls.get_value_from_request_data('group'),
             'organization_id': cls.get_value_from_request_data('organization'),
+            'resource_id': cls.get_value_from_request_data('resource'),
+            'query': cls.get_value_from_request_data('query'),
         }
         context = {
             'model': model,
@@ -64,7 +69,7 @@ class _SubscribeController:
         except ValidationError as err:
             error_messages = []
             for key_ignored in ('message', '__before', 'dataset_id',
-                                'group_id'):
+                                'group_id', 'resource_id', 'query'):
                 if key_ignored in err.error_dict:
                     error_messages.extend(err.error_dict.pop(key_ignored))
             if err.error_dict:
@@ -77,7 +82,8 @@ class _SubscribeController:
                                    'administrator for help'))
             return cls._redirect_back_to_subscribe_page_from_request(data_dict)
         else:
-            subscribe_title = dataset_title or group_title
+            subscribe_title = dataset_title or group_title or \
+                subscription['object_name']
             h.flash_success(
                 ugettext('Subscription to {} was successful, please confirm '
                          'your subscription by checking your email inbox and '
@@ -144,13 +150,20 @@ class _SubscribeController:
             dict(text=f.name.lower().capitalize().replace(
                      'Immediate', 'Immediately'),
                  value=f.name)
-            for f in sorted(subscribe_model.Frequency, key=lambda x: x.value)
+            for f in subscribe_model.FREQUENCIES_IN_ORDER
+        ]
+        activity_type_options = [
+            dict(text=activity_type.replace('package', 'dataset').capitalize(),
+                 value=activity_type)
+            for activity_type in subscribe_model.ACTIVITY_TYPES
         ]
         return render('subscribe/manage.html', extra_vars={
             'email': email,
             'code': code,
+            'feed_code': email_auth.create_feed_code(email),
             'subscriptions': subscriptions,
             'frequency_options': frequency_options,
+            'activity_type_options': activity_type_options,
         })
 
     @classmethod
@@ -199,7 +212,16 @@ class _SubscribeController:
         data_dict = {
             'id': subscription_id,
             'frequency': frequency,
+            # none selected means all activity types
+            'activity_types': cls.get_list_from_request_data('activity_types'),
         }
+        # the checkbox comes after a hidden 'false', so it is only in the
+        # form for organizations
+        include_child_organizations = \
+            cls.get_list_from_request_data('include_child_organizations')
+        if include_child_organizations:
+            data_dict['include_child_organizations'] = \
+                'true' in include_child_organizations
         try:
             get_action('subscribe_update')(context, data_dict)
         except ValidationError as err:
@@ -242,6 +264,8 @@ class _SubscribeController:
             'dataset_id': request.params.get('dataset') or cls.get_value_from_request_data('dataset'),
             'group_id': request.params.get('group') or cls.get_value_from_request_data('group'),
             'organization_id': request.params.get('organization') or cls.get_value_from_request_data('organization'),
+            'resource_id': request.params.get('resource') or cls.get_value_from_request_data('resource'),
+            'query': request.params.get('query') or cls.get_value_from_request_data('query'),
         }
         try:
             object_name, object_type = \
@@ -249,7 +273,7 @@ class _SubscribeController:
         except ValidationError as err:
             error_messages = []
             for key_ignored in ('message', '__before', 'dataset_id',
-                                'group_id'):
+                                'group_id', 'resource_id', 'query'):
                 if key_ignored in err.error_dict:
                     error_messages.extend(err.error_dict.pop(key_ignored))
             if err.error_dict:
@@ -319,6 +343,49 @@ class _SubscribeController:
             __no_cache__=True
         )
 
+    @classmethod
+    def feed(cls):
+        code = request.params.get('code')
+        if not code:
+            abort(400, ugettext('Code not supplied'))
+        try:
+            email = email_auth.authenticate_with_feed_code(code)
+        except ValueError:
+            # the code from a manage link works too, while it lasts
+            try:
+                email = email_auth.authenticate_with_code(code)
+            except ValueError as exp:
+                abort(403, ugettext('Code is invalid: {}'.format(exp)))
+
+        feed_state = subscribe_feed.get_feed_state(email)
+        headers = {'ETag': feed_state.etag,
+                   'Cache-Control': 'private, no-cache'}
+        if feed_state.last_modified:
+            headers['Last-Modified'] = \
+                subscribe_feed.format_http_date(feed_state.last_modified)
+        if subscribe_feed.is_not_modified(
+                feed_state,
+                if_none_match=request.headers.get('If-None-Match'),
+                if_modified_since=request.headers.get('If-Modified-Since')):
+            return cls._feed_response(b'', 304, headers)
+        feed_url = h.url_for('subscribe.feed', code=code, qualified=True) \
+            if IS_CKAN_29_OR_HIGHER else \
+            h.url_for(controller='ckanext.subscribe.controller:SubscribeController',
+                      action='feed', code=code, qualified=True)
+        headers['Content-Type'] = 'application/atom+xml; charset=utf-8'
+        return cls._feed_response(
+            subscribe_feed.get_feed(email, feed_state, feed_url), 200,
+            headers)
+
+    @staticmethod
+    def _feed_response(body, status, headers):
+        if IS_CKAN_29_OR_HIGHER:
+            return make_response(body, status, headers)
+        response.status_int = status
+        for header, value in headers.items():
+            response.headers[header] = value
+        return body
+
     @staticmethod
     def _redirect_back_to_subscribe_page(object_name, object_type):
         if object_type in ('dataset', 'group', 'organization'):
@@ -401,6 +468,18 @@ class _SubscribeController:
             # Ckan >= 2.9
             return request.values.get(name)
 
+    @staticmethod
+    def get_list_from_request_data(name):
+        try:
+            # Ckan < 2.9
+            if request.method == 'GET':
+                return request.params.getall(name)
+            else:
+                return request.POST.getall(name)
+        except AttributeError:
+            # Ckan >= 2.9
+            return request.values.getlist(name)
+
     @staticmethod
     def redirect(new_route, old_route, **kwargs):
         if IS_CKAN_29_OR_HIGHER:
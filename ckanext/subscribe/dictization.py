@@ -3,7 +3,11 @@ import uuid
 from ckan.lib.dictization import table_dict_save, table_dictize
 from ckan import model
 
-from ckanext.subscribe.model import Subscription, Frequency
+from ckanext.subscribe.model import (
+    Subscription,
+    Frequency,
+    split_activity_types,
+)
 
 
 def subscription_save(subscription_dict, context):
@@ -22,9 +26,13 @@ def dictize_subscription(subscription_obj, context, include_name=False):
     # user needs to get the code from the email, to show consent, so there's no
     # exception given for admins to sign someone up on their behalf
     subscription_dict.pop('verification_code')
+    # the webhook secret is only shown when the subscription is created
+    subscription_dict.pop('webhook_secret', None)
 
     if include_name:
-        if subscription_dict['object_type'] == 'dataset':
+        if subscription_dict['object_type'] in ('query', 'resource'):
+            subscription_dict['object_name'] = subscription_dict['object_id']
+        elif subscription_dict['object_type'] == 'dataset':
             subscription_dict['object_name'] = \
                 model.Package.get(subscription_dict['object_id']).id
         else:
@@ -33,5 +41,7 @@ def dictize_subscription(subscription_obj, context, include_name=False):
 
     subscription_dict['frequency'] = \
         Frequency(subscription_dict['frequency']).name
+    subscription_dict['activity_types'] = \
+        split_activity_types(subscription_dict.get('activity_types'))
 
     return subscription_dict
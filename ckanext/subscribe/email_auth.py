@@ -18,7 +18,11 @@ messing with your subscriptions.
 This login is separate to CKAN's normal login, which uses a password.
 '''
 
+import base64
+import binascii
 import datetime
+import hashlib
+import hmac
 import random
 import string
 
@@ -27,6 +31,8 @@ from six import text_type
 import ckan.plugins as p
 from ckan import model
 from ckanext.subscribe import mailer
+from ckanext.subscribe import resource_activity
+from ckanext.subscribe import saved_search
 from ckanext.subscribe.constants import IS_CKAN_29_OR_HIGHER
 from ckanext.subscribe.model import LoginCode
 
@@ -204,10 +210,21 @@ def get_email_vars(code, subscription=None, email=None):
     )
 
     if subscription:
-        if subscription.object_type == 'dataset':
-            subscription_object = model.Package.get(subscription.object_id)
+        if subscription.object_type == 'query':
+            # a saved search is named by its query
+            object_name = subscription.object_id
+            object_title = saved_search.get_query_title(object_name)
+        elif subscription.object_type == 'resource':
+            resource = model.Resource.get(subscription.object_id)
+            object_name = subscription.object_id
+            object_title = resource_activity.get_resource_title(resource)
         else:
-            subscription_object = model.Group.get(subscription.object_id)
+            if subscription.object_type == 'dataset':
+                subscription_object = model.Package.get(subscription.object_id)
+            else:
+                subscription_object = model.Group.get(subscription.object_id)
+            object_name = subscription_object.name
+            object_title = subscription_object.title or object_name
         if IS_CKAN_29_OR_HIGHER:
             object_link = p.toolkit.url_for('dataset.read', id=subscription.object_id, qualified=True)
             unsubscribe_link = p.toolkit.url_for('subscribe.unsubscribe', code=code, qualified=True,
@@ -226,10 +243,14 @@ def get_email_vars(code, subscription=None, email=None):
                 qualified=True,
                 **{subscription.object_type: subscription.object_id}
                 )
+        if subscription.object_type == 'query':
+            object_link = saved_search.get_search_url(subscription.object_id)
+        elif subscription.object_type == 'resource':
+            object_link = resource_activity.get_resource_link(resource)
         extra_vars.update(
             object_type=subscription.object_type,
-            object_title=subscription_object.title or subscription_object.name,
-            object_name=subscription_object.name,
+            object_title=object_title,
+            object_name=object_name,
             object_link=object_link,
             unsubscribe_link=unsubscribe_link,
         )
@@ -263,3 +284,43 @@ def authenticate_with_code(code):
 
     # do the login
     return login_code.email
+
+
+# The activity feed is polled by feed readers, indefinitely, at the same URL,
+# so its code can't expire like a LoginCode. Instead it is the email address
+# signed with a secret, so it doesn't need storing either. It only gives
+# access to the feed, not to managing the subscriptions.
+
+def create_feed_code(email):
+    '''Returns the code for the email address's activity feed URL.'''
+    encoded_email = base64.urlsafe_b64encode(email.encode('utf8')) \
+        .decode('ascii').rstrip('=')
+    return '{}.{}'.format(encoded_email, _sign_feed_email(email))
+
+
+def authenticate_with_feed_code(code):
+    '''Returns the email address that the feed code is for.
+
+    :raises ValueError: if the code is not valid
+    '''
+    encoded_email, _, signature = code.partition('.')
+    try:
+        email = base64.urlsafe_b64decode(
+            (encoded_email + '=' * (-len(encoded_email) % 4))
+            .encode('ascii')).decode('utf8')
+    except (binascii.Error, TypeError, UnicodeError):
+        raise ValueError('Code not recognized')
+    if not hmac.compare_digest(
+            _sign_feed_email(email).encode('ascii'),
+            signature.encode('ascii', 'replace')):
+        raise ValueError('Code not recognized')
+    return email
+
+
+def _sign_feed_email(email):
+    secret = config.get('ckanext.subscribe.feed_secret') or \
+        config.get('beaker.session.secret') or config.get('SECRET_KEY')
+    if not secret:
+        raise ValueError('ckanext.subscribe.feed_secret is not configured')
+    return hmac.new(secret.encode('utf8'), email.encode('utf8'),
+                    hashlib.sha256).hexdigest()[:32]
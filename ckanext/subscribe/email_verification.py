@@ -9,6 +9,8 @@ import ckan.plugins as p
 from ckan import model
 from ckan.lib.helpers import url_for
 from ckanext.subscribe import mailer
+from ckanext.subscribe import resource_activity
+from ckanext.subscribe import saved_search
 from ckanext.subscribe.constants import IS_CKAN_29_OR_HIGHER
 config = p.toolkit.config
 
@@ -70,28 +72,41 @@ def get_verification_email_vars(subscription):
             action='manage',
             qualified=True)
 
-    if subscription.object_type == 'dataset':
-        subscription_object = model.Package.get(subscription.object_id)
+    if subscription.object_type == 'query':
+        # a saved search is named by its query
+        object_name = subscription.object_id
+        object_title = saved_search.get_query_title(object_name)
+        object_link = saved_search.get_search_url(subscription.object_id)
+    elif subscription.object_type == 'resource':
+        resource = model.Resource.get(subscription.object_id)
+        object_name = subscription.object_id
+        object_title = resource_activity.get_resource_title(resource)
+        object_link = resource_activity.get_resource_link(resource)
     else:
-        subscription_object = model.Group.get(subscription.object_id)
-    if IS_CKAN_29_OR_HIGHER:
-        object_link = url_for(
-            'dataset.read',
-            id=subscription.object_id,
-            qualified=True)
-    else:
-        object_link = url_for(
-            controller='package' if subscription.object_type == 'dataset'
-            else subscription.object_type,
-            action='read',
-            id=subscription.object_id,  # prefer id because it is invariant
-            qualified=True)
+        if subscription.object_type == 'dataset':
+            subscription_object = model.Package.get(subscription.object_id)
+        else:
+            subscription_object = model.Group.get(subscription.object_id)
+        if IS_CKAN_29_OR_HIGHER:
+            object_link = url_for(
+                'dataset.read',
+                id=subscription.object_id,
+                qualified=True)
+        else:
+            object_link = url_for(
+                controller='package' if subscription.object_type == 'dataset'
+                else subscription.object_type,
+                action='read',
+                id=subscription.object_id,  # prefer id because it is invariant
+                qualified=True)
+        object_name = subscription_object.name
+        object_title = subscription_object.title or object_name
     extra_vars = dict(
         site_title=config.get('ckan.site_title'),
         site_url=config.get('ckan.site_url'),
         object_type=subscription.object_type,
-        object_title=subscription_object.title or subscription_object.name,
-        object_name=subscription_object.name,
+        object_title=object_title,
+        object_name=object_name,
         object_link=object_link,
         verification_link=verification_link,
         email=subscription.email,
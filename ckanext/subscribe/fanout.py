@@ -0,0 +1,406 @@
+# encoding: utf-8
+
+'''
+Fan-out of activities to the subscriptions that are interested in them, grouped
+by recipient email address.
+
+This is the inner loop of working out notifications - every activity is paired
+with every subscription to its object. When NumPy is installed the pairing is
+done with array operations: object ids and emails are integer-encoded, the
+object -> subscriptions mapping is stored as CSR (compressed sparse row) arrays
+and the pairs are expanded, filtered and grouped in bulk. Without NumPy (or if
+it is disabled in config) the plain Python loop is used. Both give the same
+result.
+
+Where someone's subscriptions overlap (e.g. to a dataset and to its
+organization), each activity is only attributed to the most specific of them.
+This is per delivery channel - an activity covered by both an email
+subscription and a webhook subscription of the same address goes to both.
+
+Resource subscriptions are subscriptions to the resource's dataset, which are
+only paired with the activities that changed the resource.
+'''
+
+import time
+import uuid
+import datetime
+import random
+from collections import defaultdict
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def group_by_recipient(activities, objects_subscribed_to, vectorized=True,
+                       get_changed_resources=None):
+    '''Pairs each activity with the subscriptions to its object, ignoring
+    activity that occurred before the subscription was created, or is not of
+    an activity type the subscription is limited to, or (for a resource
+    subscription) didn't change the resource. If a recipient has several
+    subscriptions that an activity is paired with, it only goes under the
+    most specific one (see get_specificity) of each delivery channel (see
+    get_channel).
+
+    :param activities: list of Activity objects
+    :param objects_subscribed_to: {object_id: [subscription, ...]}
+    :param vectorized: use NumPy, if it is installed
+    :param get_changed_resources: function returning the ids of the resources
+        an activity changed (or None if not known) - see ChangedResources.
+        If not given, resource subscriptions get all their dataset's activity.
+
+    :returns: {email: {subscription: [activity, ...], ...}}
+    '''
+    if vectorized and np is not None:
+        return _group_by_recipient_vectorized(activities,
+                                              objects_subscribed_to,
+                                              get_changed_resources)
+    return _group_by_recipient_python(activities, objects_subscribed_to,
+                                      get_changed_resources)
+
+
+def get_activity_types(subscription):
+    '''Returns the set of activity types the subscription is limited to, or
+    None if it is interested in all of them.
+    '''
+    return frozenset(getattr(subscription, 'activity_type_list', None)
+                     or ()) or None
+
+
+def is_resource_subscription(subscription):
+    return getattr(subscription, 'object_type', None) == 'resource'
+
+
+def is_resource_changed(subscription, activity, get_changed_resources):
+    '''Returns whether the activity changed the resource subscribed to (or
+    might have).
+    '''
+    if get_changed_resources is None:
+        return True
+    changed = get_changed_resources(activity)
+    return changed is None or subscription.object_id in changed
+
+
+def get_channel(subscription):
+    '''Returns how notifications for the subscription are delivered - its
+    webhook URL, or None for email.
+    '''
+    return getattr(subscription, 'webhook_url', None) or None
+
+
+# Subscriptions to more specific objects come first
+OBJECT_TYPE_SPECIFICITY = {'resource': 0, 'dataset': 1, 'organization': 2,
+                           'group': 3, 'query': 4}
+
+
+def get_specificity(subscription):
+    '''Sort key putting the most specific subscription first: resource, then
+    dataset, organization, group and saved search. Ties are broken by id, so
+    that the result is deterministic.
+    '''
+    return (OBJECT_TYPE_SPECIFICITY.get(
+                getattr(subscription, 'object_type', None),
+                len(OBJECT_TYPE_SPECIFICITY)),
+            getattr(subscription, 'id', None) or '')
+
+
+def _group_by_recipient_python(activities, objects_subscribed_to,
+                               get_changed_resources=None):
+    # email: {subscription: [activity, ...], ...}
+    notifications = defaultdict(lambda: defaultdict(list))
+    activity_types = {}  # {subscription: activity_types}
+    for activity in activities:
+        for subscription in objects_subscribed_to[activity.object_id]:
+            # ignore activity that occurs before this subscription was created
+            if (subscription.created or datetime.datetime.min) > \
+                    activity.timestamp:
+                continue
+            # ignore activity of types the subscription isn't interested in
+            if subscription not in activity_types:
+                activity_types[subscription] = get_activity_types(subscription)
+            if activity_types[subscription] is not None and \
+                    activity.activity_type not in activity_types[subscription]:
+                continue
+            # ignore activity that didn't change the resource subscribed to
+            if is_resource_subscription(subscription) and \
+                    not is_resource_changed(subscription, activity,
+                                            get_changed_resources):
+                continue
+
+            notifications[subscription.email][subscription].append(activity)
+    _dedupe(notifications)
+    return notifications
+
+
+def _dedupe(notifications):
+    '''Where a recipient has several subscriptions with the same activity and
+    delivery channel, removes it from all but the most specific one.
+    '''
+    for subscription_activities in notifications.values():
+        if len(subscription_activities) < 2:
+            continue
+        activities_seen = set()  # {(channel, id(activity))}
+        for subscription in sorted(subscription_activities,
+                                   key=get_specificity):
+            channel = get_channel(subscription)
+            activities = [
+                activity for activity in subscription_activities[subscription]
+                if (channel, id(activity)) not in activities_seen]
+            activities_seen.update((channel, id(activity))
+                                   for activity in activities)
+            if activities:
+                subscription_activities[subscription] = activities
+            else:
+                del subscription_activities[subscription]
+
+
+def _group_by_recipient_vectorized(activities, objects_subscribed_to,
+                                   get_changed_resources=None):
+    index = SubscriptionIndex(objects_subscribed_to)
+    pair_email, pair_subscription, pair_activity = index.pairs(
+        activities, get_changed_resources)
+    notifications = defaultdict(lambda: defaultdict(list))
+    if not len(pair_activity):
+        return notifications
+    # the pairs are sorted by email then subscription, so each subscription's
+    # activities are a contiguous run
+    run_starts = np.concatenate(
+        ([0], np.flatnonzero(np.diff(pair_subscription)) + 1))
+    run_ends = np.append(run_starts[1:], len(pair_activity))
+    activity_indexes = pair_activity.tolist()
+    for start, end, subscription_index in zip(
+            run_starts.tolist(), run_ends.tolist(),
+            pair_subscription[run_starts].tolist()):
+        subscription = index.subscriptions[subscription_index]
+        notifications[subscription.email][subscription] = \
+            [activities[i] for i in activity_indexes[start:end]]
+    return notifications
+
+
+class SubscriptionIndex(object):
+    '''Integer-encoded form of {object_id: [subscriptions]}, for vectorized
+    fan-out. Requires NumPy.
+
+    The subscriptions for object code `o` are
+    `subscriptions[indices[indptr[o]:indptr[o + 1]]]`.
+    '''
+    def __init__(self, objects_subscribed_to):
+        self.object_codes = {}  # {object_id: object_code}
+        self.subscriptions = []  # [subscription] by subscription_code
+        self.emails = []  # [email] by email_code
+        subscription_codes = {}
+        email_codes = {}
+        recipient_codes = {}  # {(email, channel): recipient_code}
+        subscription_email_codes = []
+        subscription_recipient_codes = []
+        subscription_created = []
+        subscription_activity_types = []
+        subscription_is_resource = []
+        indptr = [0]
+        indices = []
+        for object_id, subscriptions in objects_subscribed_to.items():
+            self.object_codes[object_id] = len(self.object_codes)
+            for subscription in subscriptions:
+                code = subscription_codes.get(subscription)
+                if code is None:
+                    code = subscription_codes[subscription] = \
+                        len(self.subscriptions)
+                    self.subscriptions.append(subscription)
+                    email_code = email_codes.get(subscription.email)
+                    if email_code is None:
+                        email_code = email_codes[subscription.email] = \
+                            len(self.emails)
+                        self.emails.append(subscription.email)
+                    subscription_email_codes.append(email_code)
+                    subscription_recipient_codes.append(
+                        recipient_codes.setdefault(
+                            (subscription.email, get_channel(subscription)),
+                            len(recipient_codes)))
+                    subscription_created.append(
+                        subscription.created or datetime.datetime.min)
+                    subscription_activity_types.append(
+                        get_activity_types(subscription))
+                    subscription_is_resource.append(
+                        is_resource_subscription(subscription))
+                indices.append(code)
+            indptr.append(len(indices))
+        self.indptr = np.array(indptr, dtype=np.int64)
+        self.indices = np.array(indices, dtype=np.int64)
+        self.subscription_email_codes = \
+            np.array(subscription_email_codes, dtype=np.int64)
+        self.subscription_recipient_codes = \
+            np.array(subscription_recipient_codes, dtype=np.int64)
+        self.subscription_created = _to_microseconds(subscription_created)
+        self.subscription_is_resource = \
+            np.array(subscription_is_resource, dtype=bool)
+        # position of each subscription when sorted by specificity
+        self.subscription_rank = np.empty(len(self.subscriptions),
+                                          dtype=np.int64)
+        self.subscription_rank[sorted(
+            range(len(self.subscriptions)),
+            key=lambda code: get_specificity(self.subscriptions[code]))] = \
+            np.arange(len(self.subscriptions), dtype=np.int64)
+
+        # activity types filter, as a boolean matrix of
+        # subscription_code x activity_type_code, where the last column is for
+        # activity types that no subscription is limited to
+        self.activity_type_codes = {}
+        self.allowed_activity_types = None
+        if any(subscription_activity_types):
+            for activity_types in filter(None, subscription_activity_types):
+                for activity_type in activity_types:
+                    self.activity_type_codes.setdefault(
+                        activity_type, len(self.activity_type_codes))
+            self.allowed_activity_types = np.ones(
+                (len(self.subscriptions), len(self.activity_type_codes) + 1),
+                dtype=bool)
+            for code, activity_types in enumerate(subscription_activity_types):
+                if activity_types is None:
+                    continue
+                self.allowed_activity_types[code, :] = False
+                for activity_type in activity_types:
+                    self.allowed_activity_types[
+                        code, self.activity_type_codes[activity_type]] = True
+
+    def pairs(self, activities, get_changed_resources=None):
+        '''Returns every (email, subscription, activity) triple where the
+        activity is on a subscribed object, occurred after the subscription
+        was created, is of a type it is interested in and (for a resource
+        subscription) changed the resource, as parallel arrays of codes,
+        sorted by email, subscription then activity. Each activity is only
+        paired with the most specific of a recipient's subscriptions with the
+        same delivery channel.
+        '''
+        empty = np.array([], dtype=np.int64)
+        if not activities or not self.subscriptions:
+            return empty, empty, empty
+        object_codes = np.array(
+            [self.object_codes.get(activity.object_id, -1)
+             for activity in activities], dtype=np.int64)
+        timestamps = _to_microseconds(
+            [activity.timestamp for activity in activities])
+        activity_indexes = np.flatnonzero(object_codes >= 0)
+        object_codes = object_codes[activity_indexes]
+
+        # expand each activity into one pair per subscription to its object
+        starts = self.indptr[object_codes]
+        counts = self.indptr[object_codes + 1] - starts
+        num_pairs = int(counts.sum())
+        if not num_pairs:
+            return empty, empty, empty
+        pair_activity = np.repeat(activity_indexes, counts)
+        offsets = np.arange(num_pairs, dtype=np.int64) - \
+            np.repeat(np.cumsum(counts) - counts, counts)
+        pair_subscription = self.indices[np.repeat(starts, counts) + offsets]
+
+        # ignore activity that occurs before the subscription was created
+        keep = self.subscription_created[pair_subscription] <= \
+            timestamps[pair_activity]
+        # ignore activity of types the subscription isn't interested in
+        if self.allowed_activity_types is not None:
+            activity_type_codes = np.array(
+                [self.activity_type_codes.get(activity.activity_type, -1)
+                 for activity in activities], dtype=np.int64)
+            keep &= self.allowed_activity_types[
+                pair_subscription, activity_type_codes[pair_activity]]
+        # ignore activity that didn't change the resource subscribed to -
+        # resource subscriptions are few, so these pairs are checked one by one
+        if get_changed_resources is not None and \
+                self.subscription_is_resource.any():
+            for pair in np.flatnonzero(
+                    keep &
+                    self.subscription_is_resource[pair_subscription]).tolist():
+                keep[pair] = is_resource_changed(
+                    self.subscriptions[pair_subscription[pair]],
+                    activities[pair_activity[pair]], get_changed_resources)
+        pair_activity = pair_activity[keep]
+        pair_subscription = pair_subscription[keep]
+
+        # dedupe - keep the most specific subscription of each recipient's
+        # (email and delivery channel) pairs with an activity
+        pair_recipient = self.subscription_recipient_codes[pair_subscription]
+        order = np.lexsort((self.subscription_rank[pair_subscription],
+                            pair_activity, pair_recipient))
+        sorted_recipient = pair_recipient[order]
+        sorted_activity = pair_activity[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (sorted_recipient[1:] != sorted_recipient[:-1]) | \
+            (sorted_activity[1:] != sorted_activity[:-1])
+        keep = order[first]
+        pair_subscription = pair_subscription[keep]
+        pair_activity = pair_activity[keep]
+
+        pair_email = self.subscription_email_codes[pair_subscription]
+
+        order = np.lexsort((pair_activity, pair_subscription, pair_email))
+        return (pair_email[order], pair_subscription[order],
+                pair_activity[order])
+
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _to_microseconds(datetimes):
+    '''Converts datetimes to an int64 array of microseconds since the epoch.
+    (Much quicker than numpy's own conversion of datetime objects.)
+    '''
+    def microseconds(datetime_):
+        delta = datetime_ - _EPOCH
+        return (delta.days * 86400 + delta.seconds) * 1000000 + \
+            delta.microseconds
+    return np.fromiter((microseconds(datetime_) for datetime_ in datetimes),
+                       dtype=np.int64, count=len(datetimes))
+
+
+class _FakeSubscription(object):
+    def __init__(self, email, created):
+        self.email = email
+        self.created = created
+
+
+class _FakeActivity(object):
+    def __init__(self, object_id, timestamp):
+        self.object_id = object_id
+        self.timestamp = timestamp
+
+
+def benchmark(num_objects=1000, subscriptions_per_object=50,
+              num_activities=20000, num_emails=10000, seed=0):
+    '''Times the pure-Python and vectorized fan-out on synthetic data.
+
+    :returns: {'python': seconds, 'vectorized': seconds or None,
+               'pairs': number of activity/subscription pairs}
+    '''
+    rand = random.Random(seed)
+    now = datetime.datetime.now()
+    emails = ['user{}@example.com'.format(i) for i in range(num_emails)]
+    object_ids = [str(uuid.UUID(int=rand.getrandbits(128)))
+                  for _ in range(num_objects)]
+    objects_subscribed_to = defaultdict(list)
+    for object_id in object_ids:
+        for _ in range(subscriptions_per_object):
+            objects_subscribed_to[object_id].append(_FakeSubscription(
+                rand.choice(emails),
+                now - datetime.timedelta(hours=rand.randint(0, 24 * 14))))
+    activities = [
+        _FakeActivity(rand.choice(object_ids),
+                      now - datetime.timedelta(minutes=rand.randint(0, 60 * 24 * 7)))
+        for _ in range(num_activities)]
+
+    results = {}
+    start = time.time()
+    notifications = _group_by_recipient_python(activities,
+                                               objects_subscribed_to)
+    results['python'] = time.time() - start
+    results['pairs'] = sum(
+        len(activities_)
+        for subscription_activities in notifications.values()
+        for activities_ in subscription_activities.values())
+    if np is not None:
+        start = time.time()
+        _group_by_recipient_vectorized(activities, objects_subscribed_to)
+        results['vectorized'] = time.time() - start
+    else:
+        results['vectorized'] = None
+    return results
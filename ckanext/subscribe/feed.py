@@ -0,0 +1,316 @@
+# encoding: utf-8
+
+'''
+Atom feeds of the activity on a subscriber's subscriptions - for people who'd
+rather poll than get emails (/subscribe/feed?code=...).
+
+A feed's ETag and Last-Modified come from its "watermark" - the latest
+activity on the objects subscribed to (found with the same expansion of
+organizations and groups to their datasets as the notifications use, and the
+datasets that match the saved searches) - and the subscriptions themselves. Working that out is not cheap, so it is cached
+for each subscriber until there is new activity anywhere on the site (the
+latest activity timestamp, which is indexed) or their subscriptions change.
+So a poll when nothing has changed is answered with a 304 after two small
+queries, and otherwise the feed is served from a cache, keyed on the ETag,
+until there is new activity on the subscriptions.
+
+As in the notifications, a resource subscription only gets the activity on its
+dataset that changed the resource. That can't be done in SQL, so the feed's
+activities are fetched a page at a time and checked with ChangedResources,
+until there are enough.
+'''
+
+import calendar
+import collections
+import datetime
+import hashlib
+import threading
+from email.utils import formatdate, parsedate
+from xml.etree import ElementTree
+
+import six
+
+import ckan.plugins as p
+from ckan import model
+from ckan.model import Activity
+from ckan.lib.dictization import model_dictize
+from sqlalchemy import func
+
+from ckanext.subscribe import notification, saved_search
+from ckanext.subscribe.fanout import is_resource_subscription
+from ckanext.subscribe.resource_activity import ChangedResources
+from ckanext.subscribe.constants import IS_CKAN_29_OR_HIGHER
+from ckanext.subscribe.model import Frequency, Subscription
+
+config = p.toolkit.config
+
+ATOM_NAMESPACE = 'http://www.w3.org/2005/Atom'
+
+# activity_filter is the SQL filter for the activity on the subscriptions, or
+# None if there are none. resource_ids is {package_id: frozenset of resource
+# ids} for the datasets that are only subscribed to through resource
+# subscriptions. (It doesn't hold on to the subscription objects, so it can be
+# cached beyond the request.)
+FeedState = collections.namedtuple(
+    'FeedState', ['activity_filter', 'resource_ids', 'etag', 'last_modified'])
+
+# The most pages of activity that are fetched to fill a feed, where resource
+# subscriptions' activity has to be filtered out
+MAX_FEED_PAGES = 10
+
+_cache = None
+_state_cache = None
+
+
+class FeedCache(object):
+    '''A cache of the most recently used feeds, {email: (etag, feed)}. (Also
+    used for the feed states, {email: (key, feed_state)}.)
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.feeds = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, email, etag):
+        with self.lock:
+            cached = self.feeds.pop(email, None)
+            if cached is None:
+                return None
+            self.feeds[email] = cached
+        cached_etag, feed = cached
+        return feed if cached_etag == etag else None
+
+    def set(self, email, etag, feed):
+        if not self.size:
+            return
+        with self.lock:
+            self.feeds.pop(email, None)
+            self.feeds[email] = (etag, feed)
+            while len(self.feeds) > self.size:
+                self.feeds.popitem(last=False)
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = FeedCache(p.toolkit.asint(
+            config.get('ckanext.subscribe.feed_cache_size', 1000)))
+    return _cache
+
+
+def get_state_cache():
+    global _state_cache
+    if _state_cache is None:
+        _state_cache = FeedCache(p.toolkit.asint(
+            config.get('ckanext.subscribe.feed_cache_size', 1000)))
+    return _state_cache
+
+
+def get_feed_length():
+    return p.toolkit.asint(config.get('ckanext.subscribe.feed_length', 50))
+
+
+def get_feed_state(email):
+    '''Returns the FeedState for the email address's feed, from the cache if
+    there has been no new activity and the subscriptions are the same.
+    '''
+    key = (
+        model.Session.query(func.max(Activity.timestamp)).scalar(),
+        get_feed_length(),
+        tuple(model.Session.query(
+            Subscription.id, Subscription.object_id,
+            Subscription.activity_types,
+            Subscription.include_child_organizations)
+            .filter(Subscription.email == email)
+            .order_by(Subscription.id)),
+    )
+    cache = get_state_cache()
+    feed_state = cache.get(email, key)
+    if feed_state is None:
+        feed_state = create_feed_state(email)
+        cache.set(email, key, feed_state)
+    return feed_state
+
+
+def create_feed_state(email):
+    '''Works out the FeedState for the email address's feed.'''
+    objects_subscribed_to = notification.get_objects_subscribed_to(
+        [frequency.value for frequency in Frequency], email=email)
+    for subscription, package_id in saved_search.match_subscriptions(
+            Subscription.email == email):
+        objects_subscribed_to[package_id].append(subscription)
+    resource_ids = dict(
+        (object_id, frozenset(subscription.object_id
+                              for subscription in subscriptions))
+        for object_id, subscriptions in objects_subscribed_to.items()
+        if all(is_resource_subscription(subscription)
+               for subscription in subscriptions))
+    activity_filter = watermark = None
+    if objects_subscribed_to:
+        activity_filter = notification.get_activity_filter(
+            objects_subscribed_to)
+        watermark = _get_activity_query(
+            activity_filter,
+            model.Session.query(func.max(Activity.timestamp))).scalar()
+    subscriptions = set(
+        (subscription.id, subscription.activity_types or '')
+        for subscriptions in objects_subscribed_to.values()
+        for subscription in subscriptions)
+    etag_source = '\n'.join([
+        email,
+        watermark.isoformat() if watermark else '',
+        six.text_type(get_feed_length()),
+        ' '.join('{}:{}'.format(*subscription)
+                 for subscription in sorted(subscriptions)),
+        ' '.join(sorted(objects_subscribed_to)),
+    ])
+    etag = '"{}"'.format(
+        hashlib.sha1(etag_source.encode('utf8')).hexdigest())
+    return FeedState(activity_filter, resource_ids, etag, watermark)
+
+
+def is_not_modified(feed_state, if_none_match=None, if_modified_since=None):
+    '''Returns whether a conditional GET can be answered with 304 Not
+    Modified, given the request's If-None-Match and If-Modified-Since headers.
+    '''
+    if if_none_match:
+        etags = [etag.strip() for etag in if_none_match.split(',')]
+        return '*' in etags or feed_state.etag in etags or \
+            'W/' + feed_state.etag in etags
+    if if_modified_since and feed_state.last_modified:
+        since = parsedate(if_modified_since)
+        if since is None:
+            return False
+        return feed_state.last_modified.replace(microsecond=0) <= \
+            datetime.datetime(*since[:6])
+    return False
+
+
+def format_http_date(datetime_):
+    '''Formats a (naive, UTC) datetime for an HTTP header.'''
+    return formatdate(calendar.timegm(datetime_.utctimetuple()), usegmt=True)
+
+
+def get_feed(email, feed_state, feed_url):
+    '''Returns the Atom feed (bytes), from the cache if it is still current.
+    '''
+    cache = get_cache()
+    feed = cache.get(email, feed_state.etag)
+    if feed is None:
+        feed = create_feed(email, feed_state, feed_url)
+        cache.set(email, feed_state.etag, feed)
+    return feed
+
+
+def create_feed(email, feed_state, feed_url):
+    '''Returns the Atom feed (bytes) of the latest activity on the email
+    address's subscriptions.
+    '''
+    activities = []
+    if feed_state.activity_filter is not None:
+        activities = get_feed_activities(feed_state)
+    context = {'model': model, 'session': model.Session}
+    if IS_CKAN_29_OR_HIGHER:
+        activity_dicts = model_dictize.activity_list_dictize(
+            activities, context, include_data=True)
+    else:
+        activity_dicts = model_dictize.activity_list_dictize(
+            activities, context)
+
+    site_title = config.get('ckan.site_title')
+    feed = ElementTree.Element('feed', xmlns=ATOM_NAMESPACE)
+    _add_element(feed, 'id', 'urn:sha1:{}'.format(
+        hashlib.sha1(email.encode('utf8')).hexdigest()))
+    _add_element(feed, 'title', '{} - subscriptions of {}'.format(
+        site_title, email))
+    _add_element(feed, 'updated', _format_atom_date(
+        feed_state.last_modified or datetime.datetime.utcnow()))
+    ElementTree.SubElement(feed, 'link', rel='self', href=feed_url)
+    author = ElementTree.SubElement(feed, 'author')
+    _add_element(author, 'name', site_title)
+    for activity in activity_dicts:
+        entry = ElementTree.SubElement(feed, 'entry')
+        _add_element(entry, 'id', 'urn:uuid:{}'.format(activity['id']))
+        _add_element(entry, 'title', get_activity_title(activity))
+        _add_element(entry, 'updated', _format_atom_date(
+            p.toolkit.h.date_str_to_datetime(activity['timestamp'])))
+        link = get_activity_link(activity)
+        if link:
+            ElementTree.SubElement(entry, 'link', href=link)
+    return ElementTree.tostring(feed, encoding='utf-8')
+
+
+def get_feed_activities(feed_state):
+    '''Returns the latest activities on the subscriptions, leaving out the
+    activity on datasets subscribed to only through resource subscriptions
+    that didn't change those resources.
+    '''
+    feed_length = get_feed_length()
+    query = _get_activity_query(
+        feed_state.activity_filter, model.Session.query(Activity)) \
+        .order_by(Activity.timestamp.desc())
+    if not feed_state.resource_ids:
+        return query.limit(feed_length).all()
+    changed_resources = ChangedResources()
+    activities = []
+    for page in range(MAX_FEED_PAGES):
+        page_activities = query.offset(page * feed_length) \
+            .limit(feed_length).all()
+        changed_resources.extract([
+            activity for activity in page_activities
+            if activity.object_id in feed_state.resource_ids])
+        for activity in page_activities:
+            resource_ids = feed_state.resource_ids.get(activity.object_id)
+            if resource_ids is not None:
+                changed = changed_resources.get(activity)
+                if changed is not None and not changed & resource_ids:
+                    continue
+            activities.append(activity)
+        if len(activities) >= feed_length or \
+                len(page_activities) < feed_length:
+            break
+    return activities[:feed_length]
+
+
+def get_activity_title(activity):
+    '''Returns a title for the activity e.g. "new dataset: Gold prices"'''
+    activity_type = activity['activity_type'].replace('package', 'dataset')
+    data = activity.get('data') or {}
+    obj = data.get('package') or data.get('group') or {}
+    return '{}: {}'.format(activity_type,
+                           obj.get('title') or obj.get('name') or
+                           activity['object_id'])
+
+
+def get_activity_link(activity):
+    data = activity.get('data') or {}
+    if data.get('package'):
+        object_type, name = 'dataset', data['package'].get('name')
+    elif data.get('group'):
+        object_type = 'organization' \
+            if data['group'].get('is_organization') else 'group'
+        name = data['group'].get('name')
+    else:
+        return None
+    if IS_CKAN_29_OR_HIGHER:
+        return p.toolkit.url_for('{}.read'.format(object_type), id=name,
+                                 qualified=True)
+    return p.toolkit.url_for(
+        controller=object_type.replace('dataset', 'package'), action='read',
+        id=name, qualified=True)
+
+
+def _get_activity_query(activity_filter, query):
+    query = query.filter(activity_filter)
+    return notification.exclude_ignored_users(
+        query, notification.get_ignored_user_ids())
+
+
+def _add_element(parent, tag, text):
+    element = ElementTree.SubElement(parent, tag)
+    element.text = text
+    return element
+
+
+def _format_atom_date(datetime_):
+    return datetime_.replace(microsecond=0).isoformat() + 'Z'
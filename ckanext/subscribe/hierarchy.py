@@ -0,0 +1,111 @@
+# encoding: utf-8
+
+'''
+Organization hierarchies (as set up by ckanext-hierarchy) - a subscription to
+an organization with include_child_organizations also covers the datasets of
+its child organizations, their children and so on.
+
+ckanext-hierarchy stores a child organization as a member of its parent (a
+Member with table_name 'group' and capacity 'parent'). The descendants of the
+subscribed organizations are found with one recursive CTE over those members,
+and cached between notification cycles. The cache is invalidated when the
+hierarchy changes - each cycle compares a fingerprint (an md5 of the
+hierarchy's members and the organizations' states, computed in the database),
+which is cheap even for large trees.
+'''
+
+import threading
+
+from sqlalchemy import func, literal, literal_column, select, and_
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+
+from ckan import model
+from ckan.model import Group, Member
+
+# Member capacity of a child organization, as ckanext-hierarchy sets it
+HIERARCHY_CAPACITY = 'parent'
+
+_cache = None
+
+
+class HierarchyCache(object):
+    '''The descendants of organizations, {org_id: frozenset of org ids}, valid
+    for as long as the hierarchy's fingerprint is unchanged.
+    '''
+    def __init__(self):
+        self.fingerprint = None
+        self.descendants = {}
+        self.lock = threading.Lock()
+
+    def get_descendants(self, organization_ids):
+        '''Returns the organizations' descendants (not including themselves).
+
+        :returns: {org_id: frozenset of descendant org ids}
+        '''
+        fingerprint = get_hierarchy_fingerprint()
+        with self.lock:
+            if fingerprint != self.fingerprint:
+                self.fingerprint = fingerprint
+                self.descendants = {}
+            descendants = dict(
+                (organization_id, self.descendants[organization_id])
+                for organization_id in organization_ids
+                if organization_id in self.descendants)
+        missing = set(organization_ids) - set(descendants)
+        if missing:
+            found = get_descendants(missing)
+            descendants.update(found)
+            with self.lock:
+                if fingerprint == self.fingerprint:
+                    self.descendants.update(found)
+        return descendants
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = HierarchyCache()
+    return _cache
+
+
+def get_hierarchy_fingerprint():
+    '''Returns a value that changes whenever the organization hierarchy does.
+    '''
+    edge = Member.group_id + literal(u'>') + Member.table_id + \
+        literal(u':') + Group.state
+    return model.Session.query(
+        func.md5(func.string_agg(
+            edge, aggregate_order_by(literal_column("','"), edge)))) \
+        .join(Group, Group.id == Member.table_id) \
+        .filter(Member.table_name == 'group') \
+        .filter(Member.capacity == HIERARCHY_CAPACITY) \
+        .filter(Member.state == 'active') \
+        .scalar()
+
+
+def get_descendants(organization_ids):
+    '''Finds the organizations' descendants with one recursive query.
+
+    :returns: {org_id: frozenset of descendant org ids}
+    '''
+    tree = select([Group.id.label('root_id'), Group.id.label('org_id')]) \
+        .where(Group.id.in_(organization_ids)) \
+        .cte('organization_tree', recursive=True)
+    children = select([tree.c.root_id, Member.table_id]) \
+        .select_from(tree.join(Member, Member.group_id == tree.c.org_id)
+                     .join(Group, Group.id == Member.table_id)) \
+        .where(and_(Member.table_name == 'group',
+                    Member.capacity == HIERARCHY_CAPACITY,
+                    Member.state == 'active',
+                    Group.state == 'active',
+                    Group.is_organization.is_(True)))
+    # union (not union all) so that a cycle in the hierarchy terminates
+    tree = tree.union(children)
+    descendants = dict((organization_id, set())
+                       for organization_id in organization_ids)
+    for root_id, org_id in model.Session.execute(
+            select([tree.c.root_id, tree.c.org_id])):
+        if org_id != root_id:
+            descendants[root_id].add(org_id)
+    return dict((organization_id, frozenset(org_ids))
+                for organization_id, org_ids in descendants.items())
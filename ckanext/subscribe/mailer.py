@@ -3,28 +3,35 @@
 # For sending HTML emails. Based on core ckan's mailer
 
 from time import time
-import smtplib
-import socket
-
 
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.header import Header
-from email import utils
+from email import utils, message_from_string
 
 import ckan
 import ckan.plugins as p
-from ckan.lib.mailer import MailerException
+
+from ckanext.subscribe.ratelimit import get_rate_limiter
+from ckanext.subscribe.transport import get_transport
 
 log = __import__('logging').getLogger(__name__)
 config = p.toolkit.config
 _ = p.toolkit._
-asbool = p.toolkit.asbool
 
 
 def _mail_recipient(recipient_name, recipient_email,
                     sender_name, sender_url, subject,
                     body, body_html=None, headers=None):
+    msg = _create_message(recipient_name, recipient_email,
+                          sender_name, sender_url, subject,
+                          body, body_html=body_html, headers=headers)
+    return _mail_payload(msg, config.get('smtp.mail_from'), recipient_email)
+
+
+def _create_message(recipient_name, recipient_email,
+                    sender_name, sender_url, subject,
+                    body, body_html=None, headers=None):
 
     if not headers:
         headers = {}
@@ -55,67 +62,79 @@ def _mail_recipient(recipient_name, recipient_email,
     msg['X-Mailer'] = 'CKAN %s' % ckan.__version__
     if reply_to and reply_to != '':
         msg['Reply-to'] = reply_to
-    _mail_payload(msg, mail_from, recipient_email)
+    return msg
 
 
 def _mail_payload(msg, mail_from, recipient_email):
-    # Send the email using Python's smtplib.
-    smtp_connection = smtplib.SMTP()
-    if 'smtp.test_server' in config:
-        # If 'smtp.test_server' is configured we assume we're running tests,
-        # and don't use the smtp.server, starttls, user, password etc. options.
-        smtp_server = config['smtp.test_server']
-        smtp_starttls = False
-        smtp_user = None
-        smtp_password = None
-    else:
-        smtp_server = config.get('smtp.server', 'localhost')
-        smtp_starttls = asbool(
-            config.get('smtp.starttls'))
-        smtp_user = config.get('smtp.user')
-        smtp_password = config.get('smtp.password')
-
-    try:
-        smtp_connection.connect(smtp_server)
-    except socket.error as e:
-        log.exception(e)
-        raise MailerException('SMTP server could not be connected to: "%s" %s'
-                              % (smtp_server, e))
+    # Wait for the rate limits - returns the time spent waiting
+    rate_limiter = get_rate_limiter()
+    waited = rate_limiter.acquire(recipient_email)
     try:
-        # Identify ourselves and prompt the server for supported features.
-        smtp_connection.ehlo()
-
-        # If 'smtp.starttls' is on in CKAN config, try to put the SMTP
-        # connection into TLS mode.
-        if smtp_starttls:
-            if smtp_connection.has_extn('STARTTLS'):
-                smtp_connection.starttls()
-                # Re-identify ourselves over TLS connection.
-                smtp_connection.ehlo()
-            else:
-                raise MailerException('SMTP server does not support STARTTLS')
-
-        # If 'smtp.user' is in CKAN config, try to login to SMTP server.
-        if smtp_user:
-            assert smtp_password, ('If smtp.user is configured then '
-                                   'smtp.password must be configured as well.')
-            smtp_connection.login(smtp_user, smtp_password)
-
-        smtp_connection.sendmail(mail_from, [recipient_email], msg.as_string())
-        log.info('Sent email to {0}'.format(recipient_email))
-
-    except smtplib.SMTPException as e:
-        msg = '%r' % e
-        log.exception(msg)
-        raise MailerException(msg)
+        get_transport().send(msg, mail_from, recipient_email)
     finally:
-        smtp_connection.quit()
+        rate_limiter.release(recipient_email)
+    return waited
 
 
 def mail_recipient(recipient_name, recipient_email, subject,
                    body, body_html=None, headers=None):
+    '''Sends an email, within the rate limits.
+
+    :returns: the time spent waiting for the rate limits, in seconds
+    '''
     site_title = config.get('ckan.site_title')
     site_url = config.get('ckan.site_url')
     return _mail_recipient(recipient_name, recipient_email,
                            site_title, site_url, subject, body,
                            body_html=body_html, headers=headers)
+
+
+def create_message(recipient_name, recipient_email, subject,
+                   body, body_html=None, headers=None):
+    '''Returns the email as a message, ready for send_message(). (Creating it
+    uses the request context, for translations, whereas sending doesn't, so it
+    can be done in another thread.)
+    '''
+    site_title = config.get('ckan.site_title')
+    site_url = config.get('ckan.site_url')
+    return _create_message(recipient_name, recipient_email,
+                           site_title, site_url, subject, body,
+                           body_html=body_html, headers=headers)
+
+
+def send_message(msg, recipient_email):
+    '''Sends a message made by create_message(), within the rate limits.
+
+    :returns: the time spent waiting for the rate limits, in seconds
+    '''
+    return _mail_payload(msg, config.get('smtp.mail_from'), recipient_email)
+
+
+def send_batch(messages):
+    '''Sends messages made by create_message() together, in one go if the
+    transport supports it (see Transport.batch_size), within the rate limits.
+
+    :param messages: list of (msg, recipient_email)
+    :returns: list of (waited, error) for each message, where waited is the
+        time spent waiting for the rate limits, in seconds, and error is a
+        MailerException if it couldn't be sent, else None
+    '''
+    rate_limiter = get_rate_limiter()
+    mail_from = config.get('smtp.mail_from')
+    waited = [rate_limiter.wait_for_tokens(recipient_email)
+              for _, recipient_email in messages]
+    errors = get_transport().send_batch(
+        [(msg, mail_from, recipient_email)
+         for msg, recipient_email in messages])
+    return list(zip(waited, errors))
+
+
+def resend_message(msg_string, recipient_email):
+    '''Sends again a message made by create_message(), that was stored as a
+    string (e.g. after failing to send), with the Date updated.
+
+    :returns: the time spent waiting for the rate limits, in seconds
+    '''
+    msg = message_from_string(msg_string)
+    msg.replace_header('Date', utils.formatdate(time()))
+    return send_message(msg, recipient_email)
@@ -2,7 +2,7 @@ import logging
 import datetime
 from enum import Enum
 
-from sqlalchemy import Table, Column, types
+from sqlalchemy import Table, Column, Index, UniqueConstraint, types, inspect
 
 from ckan import model
 from ckan.model.meta import metadata, mapper, Session
@@ -18,6 +18,24 @@ __all__ = [
 subscription_table = None
 login_code_table = None
 subscribe_table = None
+activity_summary_table = None
+held_object_table = None
+delivery_table = None
+query_term_table = None
+
+# The activity types that a subscription can be limited to. There is no type
+# for resource changes - CKAN records adding, editing or deleting a resource as
+# 'changed package' of its dataset, so to hear only about one resource, use a
+# resource subscription (resource_id) instead.
+ACTIVITY_TYPES = [
+    'new package', 'changed package', 'deleted package',
+    'new group', 'changed group', 'deleted group',
+    'new organization', 'changed organization', 'deleted organization',
+]
+
+# Pseudo-frequency for the Subscribe row that records the time up to which
+# activity has been summarised (in ActivitySummary)
+ACTIVITY_SUMMARY_FREQUENCY = 0
 
 
 def setup():
@@ -30,15 +48,72 @@ def setup():
         log.debug('Subscription table creation deferred')
         return
 
-    if not subscription_table.exists():
+    # Create each table individually rather than
+    # using metadata.create_all()
+    for table in (subscription_table, login_code_table, subscribe_table,
+                  activity_summary_table, held_object_table, delivery_table,
+                  query_term_table):
+        if not table.exists():
+            table.create()
+            log.debug('Subscription table {} created'.format(table.name))
+        else:
+            add_missing_columns(table)
+
+    if not has_activity_timestamp_index():
+        log.warning(
+            'The activity table has no index on its timestamp, so checking '
+            'for new activity is slow. Create one with the "subscribe '
+            'create-activity-index" command.')
+
+
+def add_missing_columns(table):
+    '''Adds any columns that have been added to the table's definition since
+    it was created.
+    '''
+    engine = model.meta.engine
+    existing_columns = set(
+        column['name'] for column in inspect(engine).get_columns(table.name))
+    for column in table.columns:
+        if column.name in existing_columns:
+            continue
+        engine.execute('ALTER TABLE "{}" ADD COLUMN "{}" {}'.format(
+            table.name, column.name,
+            column.type.compile(dialect=engine.dialect)))
+        log.debug('Column {}.{} added'.format(table.name, column.name))
+
+
+def has_activity_timestamp_index():
+    '''Returns whether core ckan's activity table has an index on the
+    timestamp, which the notifications need, as they regularly query for the
+    latest activity.
+    '''
+    activity_indexes = inspect(model.meta.engine).get_indexes('activity')
+    return any(index['column_names'][:1] == ['timestamp']
+               for index in activity_indexes)
+
 
-        # Create each table individually rather than
-        # using metadata.create_all()
-        subscription_table.create()
-        login_code_table.create()
-        subscribe_table.create()
+def create_activity_timestamp_index():
+    '''Creates an index on the activity table's timestamp, if there isn't
+    one. On PostgreSQL it is built with CREATE INDEX CONCURRENTLY, so that
+    writes to the activity table (i.e. any edit on the site) are not blocked
+    while it is built, which can take a while on a large site.
 
-        log.debug('Subscription tables created')
+    :returns: whether the index was created
+    '''
+    if has_activity_timestamp_index():
+        return False
+    engine = model.meta.engine
+    index = Index('idx_subscribe_activity_timestamp',
+                  model.activity_table.c.timestamp,
+                  postgresql_concurrently=True)
+    with engine.connect() as connection:
+        if engine.dialect.name == 'postgresql':
+            # CONCURRENTLY can't be used inside a transaction
+            connection = connection.execution_options(
+                isolation_level='AUTOCOMMIT')
+        index.create(bind=connection)
+    log.debug('Activity timestamp index created')
+    return True
 
 
 class _DomainObject(DomainObject):
@@ -90,11 +165,41 @@ class Subscription(_DomainObject):
                 self.id, self.email, self.object_type, self.verified,
                 Frequency(self.frequency).name)
 
+    @property
+    def activity_type_list(self):
+        '''The activity types that this subscription is limited to. An empty
+        list means all activity types.
+        '''
+        return split_activity_types(self.activity_types)
+
+
+def split_activity_types(activity_types):
+    '''Activity types are stored comma-separated (they contain spaces)'''
+    if not activity_types:
+        return []
+    return activity_types.split(',')
+
+
+def join_activity_types(activity_types):
+    return ','.join(sorted(set(activity_types))) or None
+
 
 class Frequency(Enum):
     IMMEDIATE = 1
     DAILY = 2
     WEEKLY = 3
+    HOURLY = 4
+    MONTHLY = 5
+
+
+# The frequencies, from most to least frequent
+FREQUENCIES_IN_ORDER = [
+    Frequency.IMMEDIATE,
+    Frequency.HOURLY,
+    Frequency.DAILY,
+    Frequency.WEEKLY,
+    Frequency.MONTHLY,
+]
 
 
 class LoginCode(_DomainObject):
@@ -125,37 +230,192 @@ class Subscribe(_DomainObject):
     '''General state
     '''
     def __repr__(self):
-        return '<Subscribe email_last_sent={}>'.format(
-            self.email_last_sent)
+        return '<Subscribe frequency={} timezone={} emails_last_sent={}>' \
+            .format(self.frequency, self.timezone, self.emails_last_sent)
 
     @classmethod
-    def set_emails_last_sent(cls, frequency, emails_last_sent):
-        subscribe = model.Session.query(cls) \
+    def _get(cls, frequency, timezone=None):
+        return model.Session.query(cls) \
             .filter_by(frequency=frequency) \
+            .filter_by(timezone=timezone) \
             .first()
+
+    @classmethod
+    def set_emails_last_sent(cls, frequency, emails_last_sent, timezone=None):
+        subscribe = cls._get(frequency, timezone)
         if subscribe:
             subscribe.emails_last_sent = emails_last_sent
         else:
             subscribe = cls(frequency=frequency,
+                            timezone=timezone,
                             emails_last_sent=emails_last_sent)
             model.Session.add(subscribe)
         # caller needs to do:
         #   model.Session.commit()
 
     @classmethod
-    def get_emails_last_sent(cls, frequency):
+    def get_emails_last_sent(cls, frequency, timezone=None):
         try:
-            return model.Session.query(cls) \
-                .filter_by(frequency=frequency) \
-                .first() \
-                .emails_last_sent
+            return cls._get(frequency, timezone).emails_last_sent
         except AttributeError:
             return None
 
+    @classmethod
+    def get_all_emails_last_sent(cls):
+        '''Returns when emails were last sent for every frequency and time
+        zone, in one query.
+
+        :returns: {(frequency, timezone): emails_last_sent}
+        '''
+        return dict(
+            ((frequency, timezone), emails_last_sent)
+            for frequency, timezone, emails_last_sent
+            in model.Session.query(cls.frequency, cls.timezone,
+                                   cls.emails_last_sent))
+
+    @classmethod
+    def set_send_window_progress(cls, frequency, cycle, slots_sent,
+                                 timezone=None):
+        '''Records how many of the send window's slots have been sent, for the
+        notifications scheduled at time `cycle`. (Both None when it is done.)
+        The row must already exist.
+        '''
+        subscribe = cls._get(frequency, timezone)
+        subscribe.send_window_cycle = cycle
+        subscribe.send_window_slots_sent = slots_sent
+        # caller needs to do:
+        #   model.Session.commit()
+
+    @classmethod
+    def set_run_in_progress(cls, frequency, run_datetime, timezone=None):
+        '''Records that emails are being sent for the activity up to
+        `run_datetime` (None once they are all sent), so that if the sending
+        is interrupted, it can be resumed. The row must already exist.
+        '''
+        subscribe = cls._get(frequency, timezone)
+        subscribe.run_in_progress = run_datetime
+        # caller needs to do:
+        #   model.Session.commit()
+
+    @classmethod
+    def get_run_in_progress(cls, frequency, timezone=None):
+        subscribe = cls._get(frequency, timezone)
+        return subscribe.run_in_progress if subscribe else None
+
+    @classmethod
+    def get_send_window_progress(cls, frequency, timezone=None):
+        '''Returns (cycle, slots_sent), or (None, 0) if no notifications are
+        part way through being sent.
+        '''
+        subscribe = cls._get(frequency, timezone)
+        if not subscribe or not subscribe.send_window_cycle:
+            return None, 0
+        return subscribe.send_window_cycle, \
+            subscribe.send_window_slots_sent or 0
+
+
+class ActivitySummary(_DomainObject):
+    '''A count of the activity of one type on an object, during one "day" -
+    a day being the 24 hours from the daily notification time. Digests are
+    built from these rather than rescanning the activity table.
+    '''
+    def __repr__(self):
+        return '<ActivitySummary object_id={} day={} activity_type={} ' \
+            'activity_count={}>'.format(
+                self.object_id, self.day, self.activity_type,
+                self.activity_count)
+
+    @property
+    def timestamp(self):
+        # so it can be treated like an Activity when matching to subscriptions
+        # - a subscription created after the first activity it counts doesn't
+        # get it (see split_summaries_at_creation)
+        return self.first_timestamp
+
+
+class HeldObject(_DomainObject):
+    '''An object whose immediate notifications are being held back, because
+    it is still being edited. They are sent once it has been quiet for a
+    while, or it has been held for too long.
+    '''
+    key_attr = 'object_id'
+
+    def __repr__(self):
+        return '<HeldObject object_id={} first_activity={} ' \
+            'last_activity={}>'.format(
+                self.object_id, self.first_activity, self.last_activity)
+
+
+class Delivery(_DomainObject):
+    '''The ledger of notification emails sent (or that failed) in a
+    notification run, so that an interrupted run can be resumed without
+    resending, and failed emails can be retried.
+    '''
+    SENT = 'sent'
+    FAILED = 'failed'
+
+    def __repr__(self):
+        return '<Delivery run={} email={} status={} attempts={}>'.format(
+            self.run, self.email, self.status, self.attempts)
+
+    @classmethod
+    def get_emails(cls, run):
+        '''Returns the emails that have been sent (or have failed and are
+        being retried) in the run.
+        '''
+        return set(email for (email,) in model.Session.query(cls.email)
+                   .filter_by(run=run))
+
+    @classmethod
+    def record_sent(cls, run, email):
+        model.Session.add(cls(run=run, email=email, status=cls.SENT,
+                              attempts=1))
+        # caller needs to do:
+        #   model.Session.commit()
+
+    @classmethod
+    def record_failed(cls, run, email, message, error, next_attempt):
+        model.Session.add(cls(run=run, email=email, status=cls.FAILED,
+                              attempts=1, message=message, error=error,
+                              next_attempt=next_attempt))
+        # caller needs to do:
+        #   model.Session.commit()
+
+    @classmethod
+    def delete_sent(cls, run):
+        '''Clears up the record of the emails sent in the run, once it is
+        complete.
+        '''
+        model.Session.query(cls) \
+            .filter_by(run=run) \
+            .filter_by(status=cls.SENT) \
+            .delete(synchronize_session=False)
+        # caller needs to do:
+        #   model.Session.commit()
+
+    @classmethod
+    def get_retries_due(cls, now):
+        return model.Session.query(cls) \
+            .filter_by(status=cls.FAILED) \
+            .filter(cls.next_attempt <= now) \
+            .order_by(cls.next_attempt) \
+            .all()
+
+
+class QueryTerm(_DomainObject):
+    '''The inverted index of the saved search (query) subscriptions - a row
+    for each of a subscription's terms e.g. "tags:covid" (see saved_search).
+    '''
+    def __repr__(self):
+        return '<QueryTerm term={} subscription_id={}>'.format(
+            self.term, self.subscription_id)
+
 
 def define_tables():
 
-    global subscription_table, login_code_table, subscribe_table
+    global subscription_table, login_code_table, subscribe_table, \
+        activity_summary_table, held_object_table, delivery_table, \
+        query_term_table
 
     subscription_table = Table(
         'subscription',
@@ -163,14 +423,29 @@ def define_tables():
         Column('id', types.UnicodeText, primary_key=True, default=make_uuid),
         Column('email', types.UnicodeText, nullable=False),
         Column('object_type', types.UnicodeText, nullable=False),
-        # object_type is: dataset, group or organization
+        # object_type is: dataset, group, organization, resource or query
+        # object_id is the object's id, or for a query, the saved search
         Column('object_id', types.UnicodeText, nullable=False),
         Column('verified', types.Boolean, default=False),
         Column('verification_code', types.UnicodeText),
         Column('verification_code_expires', types.DateTime),
         Column('created', types.DateTime, default=datetime.datetime.utcnow),
-        # frequency is: immediate, daily, weekly
+        # frequency is: immediate, hourly, daily, weekly, monthly
         Column('frequency', types.Integer),
+        # activity_types limits notifications to activity of these types
+        # (comma-separated). Null means all types.
+        Column('activity_types', types.UnicodeText),
+        # timezone that daily, weekly and monthly notifications are scheduled
+        # in e.g. 'Europe/London'. Null means the site's default.
+        Column('timezone', types.UnicodeText),
+        # webhook_url - if set, notifications are POSTed to it, signed with
+        # webhook_secret, rather than emailed to the email address
+        Column('webhook_url', types.UnicodeText),
+        Column('webhook_secret', types.UnicodeText),
+        # include_child_organizations - for an organization subscription,
+        # also cover the datasets of its descendants in the organization
+        # hierarchy (ckanext-hierarchy). Null means false.
+        Column('include_child_organizations', types.Boolean, default=False),
     )
 
     login_code_table = Table(
@@ -185,10 +460,73 @@ def define_tables():
     subscribe_table = Table(
         'subscribe',
         metadata,
-        # just stores one row for each frequency now
+        # stores one row for each frequency (and time zone, for subscriptions
+        # that have one)
         Column('id', types.UnicodeText, primary_key=True, default=make_uuid),
         Column('frequency', types.Integer),
+        Column('timezone', types.UnicodeText),
         Column('emails_last_sent', types.DateTime, nullable=False),
+        # progress through sending the notifications scheduled at
+        # send_window_cycle, when they are spread over a send window
+        Column('send_window_cycle', types.DateTime),
+        Column('send_window_slots_sent', types.Integer),
+        # the activity up to this time is being notified about, but the
+        # emails are not all sent yet
+        Column('run_in_progress', types.DateTime),
+    )
+
+    activity_summary_table = Table(
+        'subscribe_activity_summary',
+        metadata,
+        Column('id', types.UnicodeText, primary_key=True, default=make_uuid),
+        Column('object_id', types.UnicodeText, nullable=False, index=True),
+        # day is the date on which the 24 hour period starts, at the daily
+        # notification time
+        Column('day', types.Date, nullable=False, index=True),
+        Column('activity_type', types.UnicodeText, nullable=False),
+        Column('activity_count', types.Integer, nullable=False),
+        Column('first_timestamp', types.DateTime, nullable=False),
+        Column('last_timestamp', types.DateTime, nullable=False),
+    )
+
+    held_object_table = Table(
+        'subscribe_held_object',
+        metadata,
+        Column('id', types.UnicodeText, primary_key=True, default=make_uuid),
+        Column('object_id', types.UnicodeText, nullable=False, unique=True),
+        # the held notifications are of the activity after this time
+        Column('activity_from', types.DateTime, nullable=False),
+        Column('first_activity', types.DateTime, nullable=False),
+        Column('last_activity', types.DateTime, nullable=False),
+    )
+
+    delivery_table = Table(
+        'subscribe_delivery',
+        metadata,
+        Column('id', types.UnicodeText, primary_key=True, default=make_uuid),
+        # run identifies the notification run e.g. "daily 2020-01-24 09:00:00"
+        Column('run', types.UnicodeText, nullable=False),
+        Column('email', types.UnicodeText, nullable=False),
+        # status is: sent, failed
+        Column('status', types.UnicodeText, nullable=False),
+        Column('attempts', types.Integer, nullable=False),
+        Column('created', types.DateTime, default=datetime.datetime.now),
+        # for failed emails - the email to resend, and when to retry it
+        Column('message', types.UnicodeText),
+        Column('error', types.UnicodeText),
+        Column('next_attempt', types.DateTime, index=True),
+        UniqueConstraint('run', 'email'),
+    )
+
+    query_term_table = Table(
+        'subscribe_query_term',
+        metadata,
+        Column('id', types.UnicodeText, primary_key=True, default=make_uuid),
+        Column('subscription_id', types.UnicodeText, nullable=False,
+               index=True),
+        # term is field:value e.g. "tags:covid" or "organization:<org id>"
+        Column('term', types.UnicodeText, nullable=False),
+        Index('idx_subscribe_query_term_term', 'term', 'subscription_id'),
     )
 
     mapper(
@@ -203,3 +541,19 @@ def define_tables():
         Subscribe,
         subscribe_table,
     )
+    mapper(
+        ActivitySummary,
+        activity_summary_table,
+    )
+    mapper(
+        HeldObject,
+        held_object_table,
+    )
+    mapper(
+        Delivery,
+        delivery_table,
+    )
+    mapper(
+        QueryTerm,
+        query_term_table,
+    )
@@ -1,26 +1,50 @@
+import calendar
 import datetime
-from collections import defaultdict
+import hashlib
+import time
+from collections import defaultdict, Counter
+from concurrent import futures
+
+import pytz
+import six
+from sqlalchemy import func, cast, types, and_, or_, not_
 
 from ckan import model
-from ckan.model import Activity, Package, Group, Member
+from ckan.model import Activity, Package, Group, Member, Resource
 from ckan.lib.dictization import model_dictize
+from ckan.lib.mailer import MailerException
 from ckan.plugins import toolkit
 from ckan.lib.email_notifications import string_to_timedelta
 
 from ckanext.subscribe import dictization
+from ckanext.subscribe import fanout
+from ckanext.subscribe import hierarchy
+from ckanext.subscribe import resource_activity
+from ckanext.subscribe import saved_search
+from ckanext.subscribe.schedule import Schedule
 from ckanext.subscribe.constants import IS_CKAN_29_OR_HIGHER
 from ckanext.subscribe.model import (
     Subscription,
     Subscribe,
     Frequency,
+    ActivitySummary,
+    HeldObject,
+    Delivery,
+    ACTIVITY_SUMMARY_FREQUENCY,
 )
 from ckanext.subscribe import notification_email
 from ckanext.subscribe import email_auth
+from ckanext.subscribe import mailer
+from ckanext.subscribe import webhook
+from ckanext.subscribe.transport import get_transport
 
 log = __import__('logging').getLogger(__name__)
 
 _config = {}
 
+# counters, over the life of the process
+metrics = Counter()
+
 
 def get_config(key):
     global _config
@@ -39,123 +63,960 @@ def get_config(key):
                 toolkit.config.get('daily_and_weekly_notification_time',
                                    '9:00'),
                 '%H:%M')
+        _config['vectorized_fanout'] = toolkit.asbool(
+            toolkit.config.get('ckanext.subscribe.vectorized_fanout', True))
+        _config['ignore_activity_from_users'] = toolkit.aslist(
+            toolkit.config.get(
+                'ckanext.subscribe.ignore_activity_from_users', '')
+            .replace(',', ' '))
+        _config['ignore_activity_from_site_user'] = toolkit.asbool(
+            toolkit.config.get(
+                'ckanext.subscribe.ignore_activity_from_site_user', False))
+        quiet_period = toolkit.config.get(
+            'ckanext.subscribe.immediate_quiet_period')
+        _config['immediate_quiet_period'] = \
+            string_to_timedelta(quiet_period) if quiet_period \
+            else datetime.timedelta(0)
+        _config['immediate_max_hold'] = string_to_timedelta(
+            toolkit.config.get(
+                'ckanext.subscribe.immediate_max_hold', '1:00:00'))
+        _config['schedules'] = get_schedules_from_config()
+        send_window = toolkit.config.get('ckanext.subscribe.send_window')
+        _config['send_window'] = \
+            string_to_timedelta(send_window) if send_window else None
+        _config['send_window_slots'] = toolkit.asint(
+            toolkit.config.get('ckanext.subscribe.send_window_slots', 60))
+        _config['mail_concurrency'] = toolkit.asint(
+            toolkit.config.get('ckanext.subscribe.mail_concurrency', 1))
+        _config['delivery_retry_interval'] = string_to_timedelta(
+            toolkit.config.get('ckanext.subscribe.delivery_retry_interval',
+                               '0:05:00'))
+        _config['delivery_max_attempts'] = toolkit.asint(
+            toolkit.config.get('ckanext.subscribe.delivery_max_attempts', 5))
 
     return _config[key]
 
 
-def send_any_immediate_notifications():
-    log.debug('send_any_immediate_notifications')
-    notification_datetime = datetime.datetime.now()
-    notifications_by_email = get_immediate_notifications(notification_datetime)
-    if not notifications_by_email:
-        log.debug('no emails to send (immediate frequency)')
-    else:
-        log.debug('sending {} emails (immediate frequency)'
-                  .format(len(notifications_by_email)))
-        send_emails(notifications_by_email)
+# The frequencies that are sent on a schedule (immediate notifications are
+# sent on every run)
+SCHEDULED_FREQUENCIES = [
+    Frequency.HOURLY.value,
+    Frequency.DAILY.value,
+    Frequency.WEEKLY.value,
+    Frequency.MONTHLY.value,
+]
 
-    # record that notifications are 'all done' up to this time
-    Subscribe.set_emails_last_sent(frequency=Frequency.IMMEDIATE.value,
-                                   emails_last_sent=notification_datetime)
-    model.Session.commit()
+# Frequencies whose notifications are built from the ActivitySummary table,
+# rather than from the raw activity
+SUMMARISED_FREQUENCIES = set([Frequency.WEEKLY.value,
+                              Frequency.MONTHLY.value])
 
+# Frequencies that are scheduled in the subscription's time zone, if it has
+# one. The subscriptions in each time zone are sent as a separate "bucket".
+TIMEZONE_FREQUENCIES = set([Frequency.DAILY.value,
+                            Frequency.WEEKLY.value,
+                            Frequency.MONTHLY.value])
 
-def send_weekly_notifications_if_its_time_to():
-    if not is_it_time_to_send_weekly_notifications():
+# get_objects_subscribed_to() timezone value for subscriptions in any zone
+ALL_TIMEZONES = '*'
+
+
+def get_schedules_from_config():
+    '''Returns the schedule for each scheduled frequency. By default they are
+    sent at the daily_and_weekly_notification_time (each hour at that minute,
+    for hourly ones), weekly ones on the weekly_notification_day, and monthly
+    ones on the 1st of the month. Each can be overridden with a cron-like spec
+    in ckanext.subscribe.schedule.<frequency>.
+
+    :returns: {frequency: Schedule}
+    '''
+    notification_time = get_config('daily_and_weekly_notification_time')
+    # cron numbers days of the week from Sunday
+    weekly_day = (get_config('weekly_notification_day') + 1) % 7
+    default_specs = {
+        Frequency.HOURLY.value: '{minute} * * * *',
+        Frequency.DAILY.value: '{minute} {hour} * * *',
+        Frequency.WEEKLY.value: '{minute} {hour} * * {weekly_day}',
+        Frequency.MONTHLY.value: '{minute} {hour} 1 * *',
+    }
+    schedules = {}
+    for frequency in SCHEDULED_FREQUENCIES:
+        spec = toolkit.config.get(
+            'ckanext.subscribe.schedule.{}'.format(
+                Frequency(frequency).name.lower())) or \
+            default_specs[frequency].format(
+                minute=notification_time.minute,
+                hour=notification_time.hour,
+                weekly_day=weekly_day)
+        schedules[frequency] = Schedule(spec)
+    return schedules
+
+
+def get_schedule(frequency):
+    '''Returns the Schedule for the frequency, or None for immediate.'''
+    return get_config('schedules').get(frequency)
+
+
+def get_frequency_period(frequency, now=None):
+    '''Returns how far back the frequency's notifications cover (in addition
+    to the catch-up period), when there is no record of sending them
+    previously, i.e. the time between its scheduled sends. None for
+    immediate.
+    '''
+    schedule = get_schedule(frequency)
+    if schedule is None:
+        return None
+    return schedule.period(now)
+
+
+def send_any_notifications():
+    '''Sends the notifications for all frequencies that are due, in a single
+    pass. The subscriptions are expanded once and the activity is fetched once,
+    covering all the frequencies' time windows, and then the results are
+    partitioned by frequency.
+    '''
+    log.debug('send_any_notifications')
+    frequencies = [Frequency.IMMEDIATE.value] + [
+        frequency for frequency in SCHEDULED_FREQUENCIES
+        if is_it_time_to_send(frequency)]
+    _send_notifications(frequencies)
+
+    # subscriptions with their own time zone are due at different times, so
+    # each zone is a separate bucket, with a smaller set of subscriptions
+    for timezone in get_subscription_timezones():
+        frequencies = [
+            frequency for frequency in SCHEDULED_FREQUENCIES
+            if frequency in TIMEZONE_FREQUENCIES and
+            is_it_time_to_send(frequency, timezone=timezone)]
+        if frequencies:
+            log.debug('sending notifications for time zone {}'
+                      .format(timezone))
+            _send_notifications(frequencies, timezone)
+
+    # (after any interrupted runs have been resumed, which skip the failed
+    # emails)
+    retry_failed_deliveries()
+
+
+def get_next_due_datetime(now=None):
+    '''Returns when notifications are next due to be sent, other than
+    immediate notifications of new activity (which are due whenever there is
+    some), or None if nothing is scheduled. It includes the scheduled
+    frequencies (in each time zone), held immediate notifications, slots of a
+    send window in progress and retries of failed emails.
+    '''
+    now = now or datetime.datetime.now()
+    due = []
+    for frequency in SCHEDULED_FREQUENCIES:
+        due.append(next_notification_datetime(frequency, now))
+    for timezone in get_subscription_timezones():
+        for frequency in SCHEDULED_FREQUENCIES:
+            if frequency in TIMEZONE_FREQUENCIES:
+                due.append(
+                    next_notification_datetime(frequency, now, timezone))
+
+    last_activity, first_activity = model.Session.query(
+        func.min(HeldObject.last_activity),
+        func.min(HeldObject.first_activity)).one()
+    if last_activity:
+        due.append(last_activity + get_config('immediate_quiet_period'))
+        due.append(first_activity + get_config('immediate_max_hold'))
+
+    window = get_config('send_window')
+    if window:
+        slot_length = window // get_config('send_window_slots')
+        for cycle, slots_sent in model.Session.query(
+                Subscribe.send_window_cycle,
+                Subscribe.send_window_slots_sent) \
+                .filter(Subscribe.send_window_cycle.isnot(None)):
+            due.append(cycle + slot_length * (slots_sent or 0))
+
+    due.append(model.Session.query(func.min(Delivery.next_attempt))
+               .filter(Delivery.status == Delivery.FAILED)
+               .scalar())
+    due = [due_datetime for due_datetime in due if due_datetime]
+    return min(due) if due else None
+
+
+def get_subscription_timezones():
+    '''Returns the time zones that subscriptions have been given.'''
+    return sorted(
+        timezone for (timezone,) in model.Session.query(Subscription.timezone)
+        .filter(Subscription.timezone.isnot(None))
+        .filter(Subscription.frequency.in_(TIMEZONE_FREQUENCIES))
+        .distinct())
+
+
+def send_any_immediate_notifications():
+    _send_notifications([Frequency.IMMEDIATE.value])
+
+
+def send_notifications_if_its_time_to(frequency):
+    if not is_it_time_to_send(frequency):
         return
+    _send_notifications([frequency])
 
-    log.debug('send_weekly_notifications')
-    notification_datetime = datetime.datetime.now()
-    notifications_by_email = get_weekly_notifications(notification_datetime)
-    if not notifications_by_email:
-        log.debug('no emails to send (weekly frequency)')
-    else:
-        log.debug('sending {} emails (weekly frequency)'
-                  .format(len(notifications_by_email)))
-        send_emails(notifications_by_email)
 
-    # record that notifications are 'all done' up to this time
-    Subscribe.set_emails_last_sent(frequency=Frequency.WEEKLY.value,
-                                   emails_last_sent=notification_datetime)
-    model.Session.commit()
+def send_weekly_notifications_if_its_time_to():
+    send_notifications_if_its_time_to(Frequency.WEEKLY.value)
 
 
 def send_daily_notifications_if_its_time_to():
-    if not is_it_time_to_send_daily_notifications():
-        return
+    send_notifications_if_its_time_to(Frequency.DAILY.value)
+
+
+def _send_notifications(frequencies, timezone=None):
+    '''Sends the notifications for the given frequencies.
 
-    log.debug('send_daily_notifications')
+    :param timezone: send the notifications for the subscriptions in this
+        time zone's bucket (default: the subscriptions with no time zone)
+    '''
     notification_datetime = datetime.datetime.now()
-    notifications_by_email = get_daily_notifications(notification_datetime)
-    if not notifications_by_email:
-        log.debug('no emails to send (daily frequency)')
-    else:
-        log.debug('sending {} emails (daily frequency)'
-                  .format(len(notifications_by_email)))
-        send_emails(notifications_by_email)
+    frequencies = list(frequencies)
+    send_windows = {}
+    resumed_runs = {}
+    for frequency in list(frequencies):
+        send_window = get_send_window(frequency, notification_datetime,
+                                      timezone)
+        if send_window is None:
+            run_in_progress = Subscribe.get_run_in_progress(frequency,
+                                                            timezone)
+            if run_in_progress:
+                resumed_runs[frequency] = run_in_progress
+            continue
+        cycle, first_slot, end_slot = send_window
+        if first_slot >= end_slot:
+            # the next slot is not due yet
+            frequencies.remove(frequency)
+            continue
+        send_windows[frequency] = send_window
+    notifications_by_frequency = get_notifications_by_frequency(
+        frequencies, notification_datetime, send_windows, timezone,
+        resumed_runs)
+    for frequency in frequencies:
+        frequency_name = Frequency(frequency).name.lower()
+        notifications_by_email = notifications_by_frequency.get(frequency)
+        if frequency in send_windows:
+            send_emails_in_slots(frequency, notifications_by_email or {},
+                                 send_windows[frequency], timezone)
+            continue
+        run_datetime = resumed_runs.get(frequency, notification_datetime)
+        run = get_run_key(frequency, run_datetime, timezone)
+        if not notifications_by_email:
+            log.debug('no emails to send ({} frequency)'
+                      .format(frequency_name))
+        else:
+            log.debug('sending {} emails ({} frequency)'
+                      .format(len(notifications_by_email), frequency_name))
+            if frequency not in resumed_runs:
+                # record the run, so it can be resumed if interrupted
+                if Subscribe.get_emails_last_sent(frequency=frequency,
+                                                  timezone=timezone) is None:
+                    Subscribe.set_emails_last_sent(
+                        frequency=frequency,
+                        emails_last_sent=get_include_activity_from(
+                            frequency, run_datetime, timezone),
+                        timezone=timezone)
+                Subscribe.set_run_in_progress(frequency, run_datetime,
+                                              timezone)
+                model.Session.commit()
+            send_emails(notifications_by_email, run)
 
-    # record that notifications are 'all done' up to this time
-    Subscribe.set_emails_last_sent(frequency=Frequency.DAILY.value,
-                                   emails_last_sent=notification_datetime)
-    model.Session.commit()
+        # record that notifications are 'all done' up to this time
+        Subscribe.set_emails_last_sent(frequency=frequency,
+                                       emails_last_sent=run_datetime,
+                                       timezone=timezone)
+        if frequency in resumed_runs or notifications_by_email:
+            Subscribe.set_run_in_progress(frequency, None, timezone)
+            Delivery.delete_sent(run)
+        model.Session.commit()
 
 
-def get_immediate_notifications(notification_datetime=None):
-    '''Work out what immediate notifications need sending out, based on
-    activity, subscriptions and past notifications.
+def get_send_slot(email, num_slots):
+    '''Returns the recipient's slot in the send window - a stable number
+    from 0 to num_slots - 1, from a hash of the email address.
     '''
-    # just interested in activity which is recent and has a subscriber
-    subscription_frequency = Frequency.IMMEDIATE.value
+    digest = hashlib.md5(email.strip().lower().encode('utf8')).hexdigest()
+    return int(digest, 16) % num_slots
+
+
+def get_send_window(frequency, now, timezone=None):
+    '''If the frequency's notifications are spread over a send window (see
+    ckanext.subscribe.send_window), returns which of the slots are due to be
+    sent now. Slot N is released at N/num_slots of the way through the window,
+    which starts at the scheduled time (the "cycle").
 
+    :returns: (cycle, first_slot, end_slot), where the slots due are
+        first_slot <= slot < end_slot, or None if there is no send window
+    '''
+    window = get_config('send_window')
+    if not window or frequency not in SCHEDULED_FREQUENCIES:
+        return None
+    # windows only apply to frequencies sent less often than the window
+    period = get_frequency_period(frequency, now)
+    if not period or period <= window:
+        return None
+    cycle = most_recent_notification_datetime(frequency, now, timezone)
+    num_slots = get_config('send_window_slots')
+    slot_seconds = window.total_seconds() / num_slots
+    end_slot = min(num_slots,
+                   int((now - cycle).total_seconds() // slot_seconds) + 1)
+    progress_cycle, slots_sent = Subscribe.get_send_window_progress(
+        frequency, timezone)
+    first_slot = slots_sent if progress_cycle == cycle else 0
+    return cycle, first_slot, end_slot
+
+
+def send_emails_in_slots(frequency, notifications_by_email, send_window,
+                         timezone=None):
+    '''Sends the notifications to the recipients in the due slots of the send
+    window, in slot order, recording progress after each slot so that if it is
+    interrupted, slots are not sent twice. Once the last slot is sent, the
+    frequency's notifications are 'all done' up to the scheduled time.
+    '''
+    cycle, first_slot, end_slot = send_window
+    num_slots = get_config('send_window_slots')
+    notifications_by_slot = defaultdict(dict)
+    for email, notifications in notifications_by_email.items():
+        notifications_by_slot[get_send_slot(email, num_slots)][email] = \
+            notifications
+    log.debug('sending {} emails in slots {}-{} of {} ({} frequency)'.format(
+        len(notifications_by_email), first_slot, end_slot - 1, num_slots,
+        Frequency(frequency).name.lower()))
+    if Subscribe.get_emails_last_sent(frequency=frequency,
+                                      timezone=timezone) is None:
+        # create the Subscribe row, to record the progress in
+        Subscribe.set_emails_last_sent(
+            frequency=frequency,
+            emails_last_sent=get_include_activity_from(frequency, cycle,
+                                                       timezone),
+            timezone=timezone)
+    run = get_run_key(frequency, cycle, timezone)
+    for slot in range(first_slot, end_slot):
+        if notifications_by_slot.get(slot):
+            send_emails(notifications_by_slot[slot], run)
+        if slot + 1 < num_slots:
+            Subscribe.set_send_window_progress(frequency, cycle, slot + 1,
+                                               timezone)
+        else:
+            Subscribe.set_emails_last_sent(frequency=frequency,
+                                           emails_last_sent=cycle,
+                                           timezone=timezone)
+            Subscribe.set_send_window_progress(frequency, None, None,
+                                               timezone)
+            Delivery.delete_sent(run)
+        model.Session.commit()
+
+
+def backfill(since, slice_length, frequencies=None, until=None):
+    '''Sends notifications for the activity since a given time, walking
+    through it in time slices, to recover from an outage (of SMTP, cron etc).
+    Unlike the normal sending, it is not limited by
+    ckan.email_notifications_since.
+
+    Each slice is processed and then checkpointed, by updating the frequency's
+    Subscribe.emails_last_sent, so memory use is bounded by the slice length
+    and, if interrupted, running it again resumes after the last complete
+    slice. The normal sending (e.g. cron) should be paused while it runs.
+    Subscriptions with a time zone are backfilled separately, from their
+    time zone bucket's own emails_last_sent.
+
+    :param since: datetime to send notifications of activity from
+    :param slice_length: timedelta - the length of each slice. Scheduled
+        frequencies use slices at least as long as the time between their
+        scheduled sends, e.g. a day for daily notifications.
+    :param frequencies: frequency values to backfill (default: all)
+    :param until: datetime to send notifications of activity until
+        (default: now)
+    '''
+    until = until or datetime.datetime.now()
+    frequencies = frequencies or [frequency.value for frequency in Frequency]
+    for frequency in frequencies:
+        # subscriptions in each time zone are a separate bucket, with its own
+        # record of when they were last sent
+        timezones = [None]
+        if frequency in TIMEZONE_FREQUENCIES:
+            timezones += get_subscription_timezones()
+        for timezone in timezones:
+            _backfill_bucket(frequency, timezone, since, slice_length, until)
+
+
+def _backfill_bucket(frequency, timezone, since, slice_length, until):
+    frequency_name = Frequency(frequency).name.lower()
+    frequency_slice_length = max(
+        slice_length,
+        get_frequency_period(frequency, until) or slice_length)
+    emails_last_sent = Subscribe.get_emails_last_sent(frequency=frequency,
+                                                      timezone=timezone)
+    slice_start = max(since, emails_last_sent) \
+        if emails_last_sent else since
+    while slice_start < until:
+        slice_end = min(slice_start + frequency_slice_length, until)
+        log.info('Backfilling {} notifications for activity {} - {}{}'
+                 .format(frequency_name, slice_start, slice_end,
+                         ' (time zone {})'.format(timezone)
+                         if timezone else ''))
+        notifications_by_email = get_notifications_for_time_slice(
+            frequency, slice_start, slice_end, timezone)
+        run = 'backfill ' + get_run_key(frequency, slice_end, timezone)
+        if notifications_by_email:
+            log.info('sending {} emails ({} frequency)'
+                     .format(len(notifications_by_email), frequency_name))
+            send_emails(notifications_by_email, run)
+
+        # checkpoint
+        Subscribe.set_emails_last_sent(frequency=frequency,
+                                       emails_last_sent=slice_end,
+                                       timezone=timezone)
+        Delivery.delete_sent(run)
+        model.Session.commit()
+        model.Session.remove()
+        slice_start = slice_end
+
+
+def get_notifications_for_time_slice(frequency, include_activity_from,
+                                     include_activity_to, timezone=None):
+    '''Work out the notifications for the activity in the given time slice,
+    for subscriptions of the given frequency.
+
+    :param timezone: the time zone bucket (default: the subscriptions with no
+        time zone)
+    '''
     # {object_id: [subscriptions]}
-    objects_subscribed_to = get_objects_subscribed_to(subscription_frequency)
+    objects_subscribed_to = get_objects_subscribed_to(
+        frequency, timezone, changed_since=include_activity_from)
     if not objects_subscribed_to:
         return {}
+    ignored_user_ids = get_ignored_user_ids()
+    activities = exclude_ignored_users(
+        model.Session.query(Activity)
+        .filter(Activity.timestamp > include_activity_from)
+        .filter(Activity.timestamp <= include_activity_to)
+        .filter(get_activity_filter(objects_subscribed_to)),
+        ignored_user_ids) \
+        .all()
+    if ignored_user_ids:
+        metrics['suppressed_activities'] += model.Session.query(
+            func.count(Activity.id)) \
+            .filter(Activity.timestamp > include_activity_from) \
+            .filter(Activity.timestamp <= include_activity_to) \
+            .filter(get_activity_filter(objects_subscribed_to)) \
+            .filter(Activity.user_id.in_(ignored_user_ids)) \
+            .scalar()
+    if not activities:
+        return {}
+    return get_notifications_by_email(activities, objects_subscribed_to,
+                                      frequency)
+
 
-    emails_last_sent = Subscribe.get_emails_last_sent(
-        frequency=Frequency.IMMEDIATE.value)
+def get_notifications(frequency, notification_datetime=None):
+    '''Work out what notifications of the given frequency need sending out,
+    based on activity, subscriptions and past notifications.
+    '''
+    return get_notifications_by_frequency(
+        [frequency], notification_datetime).get(frequency, {})
+
+
+def get_immediate_notifications(notification_datetime=None):
+    return get_notifications(Frequency.IMMEDIATE.value, notification_datetime)
+
+
+def get_weekly_notifications(notification_datetime=None):
+    return get_notifications(Frequency.WEEKLY.value, notification_datetime)
+
+
+def get_daily_notifications(notification_datetime=None):
+    return get_notifications(Frequency.DAILY.value, notification_datetime)
+
+
+def get_notifications_by_frequency(frequencies, notification_datetime=None,
+                                   send_windows=None, timezone=None,
+                                   resumed_runs=None):
+    '''Work out what notifications need sending out for the given
+    frequencies, based on activity, subscriptions and past notifications.
+
+    :param send_windows: {frequency: (cycle, first_slot, end_slot)} for
+        frequencies being sent over a send window - only the recipients in
+        those slots are included, and only the activity up to the cycle time
+        (see get_send_window)
+    :param timezone: the time zone bucket - for the TIMEZONE_FREQUENCIES, only
+        the subscriptions in this time zone are included (default: the
+        subscriptions with no time zone)
+    :param resumed_runs: {frequency: run_datetime} for frequencies whose
+        last run was interrupted - only the activity up to the run's time is
+        included, so the notifications are the same as that run's
+
+    :returns: {frequency: {email: [notification, ...]}}
+    '''
     now = notification_datetime or datetime.datetime.now()
+    send_windows = send_windows or {}
+    resumed_runs = resumed_runs or {}
+    include_activity_to = dict(
+        (frequency,
+         send_windows[frequency][0] if frequency in send_windows
+         else resumed_runs.get(frequency, now))
+        for frequency in frequencies)
+
+    # cheap check that there is any new activity, before doing the work of
+    # expanding the subscriptions - first the latest activity of all (which
+    # the timestamp index answers without reading the table)...
+    latest_activity = get_latest_activity_timestamp()
+    all_emails_last_sent = Subscribe.get_all_emails_last_sent()
+    include_activity_from = dict(
+        (frequency, get_include_activity_from(
+            frequency, include_activity_to[frequency], timezone,
+            all_emails_last_sent))
+        for frequency in frequencies)
+    since = min(include_activity_from.values())
+
+    # activity by these users (e.g. harvesters) is not notified about
+    ignored_user_ids = get_ignored_user_ids()
+    if latest_activity and latest_activity <= since:
+        latest_activity = None
+    elif latest_activity and ignored_user_ids:
+        # ...and then whether any of the new activity is not ignored
+        latest_activity = get_latest_activity_timestamp(since,
+                                                        ignored_user_ids)
+    # held immediate notifications may be due, even without new activity
+    held_objects_due = Frequency.IMMEDIATE.value in frequencies and \
+        are_held_objects_due(now)
+    if latest_activity:
+        metrics['active_cycles'] += 1
+    elif not held_objects_due:
+        metrics['skipped_cycles'] += 1
+        log.debug('no new activity - skipping')
+        return {}
+    frequencies = [
+        frequency for frequency in frequencies
+        if (latest_activity and
+            include_activity_from[frequency] < latest_activity) or
+        (frequency == Frequency.IMMEDIATE.value and held_objects_due)]
+
+    if not frequencies:
+        return {}
+    # bring the summaries up to date, if a summarised frequency is due
+    if SUMMARISED_FREQUENCIES.intersection(frequencies):
+        summarise_activity(now, ignored_user_ids)
+
+    # {object_id: [subscriptions]}
+    objects_subscribed_to = get_objects_subscribed_to(
+        frequencies, timezone,
+        changed_since=min(include_activity_from[frequency]
+                          for frequency in frequencies))
+    if not objects_subscribed_to:
+        return {}
+    objects_subscribed_to_by_frequency = \
+        partition_by_frequency(objects_subscribed_to)
+    for frequency, (cycle, first_slot, end_slot) in send_windows.items():
+        if frequency not in objects_subscribed_to_by_frequency:
+            continue
+        objects_subscribed_to_by_frequency[frequency] = filter_by_send_slot(
+            objects_subscribed_to_by_frequency[frequency],
+            first_slot, end_slot)
+        if not objects_subscribed_to_by_frequency[frequency]:
+            del objects_subscribed_to_by_frequency[frequency]
+
+    # the summarised frequencies use the activity summaries, except for
+    # resource subscriptions, which need each activity, to tell which
+    # resources it changed
+    activity_objects_subscribed_to_by_frequency = {}
+    summary_objects_subscribed_to_by_frequency = {}
+    for frequency, frequency_objects_subscribed_to in \
+            objects_subscribed_to_by_frequency.items():
+        if frequency not in SUMMARISED_FREQUENCIES:
+            activity_objects_subscribed_to_by_frequency[frequency] = \
+                frequency_objects_subscribed_to
+            continue
+        summary_objects_subscribed_to, resource_objects_subscribed_to = \
+            split_resource_subscriptions(frequency_objects_subscribed_to)
+        if summary_objects_subscribed_to:
+            summary_objects_subscribed_to_by_frequency[frequency] = \
+                summary_objects_subscribed_to
+        if resource_objects_subscribed_to:
+            activity_objects_subscribed_to_by_frequency[frequency] = \
+                resource_objects_subscribed_to
+
+    notifications_by_frequency = {}
+    activity_frequencies = [
+        frequency for frequency in frequencies
+        if frequency in activity_objects_subscribed_to_by_frequency]
+    if activity_frequencies:
+        # one query covering all the frequencies' time windows
+        activity_objects_subscribed_to = defaultdict(list)
+        for frequency in activity_frequencies:
+            for object_id, subscriptions in \
+                    activity_objects_subscribed_to_by_frequency[
+                        frequency].items():
+                activity_objects_subscribed_to[object_id].extend(
+                    subscriptions)
+        activities = exclude_ignored_users(
+            model.Session.query(Activity)
+            .filter(Activity.timestamp > min(
+                include_activity_from[frequency]
+                for frequency in activity_frequencies))
+            .filter(get_activity_filter(activity_objects_subscribed_to)),
+            ignored_user_ids) \
+            .all()
+        # which resources each activity changed is worked out once, for all
+        # the frequencies
+        changed_resources = resource_activity.ChangedResources()
+        for frequency in activity_frequencies:
+            frequency_objects_subscribed_to = \
+                activity_objects_subscribed_to_by_frequency[frequency]
+            frequency_activities = [
+                activity for activity in activities
+                if include_activity_from[frequency] < activity.timestamp <=
+                include_activity_to[frequency] and
+                activity.object_id in frequency_objects_subscribed_to]
+            if frequency == Frequency.IMMEDIATE.value:
+                frequency_activities = debounce_activities(
+                    frequency_activities, frequency_objects_subscribed_to,
+                    include_activity_from[frequency], now, ignored_user_ids)
+            if not frequency_activities:
+                continue
+            notifications_by_frequency[frequency] = get_notifications_by_email(
+                frequency_activities, frequency_objects_subscribed_to,
+                frequency, changed_resources)
+
+    for frequency in frequencies:
+        if frequency not in summary_objects_subscribed_to_by_frequency:
+            continue
+        frequency_objects_subscribed_to = \
+            summary_objects_subscribed_to_by_frequency[frequency]
+        summaries = get_activity_summaries(
+            frequency_objects_subscribed_to,
+            include_activity_from[frequency], include_activity_to[frequency],
+            ignored_user_ids)
+        if not summaries:
+            continue
+        notifications_by_email = notifications_by_frequency.setdefault(
+            frequency, defaultdict(list))
+        for email, notifications in get_summary_notifications_by_email(
+                summaries, frequency_objects_subscribed_to,
+                split_summaries_at_creation(
+                    summaries, frequency_objects_subscribed_to,
+                    ignored_user_ids)).items():
+            notifications_by_email[email].extend(notifications)
+    return notifications_by_frequency
+
+
+def get_latest_activity_timestamp(since=None, ignored_user_ids=()):
+    '''Returns the timestamp of the latest activity, if there is any since the
+    given time, else None.
+
+    :param since: (default: any time)
+    :param ignored_user_ids: disregard activity by these users
+    '''
+    query = model.Session.query(func.max(Activity.timestamp))
+    if since:
+        query = query.filter(Activity.timestamp > since)
+    return exclude_ignored_users(query, ignored_user_ids).scalar()
+
+
+def get_ignored_user_ids():
+    '''Returns the ids of the users whose activity is not notified about
+    (e.g. harvesters), as configured by name or id. They are cached with the
+    config, once all of the users have been found.
+    '''
+    user_names_or_ids = list(get_config('ignore_activity_from_users'))
+    if 'ignored_user_ids' in _config:
+        return _config['ignored_user_ids']
+    if get_config('ignore_activity_from_site_user'):
+        # the site user is named after the site_id
+        user_names_or_ids.append(toolkit.config.get('ckan.site_id'))
+    if not user_names_or_ids:
+        user_ids = []
+    else:
+        user_ids = [
+            user_id for (user_id,) in model.Session.query(model.User.id)
+            .filter(or_(model.User.name.in_(user_names_or_ids),
+                        model.User.id.in_(user_names_or_ids)))]
+    # (a user that doesn't exist yet, e.g. the site user, is looked for again
+    # next time)
+    if len(user_ids) >= len(set(user_names_or_ids)):
+        _config['ignored_user_ids'] = user_ids
+    return user_ids
+
+
+def exclude_ignored_users(query, ignored_user_ids):
+    '''Filters an Activity query to exclude activity by the given users.'''
+    if not ignored_user_ids:
+        return query
+    return query.filter(or_(Activity.user_id.is_(None),
+                            not_(Activity.user_id.in_(ignored_user_ids))))
+
+
+def debounce_activities(activities, objects_subscribed_to,
+                        include_activity_from, now, ignored_user_ids=()):
+    '''Holds back the immediate notifications for objects that are still
+    being edited, until they have been quiet for the
+    ckanext.subscribe.immediate_quiet_period, or have been held for the
+    ckanext.subscribe.immediate_max_hold, so that a burst of edits results in
+    one email, not one per run. Which objects are held is stored in the
+    HeldObject table (committed along with the notifications being sent).
+
+    :param activities: the new activity on the subscribed objects
+    :param objects_subscribed_to: {object_id: [subscriptions]}
+    :param include_activity_from: start of the new activity's time window
+    :param now: the notification time
+
+    :returns: the activities to notify about now, including any previously
+        held activity that is now due
+    '''
+    quiet_period = get_config('immediate_quiet_period')
+    max_hold = get_config('immediate_max_hold')
+    held_objects = dict(
+        (held_object.object_id, held_object)
+        for held_object in model.Session.query(HeldObject))
+    if not quiet_period and not held_objects:
+        return activities
+
+    activities_by_object = defaultdict(list)
+    for activity in activities:
+        activities_by_object[activity.object_id].append(activity)
+
+    activities_to_send = []
+    released_activity_from = {}  # {object_id: activity_from}
+    for object_id in set(activities_by_object) | set(held_objects):
+        object_activities = activities_by_object.get(object_id, [])
+        held_object = held_objects.get(object_id)
+        timestamps = [activity.timestamp for activity in object_activities]
+        if held_object:
+            timestamps += [held_object.first_activity,
+                           held_object.last_activity]
+        first_activity, last_activity = min(timestamps), max(timestamps)
+        if now - last_activity < quiet_period and \
+                now - first_activity < max_hold:
+            # still busy - hold
+            if held_object:
+                held_object.last_activity = last_activity
+            else:
+                model.Session.add(HeldObject(
+                    object_id=object_id,
+                    activity_from=include_activity_from,
+                    first_activity=first_activity,
+                    last_activity=last_activity,
+                ))
+            continue
+        if held_object:
+            model.Session.delete(held_object)
+            if object_id in objects_subscribed_to:
+                released_activity_from[object_id] = held_object.activity_from
+        else:
+            activities_to_send.extend(object_activities)
+
+    if released_activity_from:
+        # the held activity predates this window, so fetch it
+        activities_to_send.extend(exclude_ignored_users(
+            model.Session.query(Activity)
+            .filter(or_(*[
+                and_(Activity.object_id == object_id,
+                     Activity.timestamp > activity_from)
+                for object_id, activity_from
+                in released_activity_from.items()]))
+            .filter(Activity.timestamp <= now),
+            ignored_user_ids))
+    return sorted(activities_to_send, key=lambda activity: activity.timestamp)
+
+
+def are_held_objects_due(now):
+    '''Returns whether any held immediate notifications are due to be sent.'''
+    quiet_period = get_config('immediate_quiet_period')
+    max_hold = get_config('immediate_max_hold')
+    return model.Session.query(HeldObject) \
+        .filter(or_(HeldObject.last_activity <= now - quiet_period,
+                    HeldObject.first_activity <= now - max_hold)) \
+        .count() > 0
+
+
+def get_include_activity_from(frequency, now, timezone=None,
+                              all_emails_last_sent=None):
+    '''Returns the time after which activity should be included in this
+    frequency's notifications (for the given time zone bucket).
+
+    :param all_emails_last_sent: the result of
+        Subscribe.get_all_emails_last_sent(), if it has been got already
+    '''
+    if all_emails_last_sent is None:
+        emails_last_sent = Subscribe.get_emails_last_sent(
+            frequency=frequency, timezone=timezone)
+    else:
+        emails_last_sent = all_emails_last_sent.get((frequency, timezone))
     catch_up_period = get_config('email_notifications_since')
+    period = get_frequency_period(frequency, now)
+    if period is None:
+        if emails_last_sent:
+            return max(emails_last_sent, (now - catch_up_period))
+        return now - catch_up_period
     if emails_last_sent:
-        include_activity_from = max(
-            emails_last_sent, (now - catch_up_period))
-    else:
-        include_activity_from = (now - catch_up_period)
+        return max(emails_last_sent, (now - period - catch_up_period))
+    return now - period
+
+
+def get_activity_filter(objects_subscribed_to, activity_class=Activity):
+    '''Returns an SQL filter for activity on the subscribed objects, which
+    also excludes activity types that none of an object's subscriptions are
+    interested in, so that they are not fetched at all.
+
+    :param objects_subscribed_to: {object_id: [subscriptions]}
+    :param activity_class: Activity, or ActivitySummary
+    '''
+    # group the objects by the activity types wanted (None means all types)
+    object_ids_by_activity_types = defaultdict(list)
+    for object_id, subscriptions in objects_subscribed_to.items():
+        activity_types = set()
+        for subscription in subscriptions:
+            if not subscription.activity_type_list:
+                activity_types = None
+                break
+            activity_types.update(subscription.activity_type_list)
+        object_ids_by_activity_types[
+            tuple(sorted(activity_types)) if activity_types is not None
+            else None].append(object_id)
+
+    clauses = []
+    for activity_types, object_ids in object_ids_by_activity_types.items():
+        clause = activity_class.object_id.in_(object_ids)
+        if activity_types is not None:
+            clause = and_(clause,
+                          activity_class.activity_type.in_(activity_types))
+        clauses.append(clause)
+    return or_(*clauses)
+
+
+def filter_by_send_slot(objects_subscribed_to, first_slot, end_slot):
+    '''Returns only the subscriptions of recipients in the given slots of the
+    send window.
+
+    :param objects_subscribed_to: {object_id: [subscriptions]}
+    '''
+    num_slots = get_config('send_window_slots')
+    slots = {}  # {email: slot}
+    filtered = defaultdict(list)
+    for object_id, subscriptions in objects_subscribed_to.items():
+        for subscription in subscriptions:
+            if subscription.email not in slots:
+                slots[subscription.email] = \
+                    get_send_slot(subscription.email, num_slots)
+            if first_slot <= slots[subscription.email] < end_slot:
+                filtered[object_id].append(subscription)
+    return filtered
+
+
+def partition_by_frequency(objects_subscribed_to):
+    '''Splits the subscriptions by their frequency
+
+    :param objects_subscribed_to: {object_id: [subscriptions]}
+
+    :returns: {frequency: {object_id: [subscriptions]}}
+    '''
+    partitioned = defaultdict(lambda: defaultdict(list))
+    for object_id, subscriptions in objects_subscribed_to.items():
+        for subscription in subscriptions:
+            partitioned[subscription.frequency][object_id].append(subscription)
+    return partitioned
 
-    activities = model.Session.query(Activity) \
-        .filter(Activity.timestamp > include_activity_from) \
-        .filter(Activity.object_id.in_(objects_subscribed_to.keys())) \
-        .all()
-    if not activities:
-        return {}
-    return get_notifications_by_email(activities,
-                                      objects_subscribed_to,
-                                      subscription_frequency)
 
+def split_resource_subscriptions(objects_subscribed_to):
+    '''Splits off the resource subscriptions
 
-def get_objects_subscribed_to(subscription_frequency):
+    :param objects_subscribed_to: {object_id: [subscriptions]}
+
+    :returns: ({object_id: [other subscriptions]},
+               {object_id: [resource subscriptions]})
+    '''
+    others = defaultdict(list)
+    resources = defaultdict(list)
+    for object_id, subscriptions in objects_subscribed_to.items():
+        for subscription in subscriptions:
+            if subscription.object_type == 'resource':
+                resources[object_id].append(subscription)
+            else:
+                others[object_id].append(subscription)
+    return others, resources
+
+
+def get_objects_subscribed_to(subscription_frequency,
+                              timezone=ALL_TIMEZONES, email=None,
+                              changed_since=None):
     ''' Returns the objects we're listening for activity to, and the
     subscriptions they are related to
 
+    :param subscription_frequency: a frequency value, or a list of them
+    :param timezone: only include the subscriptions of TIMEZONE_FREQUENCIES
+        in this time zone's bucket - a time zone name, or None for those with
+        no time zone (default: all of them)
+    :param email: only include this email address's subscriptions
+        (default: everyone's)
+    :param changed_since: include the datasets that have changed since this
+        time and match saved search subscriptions (default: saved searches
+        are left out)
+
     :returns: {object_id: [subscriptions]}
     '''
+    if isinstance(subscription_frequency, (list, tuple, set)):
+        frequencies = list(subscription_frequency)
+    else:
+        frequencies = [subscription_frequency]
+    subscription_filter = Subscription.frequency.in_(frequencies)
+    if timezone != ALL_TIMEZONES:
+        subscription_filter = and_(subscription_filter, or_(
+            Subscription.frequency.notin_(TIMEZONE_FREQUENCIES),
+            Subscription.timezone == timezone if timezone
+            else Subscription.timezone.is_(None)))
+    if email:
+        subscription_filter = and_(subscription_filter,
+                                   Subscription.email == email)
     objects_subscribed_to = defaultdict(list)  # {object_id: [subscriptions]}
     # direct subscriptions - i.e. datasets, orgs & groups
     for subscription in model.Session.query(Subscription) \
-            .filter(Subscription.frequency == subscription_frequency).all():
+            .filter(subscription_filter) \
+            .filter(Subscription.object_type.notin_(['query', 'resource'])) \
+            .all():
         objects_subscribed_to[subscription.object_id].append(subscription)
+    # resource subscriptions are to the resource's dataset (and are paired
+    # with its activities that changed the resource, in the fan-out)
+    for subscription, package_id in \
+            model.Session.query(Subscription, Resource.package_id) \
+            .filter(subscription_filter) \
+            .filter(Subscription.object_type == 'resource') \
+            .join(Resource, Resource.id == Subscription.object_id) \
+            .all():
+        objects_subscribed_to[package_id].append(subscription)
     # also include the datasets attached to the subscribed orgs
     for subscription, package_id in model.Session.query(Subscription, Package.id) \
-            .filter(Subscription.frequency == subscription_frequency) \
+            .filter(subscription_filter) \
             .join(Group, Group.id == Subscription.object_id) \
             .filter(Group.state == 'active') \
             .filter(Group.is_organization.is_(True)) \
             .join(Package, Package.owner_org == Group.id) \
             .all():
         objects_subscribed_to[package_id].append(subscription)
+    # also include the datasets of the subscribed orgs' descendants, for the
+    # subscriptions that include child organizations
+    subscriptions_by_org = defaultdict(list)  # {descendant org_id: [subs]}
+    hierarchy_subscriptions = model.Session.query(Subscription) \
+        .filter(subscription_filter) \
+        .filter(Subscription.object_type == 'organization') \
+        .filter(Subscription.include_child_organizations.is_(True)) \
+        .join(Group, Group.id == Subscription.object_id) \
+        .filter(Group.state == 'active') \
+        .all()
+    if hierarchy_subscriptions:
+        descendants = hierarchy.get_cache().get_descendants(set(
+            subscription.object_id for subscription in hierarchy_subscriptions))
+        for subscription in hierarchy_subscriptions:
+            for org_id in descendants[subscription.object_id]:
+                subscriptions_by_org[org_id].append(subscription)
+    if subscriptions_by_org:
+        for package_id, owner_org in \
+                model.Session.query(Package.id, Package.owner_org) \
+                .filter(Package.owner_org.in_(list(subscriptions_by_org))):
+            objects_subscribed_to[package_id].extend(
+                subscriptions_by_org[owner_org])
     # also include the datasets attached to the subscribed orgs
     for subscription, package_id in model.Session.query(Subscription, Package.id) \
-            .filter(Subscription.frequency == subscription_frequency) \
+            .filter(subscription_filter) \
             .join(Group, Group.id == Subscription.object_id) \
             .filter(Group.state == 'active') \
             .filter(Group.is_organization.is_(False)) \
@@ -164,129 +1025,410 @@ def get_objects_subscribed_to(subscription_frequency):
             .join(Package, Package.id == Member.table_id) \
             .all():
         objects_subscribed_to[package_id].append(subscription)
+    # also include the changed datasets that match the saved searches
+    if changed_since:
+        for subscription, package_id in saved_search.match_datasets(
+                saved_search.get_changed_dataset_ids(changed_since),
+                subscription_filter):
+            objects_subscribed_to[package_id].append(subscription)
     return objects_subscribed_to
 
 
-def is_it_time_to_send_weekly_notifications():
-    emails_last_sent = Subscribe.get_emails_last_sent(
-        frequency=Frequency.WEEKLY.value)
+def is_it_time_to_send(frequency, now=None, timezone=None):
+    '''Returns whether the frequency's notifications are due, i.e. there has
+    been a scheduled time since they were last sent.
+
+    :param timezone: for the subscriptions in this time zone's bucket
+    '''
+    emails_last_sent = Subscribe.get_emails_last_sent(frequency=frequency,
+                                                      timezone=timezone)
     if not emails_last_sent:
         return True
-    return most_recent_weekly_notification_datetime() > emails_last_sent
+    most_recent = most_recent_notification_datetime(frequency, now, timezone)
+    return most_recent is not None and most_recent > emails_last_sent
+
+
+def is_it_time_to_send_weekly_notifications():
+    return is_it_time_to_send(Frequency.WEEKLY.value)
 
 
 def is_it_time_to_send_daily_notifications():
-    emails_last_sent = Subscribe.get_emails_last_sent(
-        frequency=Frequency.DAILY.value)
-    if not emails_last_sent:
-        return True
-    return most_recent_daily_notification_datetime() > emails_last_sent
+    return is_it_time_to_send(Frequency.DAILY.value)
 
 
-def most_recent_weekly_notification_datetime(now=None):
+def most_recent_notification_datetime(frequency, now=None, timezone=None):
+    '''Returns the latest scheduled time for the frequency's notifications,
+    at or before now.
+
+    :param timezone: evaluate the schedule in this time zone (times in and
+        out are still in the server's time)
+    '''
+    schedule = get_schedule(frequency)
+    if not timezone or frequency not in TIMEZONE_FREQUENCIES:
+        return schedule.most_recent(now)
     now = now or datetime.datetime.now()
-    this_weeks_notification_date = now + datetime.timedelta(
-        days=get_config('weekly_notification_day') - now.weekday(),
-        hours=get_config('daily_and_weekly_notification_time').hour - now.hour,
-        minutes=get_config('daily_and_weekly_notification_time').minute - now.minute)
-    if this_weeks_notification_date > now:
-        return this_weeks_notification_date - datetime.timedelta(days=7)
-    return this_weeks_notification_date
+    return from_local_time(
+        schedule.most_recent(to_local_time(now, timezone)), timezone)
 
 
-def most_recent_daily_notification_datetime(now=None):
+def next_notification_datetime(frequency, now=None, timezone=None):
+    '''Returns when the frequency's notifications are next due, after now.'''
+    schedule = get_schedule(frequency)
+    if not timezone or frequency not in TIMEZONE_FREQUENCIES:
+        return schedule.next_due(now)
     now = now or datetime.datetime.now()
-    todays_notification_time = now + datetime.timedelta(
-        hours=get_config('daily_and_weekly_notification_time').hour - now.hour,
-        minutes=get_config('daily_and_weekly_notification_time').minute - now.minute)
-    if todays_notification_time > now:
-        return todays_notification_time - datetime.timedelta(days=1)
-    return todays_notification_time
+    return from_local_time(
+        schedule.next_due(to_local_time(now, timezone)), timezone)
 
 
-def get_weekly_notifications(notification_datetime=None):
-    '''Work out what weekly notifications need sending out, based on activity,
-    subscriptions and past notifications.
+def to_local_time(server_datetime, timezone):
+    '''Converts a naive datetime in the server's time (as returned by
+    datetime.now()) to a naive one in the time zone
     '''
-    # interested in activity which is this week and has a subscriber
-    subscription_frequency = Frequency.WEEKLY.value
+    utc_datetime = datetime.datetime.utcfromtimestamp(
+        time.mktime(server_datetime.timetuple())) \
+        .replace(microsecond=server_datetime.microsecond)
+    return pytz.utc.localize(utc_datetime) \
+        .astimezone(pytz.timezone(timezone)) \
+        .replace(tzinfo=None)
 
-    # {object_id: [subsciptions]}
-    objects_subscribed_to = get_objects_subscribed_to(subscription_frequency)
-    if not objects_subscribed_to:
-        return {}
 
-    emails_last_sent = Subscribe.get_emails_last_sent(
-        frequency=Frequency.WEEKLY.value)
-    now = notification_datetime or datetime.datetime.now()
-    catch_up_period = get_config('email_notifications_since')
-    week = datetime.timedelta(days=7)
-    if emails_last_sent:
-        include_activity_from = max(
-            emails_last_sent, (now - week - catch_up_period))
-    else:
-        include_activity_from = (now - week)
+def from_local_time(local_datetime, timezone):
+    '''Converts a naive datetime in the time zone to a naive one in the
+    server's time
+    '''
+    if local_datetime is None:
+        return None
+    utc_datetime = pytz.timezone(timezone).localize(local_datetime) \
+        .astimezone(pytz.utc)
+    return datetime.datetime.fromtimestamp(
+        calendar.timegm(utc_datetime.timetuple())) \
+        .replace(microsecond=local_datetime.microsecond)
 
-    activities = model.Session.query(Activity) \
-        .filter(Activity.timestamp > include_activity_from) \
-        .filter(Activity.object_id.in_(objects_subscribed_to.keys())) \
-        .all()
-    if not activities:
-        return {}
-    return get_notifications_by_email(activities,
-                                      objects_subscribed_to,
-                                      subscription_frequency)
 
+def most_recent_weekly_notification_datetime(now=None):
+    return most_recent_notification_datetime(Frequency.WEEKLY.value, now)
 
-def get_daily_notifications(notification_datetime=None):
-    '''Work out what daily notifications need sending out, based on activity,
-    subscriptions and past notifications.
+
+def most_recent_daily_notification_datetime(now=None):
+    return most_recent_notification_datetime(Frequency.DAILY.value, now)
+
+
+def get_activity_day_offset():
+    '''Activity summary "days" start at the daily notification time, so that
+    digests cover whole days. Returns the offset from midnight.
     '''
-    # interested in activity which is this week and has a subscriber
-    subscription_frequency = Frequency.DAILY.value
+    notification_time = get_config('daily_and_weekly_notification_time')
+    return datetime.timedelta(hours=notification_time.hour,
+                              minutes=notification_time.minute)
 
-    # {object_id: [subscriptions]}
-    objects_subscribed_to = get_objects_subscribed_to(subscription_frequency)
-    if not objects_subscribed_to:
-        return {}
 
-    emails_last_sent = Subscribe.get_emails_last_sent(
-        frequency=Frequency.DAILY.value)
-    now = notification_datetime or datetime.datetime.now()
-    catch_up_period = get_config('email_notifications_since')
-    day = datetime.timedelta(days=1)
-    if emails_last_sent:
-        include_activity_from = max(
-            emails_last_sent, (now - day - catch_up_period))
-    else:
-        include_activity_from = (now - day)
+def get_earliest_summarised_activity(until):
+    return until - \
+        max(get_frequency_period(frequency, until) or datetime.timedelta(0)
+            for frequency in SUMMARISED_FREQUENCIES) - \
+        get_config('email_notifications_since')
 
-    activities = model.Session.query(Activity) \
-        .filter(Activity.timestamp > include_activity_from) \
-        .filter(Activity.object_id.in_(objects_subscribed_to.keys())) \
+
+def get_summarise_activity_from(until):
+    '''Returns the time after which activity has yet to be summarised (the
+    watermark, unless that is older than any digest will need).
+    '''
+    earliest = get_earliest_summarised_activity(until)
+    summarised_to = Subscribe.get_emails_last_sent(
+        frequency=ACTIVITY_SUMMARY_FREQUENCY)
+    return max(summarised_to, earliest) if summarised_to else earliest
+
+
+def summarise_activity(until=None, ignored_user_ids=None):
+    '''Adds the activity since it was last summarised, up until the given time,
+    to the ActivitySummary table. Only aggregates are read from the activity
+    table - not the activity rows themselves. It is done when a summarised
+    frequency is due, rather than every cycle.
+
+    :param ignored_user_ids: leave out activity by these users (default: as
+        configured)
+    '''
+    until = until or datetime.datetime.now()
+    summarise_from = get_summarise_activity_from(until)
+    if summarise_from >= until:
+        return
+    if ignored_user_ids is None:
+        ignored_user_ids = get_ignored_user_ids()
+
+    day_offset = get_activity_day_offset()
+    day = cast(Activity.timestamp - day_offset, types.Date)
+    rows = exclude_ignored_users(
+        model.Session.query(
+            Activity.object_id, Activity.activity_type, day,
+            func.count(Activity.id),
+            func.min(Activity.timestamp), func.max(Activity.timestamp))
+        .filter(Activity.timestamp > summarise_from)
+        .filter(Activity.timestamp <= until),
+        ignored_user_ids) \
+        .group_by(Activity.object_id, Activity.activity_type, day) \
         .all()
-    if not activities:
-        return {}
-    return get_notifications_by_email(activities,
-                                      objects_subscribed_to,
-                                      subscription_frequency)
+    if ignored_user_ids:
+        # each activity is summarised once, so this is where it is counted
+        metrics['suppressed_activities'] += model.Session.query(
+            func.count(Activity.id)) \
+            .filter(Activity.timestamp > summarise_from) \
+            .filter(Activity.timestamp <= until) \
+            .filter(Activity.user_id.in_(ignored_user_ids)) \
+            .scalar()
+    if rows:
+        existing_summaries = dict(
+            ((summary.object_id, summary.day, summary.activity_type), summary)
+            for summary in model.Session.query(ActivitySummary)
+            .filter(ActivitySummary.day.in_(set(row[2] for row in rows)))
+            .filter(ActivitySummary.object_id.in_(set(row[0] for row in rows)))
+        )
+        for object_id, activity_type, day_, count, first_timestamp, \
+                last_timestamp in rows:
+            summary = existing_summaries.get((object_id, day_, activity_type))
+            if summary:
+                summary.activity_count += count
+                summary.first_timestamp = min(summary.first_timestamp,
+                                              first_timestamp)
+                summary.last_timestamp = max(summary.last_timestamp,
+                                             last_timestamp)
+            else:
+                model.Session.add(ActivitySummary(
+                    object_id=object_id,
+                    day=day_,
+                    activity_type=activity_type,
+                    activity_count=count,
+                    first_timestamp=first_timestamp,
+                    last_timestamp=last_timestamp,
+                ))
+
+    # summaries older than any digest will need can go
+    model.Session.query(ActivitySummary) \
+        .filter(ActivitySummary.day <
+                (get_earliest_summarised_activity(until) - day_offset).date()) \
+        .delete(synchronize_session=False)
+
+    Subscribe.set_emails_last_sent(frequency=ACTIVITY_SUMMARY_FREQUENCY,
+                                   emails_last_sent=until)
+    model.Session.commit()
+
+
+def get_activity_summaries(objects_subscribed_to, include_activity_from,
+                           until, ignored_user_ids=()):
+    '''Returns the activity summaries for the subscribed objects which have
+    activity in the time window.
+
+    Summary days start at the daily notification time, but the window may
+    not (e.g. for subscriptions in another time zone, or a custom weekly or
+    monthly schedule), so the days only partly in the window are summarised
+    from the activity itself, on the fly, rather than taken from the stored
+    summaries, which would include activity from outside the window.
+
+    :param ignored_user_ids: leave out activity by these users (in the
+        partial days - the stored summaries already do)
+    '''
+    day_offset = get_activity_day_offset()
+
+    def day_start(day):
+        return datetime.datetime.combine(day, datetime.time()) + day_offset
+
+    # the whole days in the window are first_day <= day < end_day
+    first_day = (include_activity_from - day_offset).date()
+    if day_start(first_day) < include_activity_from:
+        first_day += datetime.timedelta(days=1)
+    end_day = (until - day_offset).date()
+    if first_day >= end_day:
+        return get_partial_day_summaries(
+            objects_subscribed_to, ignored_user_ids,
+            Activity.timestamp > include_activity_from,
+            Activity.timestamp <= until)
+    return get_partial_day_summaries(
+        objects_subscribed_to, ignored_user_ids,
+        Activity.timestamp > include_activity_from,
+        Activity.timestamp < day_start(first_day)) + \
+        model.Session.query(ActivitySummary) \
+        .filter(get_activity_filter(objects_subscribed_to, ActivitySummary)) \
+        .filter(ActivitySummary.day >= first_day) \
+        .filter(ActivitySummary.day < end_day) \
+        .order_by(ActivitySummary.day, ActivitySummary.activity_type) \
+        .all() + \
+        get_partial_day_summaries(
+            objects_subscribed_to, ignored_user_ids,
+            Activity.timestamp >= day_start(end_day),
+            Activity.timestamp <= until)
+
+
+def get_partial_day_summaries(objects_subscribed_to, ignored_user_ids,
+                              *timestamp_filters):
+    '''Summarises the activity on the subscribed objects in part of a day,
+    like the stored summaries but not saved. Only aggregates are read from the
+    activity table.
+    '''
+    return [
+        ActivitySummary(
+            object_id=object_id,
+            activity_type=activity_type,
+            activity_count=count,
+            first_timestamp=first_timestamp,
+            last_timestamp=last_timestamp,
+        )
+        for object_id, activity_type, count, first_timestamp, last_timestamp
+        in exclude_ignored_users(
+            model.Session.query(
+                Activity.object_id, Activity.activity_type,
+                func.count(Activity.id),
+                func.min(Activity.timestamp), func.max(Activity.timestamp))
+            .filter(and_(*timestamp_filters))
+            .filter(get_activity_filter(objects_subscribed_to)),
+            ignored_user_ids)
+        .group_by(Activity.object_id, Activity.activity_type)
+        .order_by(Activity.activity_type)]
+
+
+def split_summaries_at_creation(summaries, objects_subscribed_to,
+                                ignored_user_ids=()):
+    '''A summary that spans a subscription's creation is not given to the
+    subscription (see ActivitySummary.timestamp), because it counts activity
+    from before the subscription existed. Instead, this summarises the
+    subscription's activity on those objects since it was created, to the end
+    of the summaries. (Only recent subscriptions are affected.)
+
+    :returns: {subscription: [summary, ...]}
+    '''
+    # {subscription: {(object_id, activity_type): summary}}
+    spanned = defaultdict(dict)
+    for summary in summaries:
+        for subscription in objects_subscribed_to.get(summary.object_id, ()):
+            if subscription.created and \
+                    summary.first_timestamp < subscription.created <= \
+                    summary.last_timestamp:
+                spanned[subscription][
+                    (summary.object_id, summary.activity_type)] = summary
+    split_summaries = {}
+    for subscription, spanned_summaries in spanned.items():
+        # the spanned summaries are all of the day (or part of a day) that
+        # the subscription was created in
+        until = max(summary.last_timestamp
+                    for summary in spanned_summaries.values())
+        subscription_summaries = [
+            summary for summary in get_partial_day_summaries(
+                dict((object_id, [subscription])
+                     for object_id, _ in spanned_summaries),
+                ignored_user_ids,
+                Activity.timestamp >= subscription.created,
+                Activity.timestamp <= until)
+            if (summary.object_id, summary.activity_type)
+            in spanned_summaries]
+        if subscription_summaries:
+            split_summaries[subscription] = subscription_summaries
+    return split_summaries
+
+
+def get_summary_notifications_by_email(summaries, objects_subscribed_to,
+                                       split_summaries=None):
+    '''Pairs the activity summaries with the subscriptions, grouped by
+    recipient, and dictizes them.
+
+    :param split_summaries: {subscription: [summary, ...]} from
+        split_summaries_at_creation, added to the subscriptions' summaries,
+        unless the recipient gets that activity through another subscription
+    '''
+    # email: {subscription: [summary, ...], ...}
+    notifications = fanout.group_by_recipient(
+        summaries, objects_subscribed_to,
+        vectorized=get_config('vectorized_fanout'))
+    for subscription, subscription_summaries in \
+            (split_summaries or {}).items():
+        recipient_summaries = notifications[subscription.email]
+        channel = fanout.get_channel(subscription)
+        other_summaries = [
+            summary
+            for other, summaries_ in recipient_summaries.items()
+            if other is not subscription and
+            fanout.get_channel(other) == channel
+            for summary in summaries_]
+        subscription_summaries = [
+            summary for summary in subscription_summaries
+            if not any(
+                other.object_id == summary.object_id and
+                other.activity_type == summary.activity_type and
+                other.first_timestamp <= summary.first_timestamp and
+                other.last_timestamp >= summary.last_timestamp
+                for other in other_summaries)]
+        if subscription_summaries:
+            recipient_summaries[subscription] = sorted(
+                recipient_summaries[subscription] + subscription_summaries,
+                key=lambda summary: summary.first_timestamp)
+        elif not recipient_summaries:
+            del notifications[subscription.email]
+
+    object_ids = set(summary.object_id for summary in summaries)
+    objects = dict(
+        (package.id, {'package': {'id': package.id, 'name': package.name,
+                                  'title': package.title}})
+        for package in model.Session.query(Package)
+        .filter(Package.id.in_(object_ids)))
+    objects.update(dict(
+        (group.id, {'group': {'id': group.id, 'name': group.name,
+                              'title': group.title}})
+        for group in model.Session.query(Group)
+        .filter(Group.id.in_(object_ids - set(objects)))))
+
+    notifications_by_email_dictized = defaultdict(list)
+    for email, subscription_summaries in notifications.items():
+        notifications_by_email_dictized[email] = \
+            dictize_summary_notifications(subscription_summaries, objects)
+    return notifications_by_email_dictized
+
+
+def dictize_summary_notifications(subscription_summaries, objects):
+    '''Dictizes a subscription and its activity summaries, in the same form as
+    dictize_notifications, so that each summary is like an activity, plus an
+    activity_count.
+
+    :param subscription_summaries: {subscription: [summary, ...], ...}
+    :param objects: {object_id: {'package' or 'group': {id, name, title}}}
+
+    :returns: [{'subscription': {...}, {'activities': [{...}, ...]}}]
+    '''
+    context = {'model': model, 'session': model.Session}
+    notifications_dictized = []
+    for subscription, summaries in subscription_summaries.items():
+        subscription_dict = \
+            dictization.dictize_subscription(subscription, context)
+        activity_dicts = [
+            {
+                'object_id': summary.object_id,
+                'activity_type': summary.activity_type,
+                'timestamp': summary.last_timestamp.isoformat(),
+                'activity_count': summary.activity_count,
+                'data': objects.get(summary.object_id, {}),
+            }
+            for summary in summaries]
+        notifications_dictized.append(
+            {
+                'subscription': subscription_dict,
+                'activities': activity_dicts,
+            }
+        )
+    return notifications_dictized
 
 
 def get_notifications_by_email(activities, objects_subscribed_to,
-                               subscription_frequency):
+                               subscription_frequency, changed_resources=None):
+    # which resources the activities changed, for the resource subscriptions
+    if changed_resources is None:
+        changed_resources = resource_activity.ChangedResources()
+    changed_resources.extract_for_subscriptions(activities,
+                                                objects_subscribed_to)
     # group by email address
     # so we can send each email address one email with all their notifications
     # and also have access to the subscription object with the object_type etc
-    # (done in a loop rather than sql merely because of ease/clarity)
     # email: {subscription: [activity, ...], ...}
-    notifications = defaultdict(lambda: defaultdict(list))
-    for activity in activities:
-        for subscription in objects_subscribed_to[activity.object_id]:
-            # ignore activity that occurs before this subscription was created
-            if subscription.created > activity.timestamp:
-                continue
-
-            notifications[subscription.email][subscription].append(activity)
+    notifications = fanout.group_by_recipient(
+        activities, objects_subscribed_to,
+        vectorized=get_config('vectorized_fanout'),
+        get_changed_resources=changed_resources.get)
 
     # dictize
     notifications_by_email_dictized = defaultdict(list)
@@ -324,7 +1466,261 @@ def dictize_notifications(subscription_activities):
     return notifications_dictized
 
 
-def send_emails(notifications_by_email):
+def send_emails(notifications_by_email, run=None):
+    '''Sends the notification emails, within the mail rate limits. If an email
+    can't be sent, it is logged and counted in the metrics, and the rest are
+    still sent. Notifications for subscriptions with a webhook are POSTed to
+    it instead (see send_webhooks).
+
+    :param run: identifies the notification run (see get_run_key), so that
+        each email is recorded in the delivery ledger. Emails already sent in
+        the run (i.e. it is being resumed) are skipped, and ones that fail are
+        retried later (see retry_failed_deliveries).
+    '''
+    notifications_by_email, webhook_notifications = \
+        split_webhook_notifications(notifications_by_email)
+    already_sent = Delivery.get_emails(run) if run else set()
+    if already_sent:
+        log.info('resuming run "{}" - {} emails already sent'
+                 .format(run, len(already_sent)))
+        notifications_by_email = dict(
+            (email, notifications)
+            for email, notifications in notifications_by_email.items()
+            if email not in already_sent)
+    if webhook_notifications:
+        send_webhooks(webhook_notifications, run, already_sent)
+    batch_size = get_transport().batch_size
+    if batch_size > 1:
+        return _send_emails_in_batches(notifications_by_email, batch_size,
+                                       run)
+    concurrency = get_config('mail_concurrency')
+    if concurrency > 1:
+        return _send_emails_concurrently(notifications_by_email, concurrency,
+                                         run)
     for email, notifications in notifications_by_email.items():
         code = email_auth.create_code(email)
-        notification_email.send_notification_email(code, email, notifications)
+        try:
+            waited = notification_email.send_notification_email(
+                code, email, notifications)
+        except MailerException as e:
+            _record_failed_delivery(
+                run, email, e,
+                lambda: notification_email.create_notification_email(
+                    code, email, notifications))
+            continue
+        _record_delivery(run, email, waited)
+
+
+def _send_emails_concurrently(notifications_by_email, concurrency, run):
+    # The emails are created in this thread (which has the request context, for
+    # translations and urls) and just the sending is done by the pool.
+    # Emails are not queued up much faster than they are sent, to keep memory
+    # use down.
+    pending = {}  # {future: (email, message)}
+
+    def collect(done):
+        for future in done:
+            email, message = pending.pop(future)
+            try:
+                waited = future.result()
+            except MailerException as e:
+                _record_failed_delivery(run, email, e, lambda: message)
+                continue
+            _record_delivery(run, email, waited)
+
+    executor = futures.ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        for email, notifications in notifications_by_email.items():
+            if len(pending) >= concurrency * 2:
+                done, _ = futures.wait(
+                    pending, return_when=futures.FIRST_COMPLETED)
+                collect(done)
+            code = email_auth.create_code(email)
+            message = notification_email.create_notification_email(
+                code, email, notifications)
+            future = executor.submit(mailer.send_message, message, email)
+            pending[future] = (email, message)
+        collect(futures.wait(pending)[0])
+    finally:
+        executor.shutdown()
+
+
+def _record_delivery(run, email, waited):
+    metrics['sent_emails'] += 1
+    metrics['rate_limit_wait_seconds'] += float(waited or 0)
+    if run:
+        Delivery.record_sent(run, email)
+        model.Session.commit()
+
+
+def _send_emails_in_batches(notifications_by_email, batch_size, run):
+    # For transports that take many emails in one request (e.g. an HTTP bulk
+    # send API). Only one batch of emails is held in memory at a time.
+    batch = []  # of (message, email)
+
+    def send_batch():
+        results = mailer.send_batch(batch)
+        for (message, email), (waited, error) in zip(batch, results):
+            if error:
+                _record_failed_delivery(run, email, error,
+                                        lambda: message)
+            else:
+                _record_delivery(run, email, waited)
+        del batch[:]
+
+    for email, notifications in notifications_by_email.items():
+        code = email_auth.create_code(email)
+        batch.append((notification_email.create_notification_email(
+            code, email, notifications), email))
+        if len(batch) >= batch_size:
+            send_batch()
+    if batch:
+        send_batch()
+
+
+def _record_failed_delivery(run, email, error, get_message):
+    log.error('Could not send notification email to {}: {}'.format(
+        email, error))
+    metrics['failed_emails'] += 1
+    if run:
+        # keep the email, to retry it
+        Delivery.record_failed(
+            run, email, get_message().as_string(), six.text_type(error),
+            datetime.datetime.now() + get_retry_interval(1))
+        model.Session.commit()
+
+
+def split_webhook_notifications(notifications_by_email):
+    '''Separates the notifications for subscriptions with a webhook, which
+    are POSTed rather than emailed.
+
+    :returns: (notifications_by_email, webhook_notifications) - the
+        notifications to email, and a list of the others
+    '''
+    emailed_by_email = {}
+    webhook_notifications = []
+    for email, notifications in notifications_by_email.items():
+        emailed = []
+        for notification in notifications:
+            if notification['subscription'].get('webhook_url'):
+                webhook_notifications.append(notification)
+            else:
+                emailed.append(notification)
+        if emailed:
+            emailed_by_email[email] = emailed
+    return emailed_by_email, webhook_notifications
+
+
+def send_webhooks(notifications, run=None, already_sent=()):
+    '''POSTs each notification to its subscription's webhook, concurrently.
+    Failures are logged, counted in the metrics and recorded in the delivery
+    ledger to be retried, like emails.
+
+    :param notifications: list of notification dicts
+        ({'subscription': {...}, 'activities': [...]})
+    :param already_sent: delivery keys (see webhook.get_delivery_key) already
+        sent in this run, to skip
+    '''
+    secrets = get_webhook_secrets(
+        [notification['subscription']['id']
+         for notification in notifications])
+    keys = []
+    webhooks = []  # of (url, secret, body)
+    for notification in notifications:
+        subscription = notification['subscription']
+        key = webhook.get_delivery_key(subscription['id'])
+        if key in already_sent:
+            continue
+        keys.append(key)
+        webhooks.append((subscription['webhook_url'],
+                         secrets.get(subscription['id']),
+                         webhook.create_body(notification)))
+    errors = webhook.get_sender().post_many(webhooks)
+    for key, (url, secret, body), error in zip(keys, webhooks, errors):
+        if error:
+            log.error(six.text_type(error))
+            metrics['failed_webhooks'] += 1
+            if run:
+                Delivery.record_failed(
+                    run, key, body, six.text_type(error),
+                    datetime.datetime.now() + get_retry_interval(1))
+        else:
+            metrics['sent_webhooks'] += 1
+            if run:
+                Delivery.record_sent(run, key)
+    if run:
+        model.Session.commit()
+
+
+def get_webhook_secrets(subscription_ids):
+    '''Returns {subscription_id: webhook_secret}'''
+    if not subscription_ids:
+        return {}
+    return dict(
+        model.Session.query(Subscription.id, Subscription.webhook_secret)
+        .filter(Subscription.id.in_(subscription_ids))
+        .all())
+
+
+def get_run_key(frequency, run_datetime, timezone=None):
+    '''Returns the key for a notification run in the delivery ledger e.g.
+    "daily 2020-01-24 09:00:00"
+    '''
+    return ' '.join(filter(None, [
+        Frequency(frequency).name.lower(), timezone,
+        run_datetime.isoformat(' ')]))
+
+
+def get_retry_interval(attempts):
+    '''Returns how long to wait before retrying an email that has failed this
+    many times - the interval doubles each time.
+    '''
+    return get_config('delivery_retry_interval') * 2 ** (attempts - 1)
+
+
+def retry_failed_deliveries(now=None):
+    '''Retries sending the notification emails (and webhooks) that failed,
+    that are due a retry. After ckanext.subscribe.delivery_max_attempts, it
+    gives up.
+    '''
+    now = now or datetime.datetime.now()
+    for delivery in Delivery.get_retries_due(now):
+        subscription_id = webhook.get_subscription_id(delivery.email)
+        kind = 'webhooks' if subscription_id else 'emails'
+        try:
+            if subscription_id:
+                waited = 0
+                subscription = Subscription.get(subscription_id)
+                if not subscription or not subscription.webhook_url:
+                    # unsubscribed, or switched to email, since
+                    model.Session.delete(delivery)
+                    model.Session.commit()
+                    continue
+                webhook.get_sender().post(subscription.webhook_url,
+                                          subscription.webhook_secret,
+                                          delivery.message)
+            else:
+                waited = mailer.resend_message(delivery.message,
+                                               delivery.email)
+        except (MailerException, webhook.WebhookError) as e:
+            delivery.attempts += 1
+            delivery.error = six.text_type(e)
+            if delivery.attempts >= get_config('delivery_max_attempts'):
+                log.error('Giving up sending notification to {} after '
+                          '{} attempts: {}'.format(
+                              delivery.email, delivery.attempts, e))
+                metrics['abandoned_' + kind] += 1
+                model.Session.delete(delivery)
+            else:
+                log.warning('Could not resend notification to {} '
+                            '(attempt {}): {}'.format(
+                                delivery.email, delivery.attempts, e))
+                metrics['failed_' + kind] += 1
+                delivery.next_attempt = \
+                    now + get_retry_interval(delivery.attempts)
+            model.Session.commit()
+            continue
+        metrics['sent_' + kind] += 1
+        metrics['rate_limit_wait_seconds'] += float(waited or 0)
+        model.Session.delete(delivery)
+        model.Session.commit()
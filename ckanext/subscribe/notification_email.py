@@ -4,6 +4,8 @@ from ckan import plugins as p
 from ckan import model
 
 from ckanext.subscribe import mailer
+from ckanext.subscribe import resource_activity
+from ckanext.subscribe import saved_search
 from ckanext.subscribe.email_auth import get_footer_contents
 from ckanext.subscribe.constants import IS_CKAN_29_OR_HIGHER
 
@@ -13,14 +15,32 @@ config = p.toolkit.config
 
 
 def send_notification_email(code, email, notifications):
+    '''Sends the notification email.
+
+    :returns: the time spent waiting for the mail rate limits, in seconds
+    '''
+    subject, plain_text_body, html_body = \
+        get_notification_email_contents(code, email, notifications)
+    return mailer.mail_recipient(recipient_name=email,
+                                 recipient_email=email,
+                                 subject=subject,
+                                 body=plain_text_body,
+                                 body_html=html_body,
+                                 headers={})
+
+
+def create_notification_email(code, email, notifications):
+    '''Returns the notification email as a message, for
+    mailer.send_message().
+    '''
     subject, plain_text_body, html_body = \
         get_notification_email_contents(code, email, notifications)
-    mailer.mail_recipient(recipient_name=email,
-                          recipient_email=email,
-                          subject=subject,
-                          body=plain_text_body,
-                          body_html=html_body,
-                          headers={})
+    return mailer.create_message(recipient_name=email,
+                                 recipient_email=email,
+                                 subject=subject,
+                                 body=plain_text_body,
+                                 body_html=html_body,
+                                 headers={})
 
 
 def get_notification_email_contents(code, email, notifications):
@@ -45,11 +65,18 @@ def get_notification_email_contents(code, email, notifications):
     <p>
       - {{ activity.timestamp.strftime('%Y-%m-%d %H:%M') }} -
       {{ activity.activity_type }}
+      {% if activity.activity_count > 1 %}({{ activity.activity_count }} times){% endif %}
       {% if notification.object_type != 'dataset' %}
         - {{ activity.dataset_link }}
       {% endif %}
     </p>
   {% endfor %}
+  {% if notification.more_count %}
+    <p>
+      - and <a href="{{ notification.more_link }}">{{ notification.more_count }}
+        more change{% if notification.more_count > 1 %}s{% endif %}</a>
+    </p>
+  {% endif %}
 {% endfor %}
 
 --
@@ -63,9 +90,15 @@ Changes have occurred in relation to your subscription(s)
 
   {% for activity in notification.activities %}
       - {{ activity.timestamp.strftime('%Y-%m-%d %H:%M') }} - {{ activity.activity_type }} {% if (
+          activity.activity_count > 1) %}({{ activity.activity_count }} times) {% endif %}{% if (
           notification.object_type != 'dataset') %} - {{ activity.dataset_href }} {% endif %}
 
   {% endfor %}
+  {% if notification.more_count %}
+      - and {{ notification.more_count }} more change{% if (
+          notification.more_count > 1) %}s{% endif %} - {{ notification.more_link }}
+
+  {% endif %}
 {% endfor %}
 
 --
@@ -75,6 +108,10 @@ Changes have occurred in relation to your subscription(s)
 
 
 def get_notification_email_vars(email, notifications):
+    # the number of activity lines is capped, so that the size of the email is
+    # bounded, however much activity there is
+    lines_left = p.toolkit.asint(
+        config.get('ckanext.subscribe.max_lines_per_email', 100)) or None
     notifications_vars = []
     for notification in notifications:
         subscription = notification['subscription']
@@ -84,44 +121,69 @@ def get_notification_email_vars(email, notifications):
             activities_vars.append(dict(
                 activity_type=activity['activity_type'].replace('package', 'dataset'),
                 timestamp=p.toolkit.h.date_str_to_datetime(activity['timestamp']),
+                # activity summaries stand for several activities
+                activity_count=activity.get('activity_count', 1),
                 dataset_link=dataset_link_from_activity(activity),
                 dataset_href=dataset_href_from_activity(activity),
             ))
+        activities_vars = coalesce_activities(activities_vars)
+        more_activities_vars = []
+        if lines_left is not None:
+            more_activities_vars = activities_vars[lines_left:]
+            activities_vars = activities_vars[:lines_left]
+            lines_left -= len(activities_vars)
+        more_count = sum(activity['activity_count']
+                         for activity in more_activities_vars)
         # get the package/group's name & title
         object_type_ = \
             subscription['object_type'].replace('dataset', 'package')
-        try:
-            # activity['data'] should have the package/group table
-            obj = notification['activities'][0]['data'][object_type_]
-            object_name = obj['name']
-            object_title = obj['title']
-        except KeyError:
-            # activity['data'] has gone missing - resort to the db
-            if subscription['object_type'] == 'dataset':
-                obj = model.Package.get(subscription['object_id'])
-            else:
-                obj = model.Group.get(subscription['object_id'])
-            object_name = obj.name
-            object_title = obj.title
-        if IS_CKAN_29_OR_HIGHER:
-            object_type_ = subscription['object_type'].replace('package', 'dataset')
-            object_link = p.toolkit.url_for(
-                '{}.read'.format(object_type_),
-                id=subscription['object_id'],
-                qualified=True)
+        if subscription['object_type'] == 'query':
+            # a saved search is named by its query
+            object_name = subscription['object_id']
+            object_title = saved_search.get_query_title(object_name)
+            object_link = saved_search.get_search_url(
+                subscription['object_id'])
+        elif subscription['object_type'] == 'resource':
+            resource = model.Resource.get(subscription['object_id'])
+            object_name = subscription['object_id']
+            object_title = resource_activity.get_resource_title(resource)
+            object_link = resource_activity.get_resource_link(resource)
         else:
-            _obj_type = subscription['object_type'].replace('dataset', 'package')
-            object_link = p.toolkit.url_for(
-                controller=_obj_type,
-                action='read',
-                id=subscription['object_id'],  # prefer id because it is invariant
-                qualified=True)
+            try:
+                # activity['data'] should have the package/group table
+                obj = notification['activities'][0]['data'][object_type_]
+                object_name = obj['name']
+                object_title = obj['title']
+            except KeyError:
+                # activity['data'] has gone missing - resort to the db
+                if subscription['object_type'] == 'dataset':
+                    obj = model.Package.get(subscription['object_id'])
+                else:
+                    obj = model.Group.get(subscription['object_id'])
+                object_name = obj.name
+                object_title = obj.title
+            if IS_CKAN_29_OR_HIGHER:
+                object_type_ = subscription['object_type'].replace('package', 'dataset')
+                object_link = p.toolkit.url_for(
+                    '{}.read'.format(object_type_),
+                    id=subscription['object_id'],
+                    qualified=True)
+            else:
+                _obj_type = subscription['object_type'].replace('dataset', 'package')
+                object_link = p.toolkit.url_for(
+                    controller=_obj_type,
+                    action='read',
+                    id=subscription['object_id'],  # prefer id because it is invariant
+                    qualified=True)
         notifications_vars.append(dict(
             activities=activities_vars,
             object_type=subscription['object_type'],
             object_title=object_title or object_name,
             object_name=object_name,
             object_link=object_link,
+            more_count=more_count,
+            more_link=activity_stream_link(subscription) if more_count
+            else '',
         ))
 
     extra_vars = dict(
@@ -133,6 +195,46 @@ def get_notification_email_vars(email, notifications):
     return extra_vars
 
 
+def coalesce_activities(activities_vars):
+    '''Combines the activities of the same type on the same dataset into one
+    line, with a count, e.g. "changed dataset (12 times)".
+    '''
+    coalesced = []
+    lines = {}  # {(activity_type, dataset_href): activity_vars}
+    for activity in activities_vars:
+        key = (activity['activity_type'], activity['dataset_href'])
+        line = lines.get(key)
+        if line is None:
+            line = lines[key] = dict(activity)
+            coalesced.append(line)
+            continue
+        line['activity_count'] += activity['activity_count']
+        line['timestamp'] = max(line['timestamp'], activity['timestamp'])
+    return coalesced
+
+
+def activity_stream_link(subscription):
+    '''Returns the link to the activity stream of the subscribed object'''
+    if subscription['object_type'] == 'query':
+        # there is no activity stream of a search, so link to the search
+        return saved_search.get_search_url(subscription['object_id'])
+    if subscription['object_type'] == 'resource':
+        return resource_activity.get_resource_link(
+            model.Resource.get(subscription['object_id']))
+    if IS_CKAN_29_OR_HIGHER:
+        object_type_ = subscription['object_type'].replace('package', 'dataset')
+        return p.toolkit.url_for(
+            '{}.activity'.format(object_type_),
+            id=subscription['object_id'],
+            qualified=True)
+    _obj_type = subscription['object_type'].replace('dataset', 'package')
+    return p.toolkit.url_for(
+        controller=_obj_type,
+        action='activity',
+        id=subscription['object_id'],
+        qualified=True)
+
+
 def dataset_link_from_activity(activity):
     href = dataset_href_from_activity(activity)
     if not href:
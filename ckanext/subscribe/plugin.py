@@ -4,6 +4,7 @@ from ckan.plugins import toolkit
 
 from ckanext.subscribe import action, cli
 from ckanext.subscribe import auth
+from ckanext.subscribe import worker
 from ckanext.subscribe import model as subscribe_model
 from ckanext.subscribe.controller import SubscribeController
 from ckanext.subscribe.constants import IS_CKAN_29_OR_HIGHER
@@ -20,6 +21,9 @@ class SubscribePlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.IActions)
     plugins.implements(plugins.IAuthFunctions)
     plugins.implements(plugins.ITemplateHelpers)
+    plugins.implements(plugins.IPackageController, inherit=True)
+    plugins.implements(plugins.IGroupController, inherit=True)
+    plugins.implements(plugins.IOrganizationController, inherit=True)
 
     if IS_CKAN_29_OR_HIGHER:
         plugins.implements(plugins.IBlueprint)
@@ -42,6 +46,8 @@ class SubscribePlugin(plugins.SingletonPlugin):
                                    view_func=SubscribeController.unsubscribe_all)
             subscribe.add_url_rule('/request_manage_code', methods=['GET', 'POST'],
                                    view_func=SubscribeController.request_manage_code)
+            subscribe.add_url_rule('/feed', methods=['GET'],
+                                   view_func=SubscribeController.feed)
 
             return [subscribe]
 
@@ -62,6 +68,7 @@ class SubscribePlugin(plugins.SingletonPlugin):
         toolkit.add_resource('fanstatic', 'subscribe')
 
         subscribe_model.setup()
+        worker.listen_for_commits()
 
     # IRoutes
     def before_map(self, l_map):
@@ -80,6 +87,8 @@ class SubscribePlugin(plugins.SingletonPlugin):
                       controller=controller, action='unsubscribe_all')
         l_map.connect('request_manage_code', '/subscribe/request_manage_code',
                       controller=controller, action='request_manage_code')
+        l_map.connect('subscribe_feed', '/subscribe/feed',
+                      controller=controller, action='feed')
         return l_map
 
     def after_map(self, l_map):
@@ -89,12 +98,14 @@ class SubscribePlugin(plugins.SingletonPlugin):
     def get_actions(self):
         return {
             'subscribe_signup': action.subscribe_signup,
+            'subscribe_signup_bulk': action.subscribe_signup_bulk,
             'subscribe_verify': action.subscribe_verify,
             'subscribe_update': action.subscribe_update,
             'subscribe_list_subscriptions':
             action.subscribe_list_subscriptions,
             'subscribe_unsubscribe': action.subscribe_unsubscribe,
             'subscribe_unsubscribe_all': action.subscribe_unsubscribe_all,
+            'subscribe_unsubscribe_bulk': action.subscribe_unsubscribe_bulk,
             'subscribe_request_manage_code':
             action.subscribe_request_manage_code,
             'subscribe_send_any_notifications':
@@ -105,18 +116,43 @@ class SubscribePlugin(plugins.SingletonPlugin):
     def get_auth_functions(self):
         return {
             'subscribe_signup': auth.subscribe_signup,
+            'subscribe_signup_bulk': auth.subscribe_signup_bulk,
             'subscribe_verify': auth.subscribe_verify,
             'subscribe_update': auth.subscribe_update,
             'subscribe_list_subscriptions':
             auth.subscribe_list_subscriptions,
             'subscribe_unsubscribe': auth.subscribe_unsubscribe,
             'subscribe_unsubscribe_all': auth.subscribe_unsubscribe_all,
+            'subscribe_unsubscribe_bulk': auth.subscribe_unsubscribe_bulk,
             'subscribe_request_manage_code':
             auth.subscribe_request_manage_code,
             'subscribe_send_any_notifications':
             auth.subscribe_send_any_notifications,
         }
 
+    # IPackageController
+    # (wake the worker, so immediate notifications about the activity go
+    # promptly - once the change is committed, and once however many of these
+    # are called for it)
+    def after_create(self, context, pkg_dict):
+        worker.wake_worker_after_commit()
+
+    def after_update(self, context, pkg_dict):
+        worker.wake_worker_after_commit()
+
+    def after_delete(self, context, pkg_dict):
+        worker.wake_worker_after_commit()
+
+    # IGroupController, IOrganizationController (and IPackageController)
+    def create(self, entity):
+        worker.wake_worker_after_commit()
+
+    def edit(self, entity):
+        worker.wake_worker_after_commit()
+
+    def delete(self, entity):
+        worker.wake_worker_after_commit()
+
 
 def version_builder(text_version):
     return Version(text_version)
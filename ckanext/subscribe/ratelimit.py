@@ -0,0 +1,165 @@
+# encoding: utf-8
+
+'''
+Rate limiting of outgoing email, so that sending a large batch of
+notifications doesn't burst past what the mail relay and the big providers
+(gmail.com, outlook.com etc) will accept, and get deferred.
+
+Each email takes a token from a global token bucket and from its recipient
+domain's bucket, waiting for them to refill if need be. A bucket refills at a
+steady rate, up to its capacity (the burst), so sending settles at the
+configured rate rather than bursting and then being throttled. The number of
+emails being sent at once to a domain can also be capped.
+'''
+
+import time
+import threading
+
+import ckan.plugins as p
+
+config = p.toolkit.config
+
+_rate_limiter = None
+
+
+class TokenBucket(object):
+    '''Hands out tokens at `rate` per second, storing up to `capacity` of them
+    when they are not being used.
+
+    :param rate: tokens per second
+    :param capacity: the most tokens that can be taken at once without waiting
+    '''
+    def __init__(self, rate, capacity=1, clock=time.time):
+        self.rate = float(rate)
+        self.capacity = float(max(capacity, 1))
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        '''Takes a token, and returns how long to wait (in seconds) until it is
+        usable. Tokens are handed out in order, so waiting callers don't
+        overtake each other.
+        '''
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(
+                self.capacity,
+                self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+
+class RateLimiter(object):
+    '''Rate limits, and limits the concurrency of, sending email - overall and
+    per recipient domain.
+
+    :param rate: emails per second overall (0 means unlimited)
+    :param burst: the number of emails that can go in a burst
+    :param domain_rates: {domain: emails per second}. The domain '*' is the
+        rate for any domain not listed.
+    :param domain_concurrency: the most emails being sent to a domain at once
+        (0 means unlimited)
+    '''
+    def __init__(self, rate=0, burst=1, domain_rates=None,
+                 domain_concurrency=0, sleep=time.sleep):
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.burst = burst
+        self.domain_rates = domain_rates or {}
+        self.domain_concurrency = domain_concurrency
+        self.sleep = sleep
+        self.domain_buckets = {}
+        self.domain_semaphores = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, recipient_email):
+        '''Waits until an email to this recipient can be sent. Call release()
+        once it has been sent.
+
+        :returns: how long was spent waiting, in seconds
+        '''
+        domain = get_domain(recipient_email)
+        waited = 0.0
+        semaphore = self._get_domain_semaphore(domain)
+        if semaphore:
+            started = time.time()
+            semaphore.acquire()
+            waited += time.time() - started
+        return waited + self.wait_for_tokens(recipient_email)
+
+    def wait_for_tokens(self, recipient_email):
+        '''Waits until the rate limits allow an email to this recipient, but
+        without the concurrency limit (e.g. for an email sent in a batch).
+
+        :returns: how long was spent waiting, in seconds
+        '''
+        domain = get_domain(recipient_email)
+        wait = max([bucket.reserve()
+                    for bucket in (self.bucket,
+                                   self._get_domain_bucket(domain))
+                    if bucket] or [0])
+        if wait:
+            self.sleep(wait)
+        return wait
+
+    def release(self, recipient_email):
+        semaphore = self._get_domain_semaphore(get_domain(recipient_email))
+        if semaphore:
+            semaphore.release()
+
+    def _get_domain_bucket(self, domain):
+        rate = self.domain_rates.get(domain, self.domain_rates.get('*'))
+        if not rate:
+            return None
+        with self.lock:
+            if domain not in self.domain_buckets:
+                self.domain_buckets[domain] = TokenBucket(rate, self.burst)
+            return self.domain_buckets[domain]
+
+    def _get_domain_semaphore(self, domain):
+        if not self.domain_concurrency:
+            return None
+        with self.lock:
+            if domain not in self.domain_semaphores:
+                self.domain_semaphores[domain] = \
+                    threading.BoundedSemaphore(self.domain_concurrency)
+            return self.domain_semaphores[domain]
+
+
+def get_domain(email):
+    return email.rsplit('@', 1)[-1].strip().lower()
+
+
+def parse_domain_rates(value):
+    '''Parses config like "gmail.com:5 outlook.com:2.5 *:10" into
+    {domain: rate}.
+    '''
+    domain_rates = {}
+    for item in p.toolkit.aslist(value.replace(',', ' ')):
+        try:
+            domain, rate = item.rsplit(':', 1)
+            domain_rates[domain.lower()] = float(rate)
+        except ValueError:
+            raise ValueError(
+                'Bad domain rate "{}" - it should be like "gmail.com:5"'
+                .format(item))
+    return domain_rates
+
+
+def get_rate_limiter():
+    '''Returns the rate limiter for this process, set up from the config.'''
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = RateLimiter(
+            rate=float(config.get('ckanext.subscribe.mail_rate_limit', 0)),
+            burst=int(config.get('ckanext.subscribe.mail_burst', 1)),
+            domain_rates=parse_domain_rates(
+                config.get('ckanext.subscribe.mail_domain_rate_limits', '')),
+            domain_concurrency=int(config.get(
+                'ckanext.subscribe.mail_domain_concurrency', 0)),
+        )
+    return _rate_limiter
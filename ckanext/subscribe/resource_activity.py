@@ -0,0 +1,200 @@
+# encoding: utf-8
+
+'''
+Resource subscriptions - notifications about one resource, rather than the
+whole of its dataset. The subscription's object_type is 'resource' and its
+object_id is the resource id.
+
+CKAN records changes to a resource as activity on its dataset ("changed
+package"), with the dataset as it was after the change in the activity's data.
+So a resource subscription is treated as a subscription to the resource's
+dataset (found by joining the resource table, as organizations are expanded to
+their datasets), and then each of the dataset's activities is only paired
+with it if the activity changed that resource. Which resources an activity
+changed is worked out by comparing its resources with those of the dataset's
+previous activity (whether or not that was included in the notifications) -
+once for each activity in a run (ChangedResources caches it), however many
+subscribers there are, and with two queries for the previous activities of
+all the datasets.
+'''
+
+from collections import defaultdict
+
+import ckan.plugins as p
+from ckan import model
+from ckan.model import Activity
+from sqlalchemy import func, and_, or_
+
+from ckanext.subscribe.constants import IS_CKAN_29_OR_HIGHER
+from ckanext.subscribe.saved_search import DATASET_ACTIVITY_TYPES
+
+# Resource fields that change without the resource itself changing
+IGNORED_RESOURCE_FIELDS = ('position',)
+
+
+class ChangedResources(object):
+    '''Which resources each activity changed, worked out once per activity
+    and cached - use one of these for a run.
+    '''
+    def __init__(self):
+        # {activity_id: frozenset of resource ids, or None if not known}
+        self.changed = {}
+
+    def get(self, activity):
+        '''Returns the ids of the resources that the activity created,
+        changed or deleted, or None if that isn't known (the activity has no
+        dataset in its data).
+        '''
+        if activity.id not in self.changed:
+            self.extract([activity])
+        return self.changed[activity.id]
+
+    def extract(self, activities):
+        '''Works out the changed resources of the activities that aren't
+        cached already.
+        '''
+        activities_by_package = defaultdict(list)
+        for activity in activities:
+            if activity.id not in self.changed:
+                activities_by_package[activity.object_id].append(activity)
+        if not activities_by_package:
+            return
+        for package_activities in activities_by_package.values():
+            package_activities.sort(key=lambda activity: activity.timestamp)
+        previous_activities = get_previous_activities(dict(
+            (package_id, package_activities[0].timestamp)
+            for package_id, package_activities
+            in activities_by_package.items()))
+        # The activities given are usually filtered (by user or activity
+        # type), so each one is compared with its dataset's actual previous
+        # activity, which may not be among them
+        all_activities = get_activities_between(dict(
+            (package_id, (package_activities[0].timestamp,
+                          package_activities[-1].timestamp))
+            for package_id, package_activities
+            in activities_by_package.items()))
+        for package_id, package_activities in activities_by_package.items():
+            activity_ids = set(activity.id for activity in package_activities)
+            timeline = dict(
+                (activity.id, activity) for activity
+                in all_activities.get(package_id, []) + package_activities)
+            previous_resources = get_resources(
+                previous_activities.get(package_id))
+            for activity in sorted(timeline.values(),
+                                   key=lambda activity: activity.timestamp):
+                resources = get_resources(activity)
+                if activity.id in activity_ids:
+                    if resources is None:
+                        changed = None
+                    elif activity.activity_type == 'deleted package':
+                        changed = frozenset(resources)
+                    else:
+                        changed = get_changed_resource_ids(
+                            previous_resources or {}, resources)
+                    self.changed[activity.id] = changed
+                if resources is not None:
+                    previous_resources = resources
+
+    def extract_for_subscriptions(self, activities, objects_subscribed_to):
+        '''Works out the changed resources of the activities on datasets with
+        resource subscriptions, in one go.
+
+        :param objects_subscribed_to: {object_id: [subscriptions]}
+        '''
+        package_ids = set(
+            object_id
+            for object_id, subscriptions in objects_subscribed_to.items()
+            if any(subscription.object_type == 'resource'
+                   for subscription in subscriptions))
+        if package_ids:
+            self.extract([activity for activity in activities
+                          if activity.object_id in package_ids])
+
+
+def get_resources(activity):
+    '''Returns the resources in the activity's dataset, {id: resource_dict},
+    or None if it has no dataset in its data.
+    '''
+    if activity is None:
+        return None
+    package = (activity.data or {}).get('package')
+    if not package:
+        return None
+    return dict((resource['id'], resource)
+                for resource in package.get('resources') or [])
+
+
+def get_changed_resource_ids(old_resources, new_resources):
+    '''Returns the ids of the resources that were added, removed or changed.
+
+    :param old_resources: {id: resource_dict}
+    :param new_resources: {id: resource_dict}
+    '''
+    def significant(resource):
+        return dict((key, value) for key, value in resource.items()
+                    if key not in IGNORED_RESOURCE_FIELDS)
+    return frozenset(
+        resource_id
+        for resource_id in set(old_resources) | set(new_resources)
+        if resource_id not in old_resources or
+        resource_id not in new_resources or
+        significant(old_resources[resource_id]) !=
+        significant(new_resources[resource_id]))
+
+
+def get_previous_activities(before):
+    '''Returns each dataset's latest activity before the given time.
+
+    :param before: {package_id: datetime}
+    :returns: {package_id: activity}
+    '''
+    latest = model.Session.query(
+        Activity.object_id.label('object_id'),
+        func.max(Activity.timestamp).label('timestamp')) \
+        .filter(Activity.activity_type.in_(DATASET_ACTIVITY_TYPES)) \
+        .filter(or_(*[
+            and_(Activity.object_id == package_id,
+                 Activity.timestamp < timestamp)
+            for package_id, timestamp in before.items()])) \
+        .group_by(Activity.object_id) \
+        .subquery()
+    return dict(
+        (activity.object_id, activity)
+        for activity in model.Session.query(Activity)
+        .join(latest, and_(Activity.object_id == latest.c.object_id,
+                           Activity.timestamp == latest.c.timestamp))
+        .filter(Activity.activity_type.in_(DATASET_ACTIVITY_TYPES)))
+
+
+def get_activities_between(periods):
+    '''Returns all of each dataset's activities in the given period (by any
+    user), in one query.
+
+    :param periods: {package_id: (first datetime, last datetime)}, inclusive
+    :returns: {package_id: [activity]}
+    '''
+    activities = defaultdict(list)
+    query = model.Session.query(Activity) \
+        .filter(Activity.activity_type.in_(DATASET_ACTIVITY_TYPES)) \
+        .filter(or_(*[
+            and_(Activity.object_id == package_id,
+                 Activity.timestamp >= first,
+                 Activity.timestamp <= last)
+            for package_id, (first, last) in periods.items()]))
+    for activity in query:
+        activities[activity.object_id].append(activity)
+    return activities
+
+
+def get_resource_title(resource):
+    return resource.name or resource.url or resource.id
+
+
+def get_resource_link(resource):
+    '''Returns the URL of the resource's page'''
+    if IS_CKAN_29_OR_HIGHER:
+        return p.toolkit.url_for('resource.read', id=resource.package_id,
+                                 resource_id=resource.id, qualified=True)
+    return p.toolkit.url_for(controller='package', action='resource_read',
+                             id=resource.package_id, resource_id=resource.id,
+                             qualified=True)
@@ -0,0 +1,357 @@
+# encoding: utf-8
+
+'''
+Saved-search subscriptions - "any dataset tagged covid", "any dataset with CSV
+resources in organization X". The subscription's object_type is 'query' and
+its object_id is the query, which is a space-separated list of field:value
+terms, all of which a dataset must match, e.g.:
+
+    tags:covid res_format:CSV organization:org-x
+
+The fields are tags, organization, groups and res_format. Values with spaces
+can be quoted e.g. tags:"covid 19". In the stored query, organizations and
+groups are identified by id, so that renaming them doesn't break the
+subscription - they are shown by their current names (get_query_title).
+
+Rather than running each saved search, the subscriptions' terms are stored in
+an inverted index (the subscribe_query_term table: term -> subscription). To
+find the saved searches that match the datasets that have changed, the
+datasets' current terms (their tags, organization, groups and resource
+formats) are probed against the index, in one query - a subscription matches
+a dataset when all of its terms are found. So the cost depends on the number
+of datasets that changed, not on the number of saved searches.
+
+Only public datasets are matched.
+'''
+
+import shlex
+from collections import defaultdict
+
+import six
+from sqlalchemy import func, literal, distinct, union_all
+
+import ckan.plugins as p
+from ckan import model
+
+from ckanext.subscribe.constants import IS_CKAN_29_OR_HIGHER
+from ckanext.subscribe.model import QueryTerm, Subscription
+
+QUERY_FIELDS = ('tags', 'organization', 'groups', 'res_format')
+
+# Activity types of the datasets that are matched against saved searches
+DATASET_ACTIVITY_TYPES = ('new package', 'changed package', 'deleted package')
+
+
+def parse_query(query):
+    '''Parses a saved search query into its terms.
+
+    :returns: sorted list of (field, value), without duplicates
+    :raises ValueError: if the query is not valid
+    '''
+    if not isinstance(query, six.string_types) or not query.strip():
+        raise ValueError('The query is empty')
+    try:
+        # shlex doesn't support unicode on python 2
+        words = [six.ensure_text(word)
+                 for word in shlex.split(six.ensure_str(query))]
+    except ValueError as e:
+        raise ValueError('The query could not be parsed: {}'.format(e))
+    terms = set()
+    for word in words:
+        field, _, value = word.partition(':')
+        field = field.strip()
+        value = value.strip()
+        if field not in QUERY_FIELDS or not value:
+            raise ValueError(
+                'Query terms must be like "field:value", where the field is '
+                'one of: {}'.format(', '.join(QUERY_FIELDS)))
+        terms.add((field, value))
+    return sorted(terms)
+
+
+def format_query(terms):
+    '''Returns the query string for the terms - the canonical form that is
+    stored as the subscription's object_id.
+    '''
+    return ' '.join(
+        '{}:"{}"'.format(field, value) if ' ' in value
+        else '{}:{}'.format(field, value)
+        for field, value in terms)
+
+
+def get_group_ids(terms, check_exists=True):
+    '''Returns the terms with the organizations and groups (given by name or
+    id) identified by id.
+
+    :param check_exists: if True, raises ValueError if an organization or
+        group doesn't exist (or is deleted). If False, the value of a term
+        that can't be looked up is left as it is - e.g. to unsubscribe from a
+        saved search naming an organization that has since gone.
+    '''
+    group_terms = []
+    for field, value in terms:
+        if field in ('organization', 'groups'):
+            group = model.Group.get(value)
+            is_organization = field == 'organization'
+            if group and bool(group.is_organization) == is_organization and \
+                    (group.state == 'active' or not check_exists):
+                value = group.id
+            elif check_exists:
+                raise ValueError('{} not found: {}'.format(
+                    'Organization' if is_organization else 'Group', value))
+        group_terms.append((field, value))
+    return sorted(set(group_terms))
+
+
+def get_query_title(query):
+    '''Returns the saved search query for display, with the organizations and
+    groups given by their current names.
+    '''
+    terms = []
+    for field, value in parse_query(query):
+        if field in ('organization', 'groups'):
+            group = model.Group.get(value)
+            if group:
+                value = group.name
+        terms.append((field, value))
+    return format_query(sorted(terms))
+
+
+def get_index_terms(terms):
+    '''Returns the terms as they are stored in the index (and in the
+    datasets' terms) e.g. "tags:covid". Organizations and groups are
+    identified by id.
+
+    :raises ValueError: if an organization or group doesn't exist
+    '''
+    index_terms = []
+    for field, value in get_group_ids(terms):
+        if field == 'res_format':
+            # matched case-insensitively
+            value = value.lower()
+        index_terms.append(u'{}:{}'.format(field, value))
+    return index_terms
+
+
+def index_subscription(subscription):
+    '''Stores the saved search subscription's terms in the index (replacing
+    any already there).
+    '''
+    unindex_subscriptions([subscription.id])
+    for term in get_index_terms(parse_query(subscription.object_id)):
+        model.Session.add(QueryTerm(subscription_id=subscription.id,
+                                    term=term))
+    # caller needs to do:
+    #   model.Session.commit()
+
+
+def unindex_subscriptions(subscription_ids):
+    '''Removes subscriptions' terms from the index'''
+    if not subscription_ids:
+        return
+    model.Session.query(QueryTerm) \
+        .filter(QueryTerm.subscription_id.in_(subscription_ids)) \
+        .delete(synchronize_session=False)
+    # caller needs to do:
+    #   model.Session.commit()
+
+
+def get_dataset_terms(package_ids):
+    '''Returns a selectable of the datasets' terms, with columns
+    (package_id, term). Private datasets are left out.
+    '''
+    public_ids = [
+        package_id for (package_id,) in model.Session.query(model.Package.id)
+        .filter(model.Package.id.in_(package_ids))
+        .filter(model.Package.private.isnot(True))]
+    Package, PackageTag, Tag, Member, Resource = (
+        model.Package, model.PackageTag, model.Tag, model.Member,
+        model.Resource)
+    return union_all(
+        model.Session.query(
+            PackageTag.package_id.label('package_id'),
+            (literal(u'tags:') + Tag.name).label('term'))
+        .join(Tag, Tag.id == PackageTag.tag_id)
+        .filter(PackageTag.state == 'active')
+        .filter(PackageTag.package_id.in_(public_ids))
+        .statement,
+        model.Session.query(
+            Package.id,
+            literal(u'organization:') + Package.owner_org)
+        .filter(Package.id.in_(public_ids))
+        .statement,
+        model.Session.query(
+            Member.table_id,
+            literal(u'groups:') + Member.group_id)
+        .filter(Member.table_name == 'package')
+        .filter(Member.state == 'active')
+        .filter(Member.table_id.in_(public_ids))
+        .statement,
+        model.Session.query(
+            Resource.package_id,
+            literal(u'res_format:') + func.lower(Resource.format))
+        .filter(Resource.state == 'active')
+        .filter(Resource.package_id.in_(public_ids))
+        .statement,
+    ).alias('dataset_terms')
+
+
+def match_datasets(package_ids, subscription_filter=None):
+    '''Finds the saved search subscriptions that match the datasets, by
+    probing the index with the datasets' terms.
+
+    :param package_ids: ids of the datasets (e.g. the ones that changed)
+    :param subscription_filter: SQL filter on the Subscriptions e.g. of their
+        frequency
+
+    :returns: list of (subscription, package_id)
+    '''
+    if not package_ids:
+        return []
+    dataset_terms = get_dataset_terms(package_ids)
+    # the number of terms that each saved search has to match
+    num_terms = model.Session.query(
+        QueryTerm.subscription_id.label('subscription_id'),
+        func.count(QueryTerm.id).label('num_terms')) \
+        .group_by(QueryTerm.subscription_id) \
+        .subquery()
+    matches = model.Session.query(QueryTerm.subscription_id,
+                                  dataset_terms.c.package_id) \
+        .join(dataset_terms, dataset_terms.c.term == QueryTerm.term) \
+        .join(num_terms,
+              num_terms.c.subscription_id == QueryTerm.subscription_id) \
+        .group_by(QueryTerm.subscription_id, dataset_terms.c.package_id,
+                  num_terms.c.num_terms) \
+        .having(func.count(distinct(QueryTerm.term)) ==
+                num_terms.c.num_terms) \
+        .all()
+    if not matches:
+        return []
+    query = model.Session.query(Subscription) \
+        .filter(Subscription.id.in_(
+            set(subscription_id for subscription_id, _ in matches)))
+    if subscription_filter is not None:
+        query = query.filter(subscription_filter)
+    subscriptions = dict((subscription.id, subscription)
+                         for subscription in query)
+    return [(subscriptions[subscription_id], package_id)
+            for subscription_id, package_id in matches
+            if subscription_id in subscriptions]
+
+
+def match_subscriptions(subscription_filter):
+    '''Finds all the datasets that match the saved search subscriptions (not
+    only the ones that changed) - e.g. for a subscriber's feed. The datasets
+    with each of the subscriptions' terms are looked up, and intersected.
+
+    :param subscription_filter: SQL filter on the Subscriptions e.g. of their
+        email
+
+    :returns: list of (subscription, package_id)
+    '''
+    subscriptions = model.Session.query(Subscription) \
+        .filter(subscription_filter) \
+        .filter(Subscription.object_type == 'query') \
+        .all()
+    if not subscriptions:
+        return []
+    terms = defaultdict(set)  # {subscription_id: set of terms}
+    for subscription_id, term in model.Session.query(
+            QueryTerm.subscription_id, QueryTerm.term) \
+            .filter(QueryTerm.subscription_id.in_(
+                [subscription.id for subscription in subscriptions])):
+        terms[subscription_id].add(term)
+    package_ids_by_term = get_term_dataset_ids(
+        set(term for terms_ in terms.values() for term in terms_))
+    matches = []
+    for subscription in subscriptions:
+        if not terms[subscription.id]:
+            continue
+        package_ids = set.intersection(*[
+            package_ids_by_term[term] for term in terms[subscription.id]])
+        matches.extend((subscription, package_id)
+                       for package_id in sorted(package_ids))
+    return matches
+
+
+def get_term_dataset_ids(terms):
+    '''Returns the public datasets that have each of the index terms.
+
+    :param terms: index terms e.g. "tags:covid"
+    :returns: {term: set of package_ids}
+    '''
+    values = defaultdict(list)  # {field: [value]}
+    for term in terms:
+        field, _, value = term.partition(':')
+        values[field].append(value)
+    Package, PackageTag, Tag, Member, Resource = (
+        model.Package, model.PackageTag, model.Tag, model.Member,
+        model.Resource)
+    selects = []
+    if values['tags']:
+        selects.append(
+            model.Session.query(
+                PackageTag.package_id.label('package_id'),
+                (literal(u'tags:') + Tag.name).label('term'))
+            .join(Tag, Tag.id == PackageTag.tag_id)
+            .filter(PackageTag.state == 'active')
+            .filter(Tag.name.in_(values['tags']))
+            .statement)
+    if values['organization']:
+        selects.append(
+            model.Session.query(
+                Package.id.label('package_id'),
+                (literal(u'organization:') + Package.owner_org).label('term'))
+            .filter(Package.owner_org.in_(values['organization']))
+            .statement)
+    if values['groups']:
+        selects.append(
+            model.Session.query(
+                Member.table_id.label('package_id'),
+                (literal(u'groups:') + Member.group_id).label('term'))
+            .filter(Member.table_name == 'package')
+            .filter(Member.state == 'active')
+            .filter(Member.group_id.in_(values['groups']))
+            .statement)
+    if values['res_format']:
+        selects.append(
+            model.Session.query(
+                Resource.package_id.label('package_id'),
+                (literal(u'res_format:') + func.lower(Resource.format))
+                .label('term'))
+            .filter(Resource.state == 'active')
+            .filter(func.lower(Resource.format).in_(values['res_format']))
+            .statement)
+    package_ids_by_term = dict((term, set()) for term in terms)
+    if not selects:
+        return package_ids_by_term
+    dataset_terms = (union_all(*selects) if len(selects) > 1
+                     else selects[0]).alias('dataset_terms')
+    for package_id, term in model.Session.query(
+            dataset_terms.c.package_id, dataset_terms.c.term) \
+            .join(model.Package, model.Package.id == dataset_terms.c.package_id) \
+            .filter(model.Package.private.isnot(True)) \
+            .distinct():
+        if term in package_ids_by_term:
+            package_ids_by_term[term].add(package_id)
+    return package_ids_by_term
+
+
+def get_changed_dataset_ids(since):
+    '''Returns the ids of the datasets with activity since the given time.'''
+    return [
+        object_id for (object_id,) in model.Session.query(
+            distinct(model.Activity.object_id))
+        .filter(model.Activity.timestamp > since)
+        .filter(model.Activity.activity_type.in_(DATASET_ACTIVITY_TYPES))]
+
+
+def get_search_url(query):
+    '''Returns the URL of the dataset search for the saved search query'''
+    params = {}
+    for field, value in parse_query(get_query_title(query)):
+        params.setdefault(field, []).append(value)
+    if IS_CKAN_29_OR_HIGHER:
+        return p.toolkit.url_for('dataset.search', qualified=True, **params)
+    return p.toolkit.url_for(controller='package', action='search',
+                             qualified=True, **params)
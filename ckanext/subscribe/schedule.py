@@ -0,0 +1,186 @@
+# encoding: utf-8
+
+'''
+Schedules for sending notifications, given as cron-like specs.
+
+A spec has five fields: minute, hour, day of month, month and day of week
+(0-7, where 0 and 7 are Sunday), e.g. "0 9 * * 5" is 9am on Fridays. Each field
+is "*", or a comma-separated list of numbers, ranges ("1-5") and steps ("*/15",
+"0-30/10"). As in cron, if both the day of month and the day of week are
+restricted, a day matching either of them will do.
+
+The scheduled times are found a month at a time - the matching days of each
+month are worked out from the fields, rather than checking each day in turn -
+so even a schedule that only matches on 29th February takes just a few steps.
+'''
+
+import calendar
+import datetime
+
+# (min, max) of each field
+FIELD_RANGES = (
+    (0, 59),  # minute
+    (0, 23),  # hour
+    (1, 31),  # day of month
+    (1, 12),  # month
+    (0, 7),  # day of week
+)
+
+# How far to search for a matching time, before deciding there is none (e.g.
+# "0 0 30 2 *") - long enough for a leap day
+MAX_SEARCH_MONTHS = 12 * 8
+
+
+class Schedule(object):
+    '''A cron-like schedule.
+
+    :param spec: e.g. "0 9 * * 5"
+    :raises ValueError: if the spec is not valid
+    '''
+    def __init__(self, spec):
+        self.spec = spec
+        fields = spec.split()
+        if len(fields) != 5:
+            raise ValueError(
+                'Schedule "{}" should have 5 fields: minute hour '
+                'day-of-month month day-of-week'.format(spec))
+        self.minutes, self.hours, self.days, self.months, days_of_week = [
+            parse_field(field, min_, max_)
+            for field, (min_, max_) in zip(fields, FIELD_RANGES)]
+        # 0 and 7 are both Sunday
+        self.days_of_week = set(day % 7 for day in days_of_week)
+        self.days_restricted = fields[2] != '*'
+        self.days_of_week_restricted = fields[4] != '*'
+        self.sorted_hours = sorted(self.hours)
+        self.sorted_minutes = sorted(self.minutes)
+
+    def __repr__(self):
+        return '<Schedule {}>'.format(self.spec)
+
+    def matching_days(self, year, month):
+        '''Returns the days of the month that match the schedule, in order.'''
+        if month not in self.months:
+            return []
+        first_weekday, num_days = calendar.monthrange(year, month)
+        days = set(day for day in self.days if day <= num_days)
+        # cron numbers days of the week from Sunday
+        first_day_of_week = (first_weekday + 1) % 7
+        days_of_week = set()
+        for day_of_week in self.days_of_week:
+            days_of_week.update(range(
+                1 + (day_of_week - first_day_of_week) % 7, num_days + 1, 7))
+        if self.days_restricted and self.days_of_week_restricted:
+            return sorted(days | days_of_week)
+        return sorted(days & days_of_week)
+
+    def most_recent(self, now=None):
+        '''Returns the latest scheduled time at or before now, or None if there
+        isn't one.
+        '''
+        now = (now or datetime.datetime.now()).replace(second=0,
+                                                       microsecond=0)
+        year, month = now.year, now.month
+        for months_ago in range(MAX_SEARCH_MONTHS):
+            for day in reversed(self.matching_days(year, month)):
+                if months_ago == 0 and day > now.day:
+                    continue
+                time_ = self._latest_time(
+                    (now.hour, now.minute)
+                    if months_ago == 0 and day == now.day else (23, 59))
+                if time_:
+                    return datetime.datetime.combine(
+                        datetime.date(year, month, day), time_)
+            year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+            if year < datetime.MINYEAR:
+                break
+        return None
+
+    def next_due(self, now=None):
+        '''Returns the earliest scheduled time after now, or None if there
+        isn't one.
+        '''
+        now = (now or datetime.datetime.now()).replace(second=0,
+                                                       microsecond=0)
+        year, month = now.year, now.month
+        for months_ahead in range(MAX_SEARCH_MONTHS):
+            for day in self.matching_days(year, month):
+                if months_ahead == 0 and day < now.day:
+                    continue
+                time_ = self._earliest_time(
+                    (now.hour, now.minute + 1)
+                    if months_ahead == 0 and day == now.day else (0, 0))
+                if time_:
+                    return datetime.datetime.combine(
+                        datetime.date(year, month, day), time_)
+            year, month = (year, month + 1) if month < 12 else (year + 1, 1)
+            if year > datetime.MAXYEAR:
+                break
+        return None
+
+    def period(self, now=None):
+        '''Returns the time between the most recent scheduled time and the one
+        before it.
+        '''
+        most_recent = self.most_recent(now)
+        if most_recent is None:
+            return None
+        previous = self.most_recent(
+            most_recent - datetime.timedelta(minutes=1))
+        if previous is None:
+            return None
+        return most_recent - previous
+
+    def _latest_time(self, at_or_before):
+        hour_limit, minute_limit = at_or_before
+        for hour in reversed(self.sorted_hours):
+            if hour > hour_limit:
+                continue
+            for minute in reversed(self.sorted_minutes):
+                if hour == hour_limit and minute > minute_limit:
+                    continue
+                return datetime.time(hour, minute)
+        return None
+
+    def _earliest_time(self, at_or_after):
+        hour_limit, minute_limit = at_or_after
+        for hour in self.sorted_hours:
+            if hour < hour_limit:
+                continue
+            for minute in self.sorted_minutes:
+                if hour == hour_limit and minute < minute_limit:
+                    continue
+                return datetime.time(hour, minute)
+        return None
+
+
+def parse_field(field, min_, max_):
+    '''Returns the set of numbers that a cron field stands for.'''
+    values = set()
+    for part in field.split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/', 1)
+            step = _parse_int(step, 1, max_ - min_ + 1)
+        if part == '*':
+            start, end = min_, max_
+        elif '-' in part:
+            start, end = [_parse_int(value, min_, max_)
+                          for value in part.split('-', 1)]
+        else:
+            start = _parse_int(part, min_, max_)
+            end = max_ if step > 1 else start
+        if start > end:
+            raise ValueError('Bad range in schedule: "{}"'.format(field))
+        values.update(range(start, end + 1, step))
+    return values
+
+
+def _parse_int(value, min_, max_):
+    try:
+        number = int(value)
+    except ValueError:
+        raise ValueError('Bad number in schedule: "{}"'.format(value))
+    if not min_ <= number <= max_:
+        raise ValueError('Number in schedule should be {}-{}: "{}"'
+                         .format(min_, max_, value))
+    return number
@@ -1,9 +1,19 @@
 # encoding: utf-8
 
+from six import string_types
+from six.moves.urllib.parse import urlparse
+import pytz
+
 import ckan.plugins as p
 from ckan.common import _
 
-from ckanext.subscribe.model import Subscription, Frequency
+from ckanext.subscribe import saved_search, webhook
+from ckanext.subscribe.model import (
+    Subscription,
+    Frequency,
+    ACTIVITY_TYPES,
+    join_activity_types,
+)
 
 get_validator = p.toolkit.get_validator
 Invalid = p.toolkit.Invalid
@@ -18,13 +28,17 @@ boolean_validator = get_validator('boolean_validator')
 def one_package_or_group_or_org(key, data, errors, context):
     num_objects_specified = len(list(filter(None, [data[('dataset_id',)],
                                                    data[('group_id',)],
-                                                   data[('organization_id',)]])))
+                                                   data[('organization_id',)],
+                                                   data.get(('resource_id',)),
+                                                   data.get(('query',))])))
     if num_objects_specified > 1:
         raise Invalid(_('Must not specify more than one of: "dataset_id", '
-                        '"group_id" or "organization_id"'))
+                        '"group_id", "organization_id", "resource_id" or '
+                        '"query"'))
     if num_objects_specified < 1:
         raise Invalid(_('Must specify one of: "dataset_id", '
-                        '"group_id" or "organization_id"'))
+                        '"group_id", "organization_id", "resource_id" or '
+                        '"query"'))
 
 
 def frequency_name_to_int(name, context):
@@ -35,22 +49,128 @@ def frequency_name_to_int(name, context):
                         .format(' '.join(f.name.lower() for f in Frequency))))
 
 
+def activity_types_validator(value, context):
+    '''Accepts a list of activity types, or a comma-separated string of them,
+    and converts to the stored (comma-separated) form. Empty means all types.
+    '''
+    if isinstance(value, string_types):
+        value = value.split(',')
+    activity_types = [activity_type.strip() for activity_type in value
+                      if activity_type and activity_type.strip()]
+    for activity_type in activity_types:
+        if activity_type not in ACTIVITY_TYPES:
+            raise Invalid(_('Activity type must be one of: {}'
+                            .format(', '.join(ACTIVITY_TYPES))))
+    return join_activity_types(activity_types)
+
+
+def resource_id_exists(value, context):
+    '''Raises Invalid if there is no (active) resource with this id.'''
+    model = context['model']
+    resource = model.Resource.get(value)
+    if not resource or resource.state != 'active':
+        raise Invalid(_('That resource ID does not exist.'))
+    return resource.id
+
+
+def query_validator(value, context):
+    '''Checks it is a saved search query e.g. "tags:covid res_format:CSV" and
+    converts it to its canonical form.
+    '''
+    try:
+        terms = saved_search.get_group_ids(saved_search.parse_query(value))
+    except ValueError as e:
+        raise Invalid(_('Query is invalid: {}').format(e))
+    return saved_search.format_query(terms)
+
+
+def unsubscribe_query_validator(value, context):
+    '''As query_validator, but the organizations and groups it names don't
+    need to exist any more.
+    '''
+    try:
+        terms = saved_search.get_group_ids(saved_search.parse_query(value),
+                                           check_exists=False)
+    except ValueError as e:
+        raise Invalid(_('Query is invalid: {}').format(e))
+    return saved_search.format_query(terms)
+
+
+def timezone_validator(value, context):
+    '''Checks it is a time zone name e.g. 'Europe/London'. Empty means the
+    site's default.
+    '''
+    if not value:
+        return None
+    if value not in pytz.all_timezones_set:
+        raise Invalid(_('Time zone not recognized - it should be like '
+                        '"Europe/London"'))
+    return value
+
+
+def webhook_url_validator(value, context):
+    '''Checks it is an http(s) URL. Empty means no webhook - notifications are
+    emailed.
+    '''
+    if not value:
+        return None
+    url = urlparse(value)
+    if url.scheme not in ('http', 'https') or not url.netloc:
+        raise Invalid(_('Webhook URL must be an http or https URL'))
+    try:
+        webhook.check_url(value, webhook.allow_private_hosts())
+    except webhook.WebhookError as e:
+        raise Invalid(_('Webhook URL is not allowed: {}').format(e))
+    return value
+
+
+def webhook_secret_validator(value, context):
+    if value and len(value) < 16:
+        raise Invalid(_('Webhook secret must be at least 16 characters'))
+    return value or None
+
+
 def subscribe_schema():
     return {
         '__before': [one_package_or_group_or_org],
         'dataset_id': [ignore_empty, package_id_or_name_exists],
         'group_id': [ignore_empty, group_id_or_name_exists],
         'organization_id': [ignore_empty, group_id_or_name_exists],
+        'resource_id': [ignore_empty, resource_id_exists],
+        'query': [ignore_empty, query_validator],
         'email': [email],
         'frequency': [ignore_empty, frequency_name_to_int],
+        'activity_types': [ignore_missing, activity_types_validator],
+        'timezone': [ignore_missing, timezone_validator],
+        'webhook_url': [ignore_missing, webhook_url_validator],
+        'webhook_secret': [ignore_missing, webhook_secret_validator],
+        'include_child_organizations': [ignore_missing, boolean_validator],
         'skip_verification': [boolean_validator],
     }
 
 
+def bulk_subscribe_schema():
+    '''As subscribe_schema, for each row of a bulk signup. The objects are
+    not looked up here - bulk.resolve_objects() does that for a whole batch
+    of rows at once.
+    '''
+    schema = subscribe_schema()
+    for key in ('dataset_id', 'group_id', 'organization_id', 'resource_id'):
+        schema[key] = [ignore_empty]
+    # this is given for the whole import
+    del schema['skip_verification']
+    return schema
+
+
 def update_schema():
     return {
         'id': [subscription_id_exists],
         'frequency': [ignore_empty, frequency_name_to_int],
+        'activity_types': [ignore_missing, activity_types_validator],
+        'timezone': [ignore_missing, timezone_validator],
+        'webhook_url': [ignore_missing, webhook_url_validator],
+        'webhook_secret': [ignore_missing, webhook_secret_validator],
+        'include_child_organizations': [ignore_missing, boolean_validator],
     }
 
 
@@ -60,6 +180,9 @@ def unsubscribe_schema():
         'dataset_id': [ignore_empty, package_id_or_name_exists],
         'group_id': [ignore_empty, group_id_or_name_exists],
         'organization_id': [ignore_empty, group_id_or_name_exists],
+        # the resource may have been deleted since
+        'resource_id': [ignore_empty],
+        'query': [ignore_empty, unsubscribe_query_validator],
         'email': [email],
     }
 
@@ -42,7 +42,8 @@ class Subscription(factory.Factory):
             kwargs['skip_verification'] = True
 
         if not (kwargs.get('dataset_id') or kwargs.get('group_id') or
-                kwargs.get('organization_id')):
+                kwargs.get('organization_id') or kwargs.get('resource_id') or
+                kwargs.get('query')):
             kwargs['dataset_id'] = ckan_factories.Dataset()['id']
 
         subscription_dict = \
@@ -7,7 +7,7 @@ import pytest
 import six
 
 from ckan.tests import helpers, factories
-from ckan.plugins.toolkit import ValidationError
+from ckan.plugins.toolkit import ValidationError, ObjectNotFound
 from ckan import model
 
 from ckanext.subscribe.tests.factories import (
@@ -171,6 +171,102 @@ class TestSubscribeSignup(object):
         assert subscription['email'] == 'bob@example.com'
         assert not subscription['verified']
 
+    @mock.patch('ckanext.subscribe.email_verification.send_request_email')
+    def test_activity_types(self, send_request_email):
+        dataset = factories.Dataset()
+
+        subscription = helpers.call_action(
+            'subscribe_signup',
+            {},
+            email='bob@example.com',
+            dataset_id=dataset['id'],
+            activity_types='new package,deleted package',
+        )
+
+        assert subscription['activity_types'] == \
+            ['new package', 'deleted package']
+        subscription_obj = model.Session.query(subscribe_model.Subscription) \
+            .get(subscription['id'])
+        assert subscription_obj.activity_type_list == \
+            ['new package', 'deleted package']
+
+    @mock.patch('ckanext.subscribe.email_verification.send_request_email')
+    def test_webhook(self, send_request_email):
+        dataset = factories.Dataset()
+
+        subscription = helpers.call_action(
+            'subscribe_signup',
+            {},
+            email='bob@example.com',
+            dataset_id=dataset['id'],
+            webhook_url='https://example.com/hook',
+        )
+
+        # the email address is still verified
+        send_request_email.assert_called_once()
+        assert subscription['webhook_url'] == 'https://example.com/hook'
+        subscription_obj = model.Session.query(subscribe_model.Subscription) \
+            .get(subscription['id'])
+        assert subscription['webhook_secret'] == \
+            subscription_obj.webhook_secret
+
+    @mock.patch('ckanext.subscribe.email_verification.send_request_email')
+    def test_webhook_change_not_allowed(self, send_request_email):
+        subscription = Subscription(email='bob@example.com',
+                                    skip_verification=True)
+        send_request_email.reset_mock()
+
+        with pytest.raises(ValidationError) as cm:
+            helpers.call_action(
+                'subscribe_signup',
+                {},
+                email='bob@example.com',
+                dataset_id=subscription['object_id'],
+                webhook_url='https://example.com/hook',
+            )
+
+        assert 'webhook_url' in cm.value.error_dict
+        assert not send_request_email.called
+        subscription_obj = model.Session.query(subscribe_model.Subscription) \
+            .get(subscription['id'])
+        assert subscription_obj.webhook_url is None
+        assert subscription_obj.verified
+
+    @mock.patch('ckanext.subscribe.email_verification.send_request_email')
+    def test_webhook_secret_not_shown_again(self, send_request_email):
+        subscription = Subscription(email='bob@example.com',
+                                    webhook_url='https://example.com/hook')
+
+        subscription = helpers.call_action(
+            'subscribe_signup',
+            {},
+            email='bob@example.com',
+            dataset_id=subscription['object_id'],
+            webhook_url='https://example.com/hook',
+        )
+
+        assert 'webhook_secret' not in subscription
+
+    @pytest.mark.ckan_config('ckanext.subscribe.webhook_allow_private_hosts',
+                             'false')
+    @mock.patch('socket.getaddrinfo')
+    @mock.patch('ckanext.subscribe.email_verification.send_request_email')
+    def test_webhook_private_host(self, send_request_email, getaddrinfo):
+        dataset = factories.Dataset()
+        for address in ('127.0.0.1', '10.1.2.3', '169.254.169.254', '::1',
+                        '::ffff:192.168.0.1'):
+            getaddrinfo.return_value = [(None, None, None, '', (address, 0))]
+
+            with pytest.raises(ValidationError) as cm:
+                helpers.call_action(
+                    'subscribe_signup',
+                    {},
+                    email='bob@example.com',
+                    dataset_id=dataset['id'],
+                    webhook_url='http://internal.example.com/hook',
+                )
+            assert 'webhook_url' in cm.value.error_dict, address
+
     @mock.patch('ckanext.subscribe.email_verification.send_request_email')
     def test_dataset_doesnt_exist(self, send_request_email):
         with pytest.raises(ValidationError) as cm:
@@ -208,12 +304,245 @@ class TestSubscribeSignup(object):
                 dataset_id=dataset['id'],
                 group_id=group['id'],
             )
-            assert 'Must not specify more than one of: "dataset_id", "group_id" or ' \
-                   '"organization_id"' in str(cm.exception.error_dict)
+            assert 'Must not specify more than one of: "dataset_id", "group_id", ' \
+                   '"organization_id", "resource_id" or "query"' in str(cm.exception.error_dict)
+
+        assert not send_request_email.called
+
+    @mock.patch('ckanext.subscribe.email_verification.send_request_email')
+    def test_resource(self, send_request_email):
+        dataset = factories.Dataset(resources=[{'url': 'http://x.com/a.csv'}])
+        resource_id = dataset['resources'][0]['id']
+
+        subscription = helpers.call_action(
+            'subscribe_signup',
+            {},
+            email='bob@example.com',
+            resource_id=resource_id,
+        )
+
+        send_request_email.assert_called_once()
+        assert subscription['object_type'] == 'resource'
+        assert subscription['object_id'] == resource_id
+
+    @mock.patch('ckanext.subscribe.email_verification.send_request_email')
+    def test_query(self, send_request_email):
+        org = factories.Organization()
+
+        subscription = helpers.call_action(
+            'subscribe_signup',
+            {},
+            email='bob@example.com',
+            query='organization:{} tags:covid  tags:covid'.format(org['name']),
+        )
+
+        send_request_email.assert_called_once()
+        assert subscription['object_type'] == 'query'
+        # stored in its canonical form, with the organization's id
+        assert subscription['object_id'] == \
+            'organization:{} tags:covid'.format(org['id'])
+        terms = model.Session.query(subscribe_model.QueryTerm.term) \
+            .filter_by(subscription_id=subscription['id']).all()
+        assert sorted(term for (term,) in terms) == \
+            ['organization:{}'.format(org['id']), 'tags:covid']
 
+    @mock.patch('ckanext.subscribe.email_verification.send_request_email')
+    def test_query_invalid(self, send_request_email):
+        with pytest.raises(ValidationError) as cm:
+            helpers.call_action(
+                'subscribe_signup',
+                {},
+                email='bob@example.com',
+                query='author:bob',
+            )
+        assert 'query' in cm.value.error_dict
         assert not send_request_email.called
 
 
+def _send_batch(messages):
+    return [(0, None) for _ in messages]
+
+
+@pytest.mark.usefixtures('reset_db', 'with_plugins')
+class TestSubscribeSignupBulk(object):
+    @mock.patch('ckanext.subscribe.mailer.send_batch', side_effect=_send_batch)
+    def test_basic(self, send_batch):
+        dataset = factories.Dataset()
+        group = factories.Group()
+        org = factories.Organization()
+
+        results = helpers.call_action(
+            'subscribe_signup_bulk',
+            {},
+            subscriptions=[
+                {'email': 'bob@example.com', 'dataset_id': dataset['name']},
+                {'email': 'bob@example.com', 'group_id': group['id']},
+                {'email': 'jo@example.com', 'organization_id': org['name'],
+                 'frequency': 'daily'},
+            ],
+        )
+
+        assert [result['status'] for result in results] == \
+            ['created', 'created', 'created']
+        assert [result['row'] for result in results] == [0, 1, 2]
+        subscriptions = [model.Session.query(subscribe_model.Subscription)
+                         .get(result['id']) for result in results]
+        assert [(s.email, s.object_type, s.object_id)
+                for s in subscriptions] == [
+            ('bob@example.com', 'dataset', dataset['id']),
+            ('bob@example.com', 'group', group['id']),
+            ('jo@example.com', 'organization', org['id']),
+        ]
+        assert subscriptions[2].frequency == \
+            subscribe_model.Frequency.DAILY.value
+        assert not any(s.verified for s in subscriptions)
+        assert all(s.verification_code for s in subscriptions)
+        # the verification emails are sent in one batch
+        send_batch.assert_called_once()
+        assert sorted(email for _, email in send_batch.call_args[0][0]) == \
+            ['bob@example.com', 'bob@example.com', 'jo@example.com']
+
+    @mock.patch('ckanext.subscribe.mailer.send_batch', side_effect=_send_batch)
+    def test_skip_verification(self, send_batch):
+        dataset = factories.Dataset()
+
+        results = helpers.call_action(
+            'subscribe_signup_bulk',
+            {},
+            subscriptions=[{'email': 'bob@example.com',
+                            'dataset_id': dataset['id']}],
+            skip_verification=True,
+        )
+
+        assert not send_batch.called
+        subscription = model.Session.query(subscribe_model.Subscription) \
+            .get(results[0]['id'])
+        assert subscription.verified
+
+    @mock.patch('ckanext.subscribe.mailer.send_batch', side_effect=_send_batch)
+    def test_errors_dont_stop_other_rows(self, send_batch):
+        dataset = factories.Dataset()
+
+        results = helpers.call_action(
+            'subscribe_signup_bulk',
+            {},
+            subscriptions=[
+                {'email': 'bob@example.com', 'dataset_id': 'unknown'},
+                {'email': 'not an email', 'dataset_id': dataset['id']},
+                {'email': 'bob@example.com', 'dataset_id': dataset['id']},
+                {'email': 'bob@example.com', 'query': 'author:bob'},
+            ],
+        )
+
+        assert [result['status'] for result in results] == \
+            ['error', 'error', 'created', 'error']
+        assert 'dataset_id' in results[0]['error']
+        assert 'email' in results[1]['error']
+        assert 'query' in results[3]['error']
+        assert model.Session.query(subscribe_model.Subscription).count() == 1
+
+    @mock.patch('ckanext.subscribe.mailer.send_batch', side_effect=_send_batch)
+    def test_existing_subscription_is_updated(self, send_batch):
+        dataset = factories.Dataset()
+        existing = Subscription(
+            dataset_id=dataset['id'],
+            email='bob@example.com',
+            skip_verification=True,
+        )
+
+        results = helpers.call_action(
+            'subscribe_signup_bulk',
+            {},
+            subscriptions=[
+                {'email': 'bob@example.com', 'dataset_id': dataset['name'],
+                 'frequency': 'weekly'},
+                # and again, in the same batch
+                {'email': 'bob@example.com', 'dataset_id': dataset['id'],
+                 'frequency': 'monthly'},
+            ],
+            skip_verification=True,
+        )
+
+        assert [(result['status'], result['id']) for result in results] == \
+            [('updated', existing['id']), ('updated', existing['id'])]
+        subscriptions = model.Session.query(subscribe_model.Subscription).all()
+        assert len(subscriptions) == 1
+        assert subscriptions[0].frequency == \
+            subscribe_model.Frequency.MONTHLY.value
+
+    @pytest.mark.ckan_config('ckanext.subscribe.bulk_batch_size', '2')
+    @mock.patch('ckanext.subscribe.mailer.send_batch', side_effect=_send_batch)
+    def test_batches(self, send_batch):
+        datasets = [factories.Dataset() for _ in range(5)]
+
+        results = helpers.call_action(
+            'subscribe_signup_bulk',
+            {},
+            subscriptions=[{'email': 'bob@example.com',
+                            'dataset_id': dataset['id']}
+                           for dataset in datasets],
+        )
+
+        assert [result['status'] for result in results] == ['created'] * 5
+        assert send_batch.call_count == 3
+        assert model.Session.query(subscribe_model.Subscription).count() == 5
+
+    @mock.patch('ckanext.subscribe.mailer.send_batch', side_effect=_send_batch)
+    def test_existing_subscription_gets_webhook(self, send_batch):
+        dataset = factories.Dataset()
+        existing = Subscription(
+            dataset_id=dataset['id'],
+            email='bob@example.com',
+            skip_verification=True,
+        )
+
+        results = helpers.call_action(
+            'subscribe_signup_bulk',
+            {},
+            subscriptions=[
+                {'email': 'bob@example.com', 'dataset_id': dataset['id'],
+                 'webhook_url': 'https://example.com/hook'},
+                # and again, in the same batch, without a secret
+                {'email': 'bob@example.com', 'dataset_id': dataset['id'],
+                 'webhook_url': 'https://example.com/hook'},
+            ],
+        )
+
+        assert [(result['status'], result['id']) for result in results] == \
+            [('updated', existing['id']), ('updated', existing['id'])]
+        subscription = model.Session.query(subscribe_model.Subscription) \
+            .get(existing['id'])
+        assert subscription.webhook_url == 'https://example.com/hook'
+        assert len(subscription.webhook_secret) >= 16
+        # the same secret is kept for the same webhook
+        assert results[0]['webhook_secret'] == subscription.webhook_secret
+        assert results[1]['webhook_secret'] == subscription.webhook_secret
+        # a new destination needs verifying
+        assert not subscription.verified
+
+    @mock.patch('ckanext.subscribe.mailer.send_batch', side_effect=_send_batch)
+    def test_query_is_indexed(self, send_batch):
+        results = helpers.call_action(
+            'subscribe_signup_bulk',
+            {},
+            subscriptions=[{'email': 'bob@example.com',
+                            'query': 'tags:covid'}],
+        )
+
+        terms = model.Session.query(subscribe_model.QueryTerm.term) \
+            .filter_by(subscription_id=results[0]['id']).all()
+        assert terms == [('tags:covid',)]
+
+    def test_subscriptions_must_be_a_list(self):
+        with pytest.raises(ValidationError) as cm:
+            helpers.call_action(
+                'subscribe_signup_bulk',
+                {},
+                subscriptions='bob@example.com',
+            )
+        assert 'subscriptions' in cm.value.error_dict
+
+
 @pytest.mark.usefixtures('reset_db', 'with_plugins')
 class TestSubscribeVerify(object):
     @pytest.mark.usefixtures('clean_db', 'clean_index')
@@ -463,6 +792,57 @@ class TestUnsubscribe(object):
         )
         assert [sub['object_id'] for sub in sub_list] == [org2['id']]
 
+    def test_query(self):
+        Subscription(
+            query='tags:covid',
+            email='bob@example.com',
+            skip_verification=True,
+        )
+
+        object_name, object_type = helpers.call_action(
+            'subscribe_unsubscribe', {},
+            email='bob@example.com',
+            query='tags:covid',
+        )
+
+        assert (object_name, object_type) == ('tags:covid', 'query')
+        assert not model.Session.query(subscribe_model.QueryTerm).count()
+
+    def test_query_with_deleted_organization(self):
+        org = factories.Organization()
+        Subscription(
+            query='organization:{} tags:covid'.format(org['name']),
+            email='bob@example.com',
+            skip_verification=True,
+        )
+        helpers.call_action('organization_delete', {}, id=org['id'])
+
+        helpers.call_action(
+            'subscribe_unsubscribe', {},
+            email='bob@example.com',
+            query='organization:{} tags:covid'.format(org['name']),
+        )
+
+        assert not model.Session.query(subscribe_model.Subscription).count()
+
+    def test_query_with_renamed_organization(self):
+        org = factories.Organization()
+        Subscription(
+            query='organization:{} tags:covid'.format(org['name']),
+            email='bob@example.com',
+            skip_verification=True,
+        )
+        helpers.call_action('organization_patch', {}, id=org['id'],
+                            name='renamed-org')
+
+        helpers.call_action(
+            'subscribe_unsubscribe', {},
+            email='bob@example.com',
+            query='organization:renamed-org tags:covid',
+        )
+
+        assert not model.Session.query(subscribe_model.Subscription).count()
+
 
 @pytest.mark.usefixtures('reset_db', 'with_plugins')
 class TestUnsubscribeAll(object):
@@ -491,6 +871,93 @@ class TestUnsubscribeAll(object):
         )
         assert not [sub['object_id'] for sub in sub_list]
 
+    def test_query_terms_are_removed(self):
+        Subscription(
+            query='tags:covid',
+            email='bob@example.com',
+            skip_verification=True,
+        )
+
+        helpers.call_action(
+            'subscribe_unsubscribe_all', {},
+            email='bob@example.com',
+        )
+
+        assert not model.Session.query(subscribe_model.QueryTerm).count()
+
+    def test_no_subscriptions(self):
+        with pytest.raises(ObjectNotFound):
+            helpers.call_action(
+                'subscribe_unsubscribe_all', {},
+                email='bob@example.com',
+            )
+
+
+@pytest.mark.usefixtures('reset_db', 'with_plugins')
+class TestUnsubscribeBulk(object):
+    def test_basic(self):
+        dataset = factories.Dataset()
+        dataset2 = factories.Dataset()
+        for email in ('bob@example.com', 'jo@example.com',
+                      'sam@example.com'):
+            for dataset_ in (dataset, dataset2):
+                Subscription(
+                    dataset_id=dataset_['id'],
+                    email=email,
+                    skip_verification=True,
+                )
+
+        counts = helpers.call_action(
+            'subscribe_unsubscribe_bulk', {},
+            emails=['bob@example.com', 'jo@example.com',
+                    'unknown@example.com'],
+        )
+
+        assert counts == {'emails': 3, 'unsubscribed_emails': 2,
+                          'subscriptions': 4}
+        assert [subscription.email for subscription in
+                model.Session.query(subscribe_model.Subscription)] == \
+            ['sam@example.com', 'sam@example.com']
+
+    @pytest.mark.ckan_config('ckanext.subscribe.bulk_batch_size', '2')
+    def test_batches(self):
+        dataset = factories.Dataset()
+        emails = ['user{}@example.com'.format(i) for i in range(5)]
+        for email in emails:
+            Subscription(
+                dataset_id=dataset['id'],
+                email=email,
+                skip_verification=True,
+            )
+
+        counts = helpers.call_action(
+            'subscribe_unsubscribe_bulk', {},
+            emails=emails,
+        )
+
+        assert counts == {'emails': 5, 'unsubscribed_emails': 5,
+                          'subscriptions': 5}
+        assert not model.Session.query(subscribe_model.Subscription).count()
+
+    def test_failed_deliveries_are_removed(self):
+        dataset = factories.Dataset()
+        Subscription(
+            dataset_id=dataset['id'],
+            email='bob@example.com',
+            skip_verification=True,
+        )
+        subscribe_model.Delivery.record_failed(
+            'immediate 2020-01-24 09:00:00', 'bob@example.com', 'message',
+            'error', datetime.datetime.now())
+        model.Session.commit()
+
+        helpers.call_action(
+            'subscribe_unsubscribe_bulk', {},
+            emails=['bob@example.com'],
+        )
+
+        assert not model.Session.query(subscribe_model.Delivery).count()
+
 
 @pytest.mark.usefixtures('clean_db', 'clean_index', 'with_plugins')
 class TestSendAnyNotifications(object):
@@ -546,3 +1013,119 @@ class TestUpdate(object):
         )
 
         assert subscription['frequency'] == 'WEEKLY'  # unchanged
+
+    def test_activity_types(self):
+        subscription = Subscription(
+            email='bob@example.com',
+            skip_verification=True,
+        )
+        assert subscription['activity_types'] == []
+
+        subscription = helpers.call_action(
+            'subscribe_update',
+            {},
+            id=subscription['id'],
+            activity_types=['new package', 'deleted package'],
+        )
+        assert subscription['activity_types'] == \
+            ['new package', 'deleted package']
+
+        subscription = helpers.call_action(
+            'subscribe_update',
+            {},
+            id=subscription['id'],
+            activity_types=[],
+        )
+        assert subscription['activity_types'] == []  # i.e. all types
+
+    def test_activity_types_invalid(self):
+        subscription = Subscription(
+            email='bob@example.com',
+            skip_verification=True,
+        )
+
+        with pytest.raises(ValidationError) as cm:
+            helpers.call_action(
+                'subscribe_update',
+                {},
+                id=subscription['id'],
+                activity_types=['bad type'],
+            )
+        assert 'activity_types' in cm.value.error_dict
+
+    def test_timezone(self):
+        subscription = Subscription(
+            email='bob@example.com',
+            skip_verification=True,
+        )
+        assert subscription['timezone'] is None
+
+        subscription = helpers.call_action(
+            'subscribe_update',
+            {},
+            id=subscription['id'],
+            timezone='Europe/London',
+        )
+        assert subscription['timezone'] == 'Europe/London'
+
+        subscription = helpers.call_action(
+            'subscribe_update',
+            {},
+            id=subscription['id'],
+            timezone='',
+        )
+        assert subscription['timezone'] is None
+
+    def test_timezone_invalid(self):
+        subscription = Subscription(
+            email='bob@example.com',
+            skip_verification=True,
+        )
+
+        with pytest.raises(ValidationError) as cm:
+            helpers.call_action(
+                'subscribe_update',
+                {},
+                id=subscription['id'],
+                timezone='Europe/Atlantis',
+            )
+        assert 'timezone' in cm.value.error_dict
+
+    def test_webhook(self):
+        subscription = Subscription(
+            email='bob@example.com',
+            skip_verification=True,
+        )
+
+        subscription = helpers.call_action(
+            'subscribe_update',
+            {},
+            id=subscription['id'],
+            webhook_url='https://example.com/hook',
+        )
+
+        assert subscription['webhook_url'] == 'https://example.com/hook'
+        # a secret is made, and shown this once
+        assert len(subscription['webhook_secret']) == 64
+        subscription = helpers.call_action(
+            'subscribe_update',
+            {},
+            id=subscription['id'],
+            frequency='daily',
+        )
+        assert 'webhook_secret' not in subscription
+
+    def test_webhook_url_invalid(self):
+        subscription = Subscription(
+            email='bob@example.com',
+            skip_verification=True,
+        )
+
+        with pytest.raises(ValidationError) as cm:
+            helpers.call_action(
+                'subscribe_update',
+                {},
+                id=subscription['id'],
+                webhook_url='ftp://example.com/hook',
+            )
+        assert 'webhook_url' in cm.value.error_dict
@@ -200,6 +200,40 @@ class TestManage(SubscribeBase):
 
 @pytest.mark.ckan_config('ckan.plugins', 'subscribe')
 @pytest.mark.usefixtures('with_plugins', 'with_request_context')
+@pytest.mark.usefixtures('with_plugins')
+class TestFeed(SubscribeBase):
+    def test_basic(self):
+        dataset = Dataset()
+        Subscription(
+            dataset_id=dataset['id'],
+            email='bob@example.com',
+            skip_verification=True,
+        )
+        code = email_auth.create_feed_code('bob@example.com')
+
+        response = self.app.get(
+            '/subscribe/feed',
+            params={'code': code},
+            status=200)
+
+        assert response.headers['Content-Type'].startswith(
+            'application/atom+xml')
+        assert six.ensure_str(dataset['title']) in six.ensure_str(response.body)
+
+        # a repeat poll isn't sent the feed again
+        self.app.get(
+            '/subscribe/feed',
+            params={'code': code},
+            headers={'If-None-Match': response.headers['ETag']},
+            status=304)
+
+    def test_bad_code(self):
+        self.app.get(
+            '/subscribe/feed',
+            params={'code': 'bad-code'},
+            status=403)
+
+
 class TestUpdate(SubscribeBase):
     def test_submit(self):
         subscription = Subscription(
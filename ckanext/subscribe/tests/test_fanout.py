@@ -0,0 +1,221 @@
+# encoding: utf-8
+
+import datetime
+
+import pytest
+
+from ckanext.subscribe import fanout
+
+
+class Sub(object):
+    def __init__(self, email, created, activity_type_list=(),
+                 object_type='dataset', object_id=None, webhook_url=None):
+        self.email = email
+        self.webhook_url = webhook_url
+        self.created = created
+        self.activity_type_list = list(activity_type_list)
+        self.object_type = object_type
+        self.object_id = object_id
+
+    def __repr__(self):
+        return '<Sub {}>'.format(self.email)
+
+
+class Act(object):
+    def __init__(self, object_id, timestamp, activity_type='changed package'):
+        self.object_id = object_id
+        self.timestamp = timestamp
+        self.activity_type = activity_type
+
+
+NOW = datetime.datetime(2020, 1, 24, 9, 0)
+
+
+def _as_comparable(notifications):
+    return dict(
+        (email, dict((sub, list(acts)) for sub, acts in sub_acts.items()))
+        for email, sub_acts in notifications.items())
+
+
+def _fixture():
+    sub_a = Sub('a@example.com', NOW - datetime.timedelta(days=2))
+    sub_b = Sub('b@example.com', NOW - datetime.timedelta(days=2))
+    sub_b2 = Sub('b@example.com', NOW - datetime.timedelta(hours=1))
+    objects_subscribed_to = {
+        'dataset1': [sub_a, sub_b],
+        'dataset2': [sub_b2],
+        'dataset3': [],
+    }
+    activities = [
+        Act('dataset1', NOW - datetime.timedelta(hours=3)),
+        Act('dataset2', NOW - datetime.timedelta(hours=2)),  # before sub_b2
+        Act('dataset2', NOW - datetime.timedelta(minutes=30)),
+        Act('dataset1', NOW - datetime.timedelta(minutes=10)),
+        Act('dataset3', NOW - datetime.timedelta(minutes=5)),
+    ]
+    return activities, objects_subscribed_to, (sub_a, sub_b, sub_b2)
+
+
+class TestGroupByRecipient(object):
+
+    def test_python(self):
+        activities, objects_subscribed_to, (sub_a, sub_b, sub_b2) = _fixture()
+
+        notifications = fanout.group_by_recipient(
+            activities, objects_subscribed_to, vectorized=False)
+
+        assert _as_comparable(notifications) == {
+            'a@example.com': {sub_a: [activities[0], activities[3]]},
+            'b@example.com': {sub_b: [activities[0], activities[3]],
+                              sub_b2: [activities[2]]},
+        }
+
+    def test_vectorized_matches_python(self):
+        pytest.importorskip('numpy')
+        activities, objects_subscribed_to, _ = _fixture()
+
+        vectorized = fanout.group_by_recipient(
+            activities, objects_subscribed_to, vectorized=True)
+        python = fanout.group_by_recipient(
+            activities, objects_subscribed_to, vectorized=False)
+
+        assert _as_comparable(vectorized) == _as_comparable(python)
+
+    def test_vectorized_no_pairs(self):
+        pytest.importorskip('numpy')
+        activities, objects_subscribed_to, _ = _fixture()
+
+        notifications = fanout.group_by_recipient(
+            activities[4:], objects_subscribed_to, vectorized=True)
+
+        assert not notifications
+
+    @pytest.mark.parametrize('vectorized', [False, True])
+    def test_subscription_without_created(self, vectorized):
+        if vectorized:
+            pytest.importorskip('numpy')
+        sub = Sub('a@example.com', None)
+        activities = [Act('dataset1', NOW)]
+
+        notifications = fanout.group_by_recipient(
+            activities, {'dataset1': [sub]}, vectorized=vectorized)
+
+        assert _as_comparable(notifications) == {
+            'a@example.com': {sub: activities}}
+
+    @pytest.mark.parametrize('vectorized', [False, True])
+    def test_activity_types(self, vectorized):
+        if vectorized:
+            pytest.importorskip('numpy')
+        created = NOW - datetime.timedelta(days=1)
+        sub_all = Sub('a@example.com', created)
+        sub_new = Sub('b@example.com', created, ['new package'])
+        sub_deleted = Sub('c@example.com', created, ['deleted package'])
+        objects_subscribed_to = {'dataset1': [sub_all, sub_new, sub_deleted]}
+        activities = [
+            Act('dataset1', NOW, 'new package'),
+            Act('dataset1', NOW, 'changed package'),
+        ]
+
+        notifications = fanout.group_by_recipient(
+            activities, objects_subscribed_to, vectorized=vectorized)
+
+        assert _as_comparable(notifications) == {
+            'a@example.com': {sub_all: activities},
+            'b@example.com': {sub_new: [activities[0]]},
+        }
+
+    @pytest.mark.parametrize('vectorized', [False, True])
+    def test_overlapping_subscriptions(self, vectorized):
+        if vectorized:
+            pytest.importorskip('numpy')
+        created = NOW - datetime.timedelta(days=1)
+        sub_group = Sub('a@example.com', created, object_type='group')
+        sub_dataset = Sub('a@example.com', created)
+        sub_org = Sub('a@example.com', created, object_type='organization')
+        sub_other = Sub('b@example.com', created, object_type='group')
+        objects_subscribed_to = {
+            'dataset1': [sub_group, sub_dataset, sub_org, sub_other],
+            'dataset2': [sub_group, sub_org],
+        }
+        activities = [
+            Act('dataset1', NOW),
+            Act('dataset2', NOW),
+        ]
+
+        notifications = fanout.group_by_recipient(
+            activities, objects_subscribed_to, vectorized=vectorized)
+
+        assert _as_comparable(notifications) == {
+            'a@example.com': {sub_dataset: [activities[0]],
+                              sub_org: [activities[1]]},
+            'b@example.com': {sub_other: [activities[0]]},
+        }
+
+    @pytest.mark.parametrize('vectorized', [False, True])
+    def test_overlapping_email_and_webhook_subscriptions(self, vectorized):
+        if vectorized:
+            pytest.importorskip('numpy')
+        created = NOW - datetime.timedelta(days=1)
+        sub_dataset = Sub('a@example.com', created)
+        sub_org = Sub('a@example.com', created, object_type='organization')
+        sub_webhook_org = Sub('a@example.com', created,
+                              object_type='organization',
+                              webhook_url='https://example.com/hook')
+        sub_webhook_group = Sub('a@example.com', created, object_type='group',
+                                webhook_url='https://example.com/hook')
+        objects_subscribed_to = {
+            'dataset1': [sub_webhook_group, sub_webhook_org, sub_org,
+                         sub_dataset],
+        }
+        activities = [Act('dataset1', NOW)]
+
+        notifications = fanout.group_by_recipient(
+            activities, objects_subscribed_to, vectorized=vectorized)
+
+        assert _as_comparable(notifications) == {
+            'a@example.com': {sub_dataset: activities,
+                              sub_webhook_org: activities},
+        }
+
+    @pytest.mark.parametrize('vectorized', [False, True])
+    def test_resource_subscriptions(self, vectorized):
+        if vectorized:
+            pytest.importorskip('numpy')
+        created = NOW - datetime.timedelta(days=1)
+        sub_res1 = Sub('a@example.com', created, object_type='resource',
+                       object_id='res1')
+        sub_res2 = Sub('b@example.com', created, object_type='resource',
+                       object_id='res2')
+        sub_dataset = Sub('a@example.com', created)
+        objects_subscribed_to = {
+            'dataset1': [sub_res1, sub_res2, sub_dataset],
+        }
+        activities = [
+            Act('dataset1', NOW),
+            Act('dataset1', NOW),
+            Act('dataset1', NOW),
+        ]
+        changed_resources = {
+            id(activities[0]): frozenset(['res1']),
+            id(activities[1]): frozenset(),
+            id(activities[2]): None,  # not known
+        }
+
+        notifications = fanout.group_by_recipient(
+            activities, objects_subscribed_to, vectorized=vectorized,
+            get_changed_resources=lambda activity:
+                changed_resources[id(activity)])
+
+        assert _as_comparable(notifications) == {
+            'a@example.com': {sub_res1: [activities[0], activities[2]],
+                              sub_dataset: [activities[1]]},
+            'b@example.com': {sub_res2: [activities[2]]},
+        }
+
+    def test_benchmark(self):
+        results = fanout.benchmark(num_objects=20, subscriptions_per_object=5,
+                                   num_activities=100, num_emails=30)
+
+        assert results['pairs'] > 0
+        assert results['python'] >= 0
@@ -0,0 +1,90 @@
+# encoding: utf-8
+
+import mock
+import pytest
+
+from ckan import model
+from ckan.tests import helpers
+from ckan.tests.factories import Organization
+
+from ckanext.subscribe import model as subscribe_model
+from ckanext.subscribe.hierarchy import (
+    HierarchyCache,
+    get_descendants,
+    get_hierarchy_fingerprint,
+)
+
+
+def add_child(parent, child):
+    '''Makes child a child organization of parent, as ckanext-hierarchy
+    does.'''
+    model.Session.add(model.Member(
+        group_id=parent['id'], table_id=child['id'], table_name='group',
+        capacity='parent', state='active'))
+    model.Session.commit()
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestGetDescendants(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+
+    def test_basic(self):
+        ministry, dept, unit, other = [Organization() for _ in range(4)]
+        add_child(ministry, dept)
+        add_child(dept, unit)
+
+        descendants = get_descendants([ministry['id'], dept['id'],
+                                       other['id']])
+
+        assert descendants == {
+            ministry['id']: frozenset([dept['id'], unit['id']]),
+            dept['id']: frozenset([unit['id']]),
+            other['id']: frozenset(),
+        }
+
+    def test_cycle(self):
+        org1, org2 = Organization(), Organization()
+        add_child(org1, org2)
+        add_child(org2, org1)
+
+        assert get_descendants([org1['id']]) == \
+            {org1['id']: frozenset([org2['id']])}
+
+    def test_deleted_organization_not_included(self):
+        ministry, dept = Organization(), Organization()
+        add_child(ministry, dept)
+        helpers.call_action('organization_delete', id=dept['id'])
+
+        assert get_descendants([ministry['id']]) == \
+            {ministry['id']: frozenset()}
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestHierarchyCache(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+
+    @mock.patch('ckanext.subscribe.hierarchy.get_descendants',
+                wraps=get_descendants)
+    def test_cached_until_the_hierarchy_changes(self, get_descendants_):
+        ministry, dept, unit = [Organization() for _ in range(3)]
+        add_child(ministry, dept)
+        cache = HierarchyCache()
+
+        cache.get_descendants([ministry['id']])
+        assert cache.get_descendants([ministry['id']]) == \
+            {ministry['id']: frozenset([dept['id']])}
+        assert get_descendants_.call_count == 1
+
+        fingerprint = get_hierarchy_fingerprint()
+        add_child(dept, unit)
+        assert get_hierarchy_fingerprint() != fingerprint
+
+        assert cache.get_descendants([ministry['id']]) == \
+            {ministry['id']: frozenset([dept['id'], unit['id']])}
+        assert get_descendants_.call_count == 2
@@ -1,17 +1,23 @@
 # encoding: utf-8
 
 import datetime
+import json
+from email.mime.text import MIMEText
 
 import pytest
 import mock
 
 from ckan.tests import helpers
-from ckan.tests.factories import Dataset, Organization, Group
+from ckan.tests.factories import Dataset, Organization, Group, User
 from ckan import model
+from ckan.lib.mailer import MailerException
 
 from ckanext.subscribe import model as subscribe_model
 from ckanext.subscribe.model import Frequency
 from ckanext.subscribe.notification import (
+    send_any_notifications,
+    backfill,
+    get_notifications_by_frequency,
     send_any_immediate_notifications,
     get_immediate_notifications,
     send_weekly_notifications_if_its_time_to,
@@ -20,12 +26,222 @@ from ckanext.subscribe.notification import (
     get_daily_notifications,
     send_emails,
     dictize_notifications,
+    summarise_activity,
     most_recent_weekly_notification_datetime,
+    get_notifications,
+    is_it_time_to_send,
+    get_send_slot,
+    get_send_window,
+    send_emails_in_slots,
+    get_run_key,
+    retry_failed_deliveries,
+    get_next_due_datetime,
 )
 from ckanext.subscribe import notification as subscribe_notification
+from ckanext.subscribe.webhook import WebhookError
 from ckanext.subscribe.tests import factories
 
 
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestSendAnyNotifications(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+        subscribe_notification._config = {}
+
+    @mock.patch('ckanext.subscribe.notification_email.send_notification_email')
+    def test_all_frequencies_in_one_pass(self, send_notification_email):
+        dataset = factories.DatasetActivity()
+        factories.Subscription(dataset_id=dataset['id'], email='i@a.com',
+                               frequency='immediate')
+        factories.Subscription(dataset_id=dataset['id'], email='d@a.com',
+                               frequency='daily')
+        factories.Subscription(dataset_id=dataset['id'], email='w@a.com',
+                               frequency='weekly')
+
+        with mock.patch.object(
+                subscribe_notification, 'get_objects_subscribed_to',
+                wraps=subscribe_notification.get_objects_subscribed_to) \
+                as get_objects_subscribed_to:
+            send_any_notifications()
+
+        get_objects_subscribed_to.assert_called_once()
+        emails = set(call[0][1] for call in send_notification_email.call_args_list)
+        assert emails == set(('i@a.com', 'd@a.com', 'w@a.com'))
+        for frequency in Frequency:
+            assert time_since_emails_last_sent(frequency.value) \
+                < datetime.timedelta(seconds=1)
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestBackfill(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+        subscribe_notification._config = {}
+
+    def _create_activity(self):
+        now = datetime.datetime.now()
+        dataset = factories.DatasetActivity(
+            timestamp=now - datetime.timedelta(days=5))
+        factories.Activity(
+            object_id=dataset['id'], activity_type='changed package',
+            timestamp=now - datetime.timedelta(days=3))
+        factories.Subscription(
+            dataset_id=dataset['id'],
+            created=now - datetime.timedelta(days=10))
+
+    @mock.patch('ckanext.subscribe.notification_email.send_notification_email')
+    def test_basic(self, send_notification_email):
+        self._create_activity()
+
+        backfill(since=datetime.datetime.now() - datetime.timedelta(days=6),
+                 slice_length=datetime.timedelta(days=1),
+                 frequencies=[Frequency.IMMEDIATE.value])
+
+        # activity older than ckan.email_notifications_since is included, with
+        # one email per slice of activity
+        assert send_notification_email.call_count == 2
+        assert time_since_emails_last_sent(Frequency.IMMEDIATE.value) \
+            < datetime.timedelta(seconds=1)
+
+    @mock.patch('ckanext.subscribe.notification_email.send_notification_email')
+    def test_resumes_after_the_last_complete_slice(self, send_notification_email):
+        self._create_activity()
+        subscribe_model.Subscribe.set_emails_last_sent(
+            Frequency.IMMEDIATE.value,
+            datetime.datetime.now() - datetime.timedelta(days=4))
+        model.Session.commit()
+
+        backfill(since=datetime.datetime.now() - datetime.timedelta(days=6),
+                 slice_length=datetime.timedelta(days=1),
+                 frequencies=[Frequency.IMMEDIATE.value])
+
+        assert send_notification_email.call_count == 1
+
+    @mock.patch('ckanext.subscribe.notification_email.send_notification_email')
+    def test_time_zone_buckets(self, send_notification_email):
+        now = datetime.datetime.now()
+        dataset = factories.DatasetActivity(
+            timestamp=now - datetime.timedelta(days=3))
+        factories.Subscription(
+            dataset_id=dataset['id'], frequency='daily',
+            email='utc@example.com',
+            created=now - datetime.timedelta(days=10))
+        factories.Subscription(
+            dataset_id=dataset['id'], frequency='daily',
+            email='ny@example.com', timezone='America/New_York',
+            created=now - datetime.timedelta(days=10))
+
+        backfill(since=now - datetime.timedelta(days=6),
+                 slice_length=datetime.timedelta(days=1),
+                 frequencies=[Frequency.DAILY.value])
+
+        emails = sorted(call[0][1]
+                        for call in send_notification_email.call_args_list)
+        assert emails == ['ny@example.com', 'utc@example.com']
+        # each bucket is checkpointed
+        for timezone in (None, 'America/New_York'):
+            assert subscribe_model.Subscribe.get_emails_last_sent(
+                Frequency.DAILY.value, timezone=timezone) >= now
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestGetNotificationsByFrequency(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+        subscribe_notification._config = {}
+
+    def test_activity_windows_are_per_frequency(self):
+        dataset = factories.DatasetActivity(
+            timestamp=datetime.datetime.now() - datetime.timedelta(hours=1))
+        factories.Subscription(dataset_id=dataset['id'], email='i@a.com',
+                               frequency='immediate')
+        factories.Subscription(dataset_id=dataset['id'], email='d@a.com',
+                               frequency='daily')
+        subscribe_model.Subscribe.set_emails_last_sent(
+            Frequency.IMMEDIATE.value,
+            datetime.datetime.now() - datetime.timedelta(minutes=5))
+        model.Session.commit()
+
+        notifies = get_notifications_by_frequency(
+            [Frequency.IMMEDIATE.value, Frequency.DAILY.value])
+
+        assert list(notifies.keys()) == [Frequency.DAILY.value]
+        assert list(notifies[Frequency.DAILY.value].keys()) == ['d@a.com']
+
+    def test_no_new_activity_skips_checking_subscriptions(self):
+        factories.Subscription()
+        for frequency in (Frequency.IMMEDIATE.value,
+                          subscribe_model.ACTIVITY_SUMMARY_FREQUENCY):
+            subscribe_model.Subscribe.set_emails_last_sent(
+                frequency, datetime.datetime.now())
+        model.Session.commit()
+        skipped_cycles = subscribe_notification.metrics['skipped_cycles']
+
+        with mock.patch.object(subscribe_notification,
+                               'get_objects_subscribed_to') \
+                as get_objects_subscribed_to:
+            notifies = get_notifications_by_frequency(
+                [Frequency.IMMEDIATE.value])
+
+        assert notifies == {}
+        get_objects_subscribed_to.assert_not_called()
+        assert subscribe_notification.metrics['skipped_cycles'] == \
+            skipped_cycles + 1
+
+    @pytest.mark.ckan_config('ckanext.subscribe.ignore_activity_from_users',
+                             'harvester')
+    def test_activity_by_ignored_users_is_not_notified(self):
+        harvester = User(name='harvester')
+        dataset = factories.DatasetActivity(user_id=harvester['id'])
+        factories.Activity(
+            object_id=dataset['id'], activity_type='changed package')
+        factories.Subscription(dataset_id=dataset['id'])
+        suppressed = subscribe_notification.metrics['suppressed_activities']
+
+        notifies = get_notifications_by_frequency(
+            [Frequency.IMMEDIATE.value])
+
+        assert _get_activities(notifies[Frequency.IMMEDIATE.value]) == [
+            ('bob@example.com', 'changed package', dataset['id'])]
+        assert subscribe_notification.metrics['suppressed_activities'] == \
+            suppressed + 1
+
+    @pytest.mark.ckan_config('ckanext.subscribe.ignore_activity_from_users',
+                             'harvester')
+    def test_only_activity_by_ignored_users_skips(self):
+        harvester = User(name='harvester')
+        dataset = factories.DatasetActivity(user_id=harvester['id'])
+        factories.Subscription(dataset_id=dataset['id'])
+        skipped_cycles = subscribe_notification.metrics['skipped_cycles']
+
+        notifies = get_notifications_by_frequency(
+            [Frequency.IMMEDIATE.value])
+
+        assert notifies == {}
+        assert subscribe_notification.metrics['skipped_cycles'] == \
+            skipped_cycles + 1
+
+    @pytest.mark.ckan_config('ckanext.subscribe.ignore_activity_from_users',
+                             'harvester')
+    def test_ignored_users_are_cached_once_found(self):
+        # not created yet, so looked for again
+        assert subscribe_notification.get_ignored_user_ids() == []
+        harvester = User(name='harvester')
+        assert subscribe_notification.get_ignored_user_ids() == \
+            [harvester['id']]
+
+        with mock.patch.object(model.Session, 'query') as query:
+            assert subscribe_notification.get_ignored_user_ids() == \
+                [harvester['id']]
+        query.assert_not_called()
+
+
 @pytest.mark.usefixtures('clean_db', 'with_plugins')
 class TestSendAnyImmediateNotifications(object):
 
@@ -83,6 +299,46 @@ class TestGetImmediateNotifications(object):
         assert notifies.keys(), [subscription['email']]
         assert _get_activities(notifies), [('bob@example.com', 'new package', dataset['id'])]
 
+    def test_subscribe_to_an_org_including_child_organizations(self):
+        ministry, dept, unit = Organization(), Organization(), Organization()
+        for parent, child in ((ministry, dept), (dept, unit)):
+            model.Session.add(model.Member(
+                group_id=parent['id'], table_id=child['id'],
+                table_name='group', capacity='parent', state='active'))
+        model.Session.commit()
+        factories.Subscription(organization_id=ministry['id'],
+                               include_child_organizations=True)
+        factories.Subscription(organization_id=ministry['id'],
+                               email='carl@example.com')
+        subscribe_model.Subscribe.set_emails_last_sent(
+            Frequency.IMMEDIATE.value,
+            datetime.datetime.now())
+        dataset = Dataset(owner_org=unit['id'])
+
+        notifies = get_immediate_notifications()
+
+        assert _get_activities(notifies) == [
+            ('bob@example.com', 'new package', dataset['id'])]
+
+    def test_deleted_org_does_not_include_child_organizations(self):
+        ministry, dept = Organization(), Organization()
+        model.Session.add(model.Member(
+            group_id=ministry['id'], table_id=dept['id'],
+            table_name='group', capacity='parent', state='active'))
+        model.Session.commit()
+        factories.Subscription(organization_id=ministry['id'],
+                               include_child_organizations=True)
+        model.Group.get(ministry['id']).state = 'deleted'
+        subscribe_model.Subscribe.set_emails_last_sent(
+            Frequency.IMMEDIATE.value,
+            datetime.datetime.now())
+        model.Session.commit()
+        Dataset(owner_org=dept['id'])
+
+        notifies = get_immediate_notifications()
+
+        assert not _get_activities(notifies)
+
     def test_subscribe_to_an_group_and_its_dataset_has_activity(self):
         group = Group()
         subscription = factories.Subscription(group_id=group['id'])
@@ -168,6 +424,143 @@ class TestGetImmediateNotifications(object):
 
         assert not _get_activities(notifies)
 
+    def test_activity_types_filter(self):
+        dataset = factories.DatasetActivity()
+        factories.Activity(
+            object_id=dataset['id'], activity_type='changed package')
+        factories.Subscription(
+            email='new@example.com', dataset_id=dataset['id'],
+            activity_types=['new package'])
+        factories.Subscription(
+            email='all@example.com', dataset_id=dataset['id'])
+
+        notifies = get_immediate_notifications()
+
+        assert sorted(_get_activities(notifies)) == [
+            ('all@example.com', 'changed package', dataset['id']),
+            ('all@example.com', 'new package', dataset['id']),
+            ('new@example.com', 'new package', dataset['id']),
+        ]
+
+    def test_activity_types_filter_with_no_matching_activity(self):
+        dataset = factories.DatasetActivity()
+        factories.Subscription(dataset_id=dataset['id'],
+                               activity_types=['deleted package'])
+
+        notifies = get_immediate_notifications()
+
+        assert not _get_activities(notifies)
+
+    def test_resource_subscription_only_gets_its_resource_changes(self):
+        dataset = Dataset(resources=[{'url': 'http://x.com/a.csv'},
+                                     {'url': 'http://x.com/b.csv'}])
+        res_a, res_b = dataset['resources']
+        factories.Subscription(resource_id=res_a['id'])
+        subscribe_model.Subscribe.set_emails_last_sent(
+            Frequency.IMMEDIATE.value,
+            datetime.datetime.now())
+        for resources in ([res_a, dict(res_b, description='b')],
+                          [dict(res_a, description='a'),
+                           dict(res_b, description='b')]):
+            model.Session.add(model.Activity(
+                user_id=dataset['creator_user_id'], object_id=dataset['id'],
+                activity_type='changed package',
+                data={'package': dict(dataset, resources=resources)}))
+            model.Session.commit()
+
+        notifies = get_immediate_notifications()
+
+        activities = notifies['bob@example.com'][0]['activities']
+        assert [activity['data']['package']['resources'][0].get('description')
+                for activity in activities] == ['a']
+
+    def test_saved_search_matches_a_changed_dataset(self):
+        org = Organization()
+        factories.Subscription(
+            query='tags:covid organization:{}'.format(org['name']))
+        subscribe_model.Subscribe.set_emails_last_sent(
+            Frequency.IMMEDIATE.value,
+            datetime.datetime.now())
+        dataset = Dataset(owner_org=org['id'], tags=[{'name': 'covid'}])
+        Dataset(owner_org=org['id'], tags=[{'name': 'flu'}])  # decoy
+        Dataset(tags=[{'name': 'covid'}])  # decoy - other org
+
+        notifies = get_immediate_notifications()
+
+        assert _get_activities(notifies) == [
+            ('bob@example.com', 'new package', dataset['id'])]
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+@pytest.mark.ckan_config('ckanext.subscribe.immediate_quiet_period',
+                         '0:10:00')
+class TestDebounceImmediateNotifications(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+        subscribe_notification._config = {}
+
+    def test_busy_object_is_held(self):
+        dataset = factories.DatasetActivity(
+            timestamp=datetime.datetime.now() - datetime.timedelta(minutes=1))
+        factories.Subscription(dataset_id=dataset['id'])
+
+        notifies = get_immediate_notifications()
+
+        assert not _get_activities(notifies)
+        assert subscribe_model.HeldObject.get(dataset['id'])
+
+    def test_quiet_object_is_not_held(self):
+        dataset = factories.DatasetActivity(
+            timestamp=datetime.datetime.now() - datetime.timedelta(minutes=20))
+        factories.Subscription(
+            dataset_id=dataset['id'],
+            created=datetime.datetime.now() - datetime.timedelta(hours=1))
+
+        notifies = get_immediate_notifications()
+
+        assert _get_activities(notifies) == [
+            ('bob@example.com', 'new package', dataset['id'])]
+        assert not subscribe_model.HeldObject.get(dataset['id'])
+
+    def test_held_object_is_released_when_quiet(self):
+        now = datetime.datetime.now()
+        dataset = factories.DatasetActivity(
+            timestamp=now - datetime.timedelta(minutes=1))
+        factories.Subscription(dataset_id=dataset['id'])
+        get_immediate_notifications(now)
+        subscribe_model.Subscribe.set_emails_last_sent(
+            Frequency.IMMEDIATE.value, now)
+        model.Session.commit()
+
+        notifies = get_immediate_notifications(
+            now + datetime.timedelta(minutes=15))
+
+        assert _get_activities(notifies) == [
+            ('bob@example.com', 'new package', dataset['id'])]
+        assert not subscribe_model.HeldObject.get(dataset['id'])
+
+    def test_held_object_is_released_after_max_hold(self):
+        now = datetime.datetime.now()
+        dataset = factories.DatasetActivity(
+            timestamp=now - datetime.timedelta(minutes=1))
+        factories.Subscription(
+            dataset_id=dataset['id'],
+            created=now - datetime.timedelta(hours=3))
+        model.Session.add(subscribe_model.HeldObject(
+            object_id=dataset['id'],
+            activity_from=now - datetime.timedelta(hours=2),
+            first_activity=now - datetime.timedelta(hours=2),
+            last_activity=now - datetime.timedelta(minutes=5),
+        ))
+        model.Session.commit()
+
+        notifies = get_immediate_notifications(now)
+
+        assert _get_activities(notifies) == [
+            ('bob@example.com', 'new package', dataset['id'])]
+
 
 def _create_dataset_and_activity(activity_in_minutes_ago=()):
     minutes_ago = activity_in_minutes_ago.pop(0)
@@ -271,6 +664,68 @@ class TestGetWeeklyNotifications(object):
 
         assert not _get_activities(notifies)
 
+    def test_activity_is_summarised(self):
+        dataset = factories.DatasetActivity()
+        factories.Activity(
+            object_id=dataset['id'], activity_type='changed package')
+        factories.Activity(
+            object_id=dataset['id'], activity_type='changed package')
+        factories.Subscription(dataset_id=dataset['id'], frequency='weekly')
+
+        notifies = get_weekly_notifications()
+
+        activities = notifies['bob@example.com'][0]['activities']
+        assert sorted((a['activity_type'], a['activity_count'])
+                      for a in activities) == \
+            [('changed package', 2), ('new package', 1)]
+        assert activities[0]['data']['package']['id'] == dataset['id']
+
+    def test_partial_days_are_not_taken_from_the_summaries(self):
+        # the window starts part way through a summary day (which starts at
+        # 9am), e.g. for a subscription in another time zone
+        window_start = datetime.datetime.combine(
+            datetime.date.today() - datetime.timedelta(days=3),
+            datetime.time(15, 0))
+        dataset = factories.DatasetActivity(
+            timestamp=window_start - datetime.timedelta(hours=2))
+        factories.Activity(
+            object_id=dataset['id'], activity_type='changed package',
+            timestamp=window_start - datetime.timedelta(hours=1))
+        factories.Activity(
+            object_id=dataset['id'], activity_type='changed package',
+            timestamp=window_start + datetime.timedelta(hours=1))
+        factories.Subscription(
+            dataset_id=dataset['id'], frequency='weekly',
+            created=window_start - datetime.timedelta(days=1))
+        subscribe_model.Subscribe.set_emails_last_sent(
+            frequency=Frequency.WEEKLY.value, emails_last_sent=window_start)
+        model.Session.commit()
+
+        notifies = get_weekly_notifications()
+
+        activities = notifies['bob@example.com'][0]['activities']
+        assert [(a['activity_type'], a['activity_count'])
+                for a in activities] == [('changed package', 1)]
+
+    def test_subscription_created_part_way_through_a_summary_day(self):
+        # a summary day starts at 9am
+        day = datetime.datetime.combine(
+            datetime.date.today() - datetime.timedelta(days=3),
+            datetime.time(10, 0))
+        dataset = factories.DatasetActivity(timestamp=day)
+        for hours in (0.5, 2, 3):
+            factories.Activity(
+                object_id=dataset['id'], activity_type='changed package',
+                timestamp=day + datetime.timedelta(hours=hours))
+        factories.Subscription(dataset_id=dataset['id'], frequency='weekly',
+                               created=day + datetime.timedelta(hours=1))
+
+        notifies = get_weekly_notifications()
+
+        activities = notifies['bob@example.com'][0]['activities']
+        assert [(a['activity_type'], a['activity_count'])
+                for a in activities] == [('changed package', 2)]
+
     def test_activities_older_than_a_week_are_not_notified(self):
         dataset = factories.DatasetActivity(
             timestamp=datetime.datetime.now() - datetime.timedelta(days=8))
@@ -296,6 +751,64 @@ class TestGetWeeklyNotifications(object):
         assert not _get_activities(notifies)
 
 
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestSummariseActivity(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+        subscribe_notification._config = {}
+
+    def test_basic(self):
+        dataset = factories.DatasetActivity()
+        factories.Activity(
+            object_id=dataset['id'], activity_type='changed package')
+        factories.Activity(
+            object_id=dataset['id'], activity_type='changed package')
+
+        summarise_activity()
+
+        assert _get_summary_counts(dataset['id']) == \
+            [('changed package', 2), ('new package', 1)]
+
+    def test_incremental(self):
+        dataset = factories.DatasetActivity()
+        summarise_activity()
+        factories.Activity(
+            object_id=dataset['id'], activity_type='changed package')
+        factories.Activity(
+            object_id=dataset['id'], activity_type='changed package')
+
+        summarise_activity()
+
+        assert _get_summary_counts(dataset['id']) == \
+            [('changed package', 2), ('new package', 1)]
+
+    def test_not_summarised_unless_a_summarised_frequency_is_due(self):
+        dataset = factories.DatasetActivity()
+        factories.Subscription(dataset_id=dataset['id'])
+
+        get_immediate_notifications()
+
+        assert _get_summary_counts(dataset['id']) == []
+
+    def test_old_activity_is_not_summarised(self):
+        dataset = factories.DatasetActivity(
+            timestamp=datetime.datetime.now() - datetime.timedelta(days=30))
+
+        summarise_activity()
+
+        assert _get_summary_counts(dataset['id']) == []
+
+
+def _get_summary_counts(object_id):
+    return [
+        (summary.activity_type, summary.activity_count)
+        for summary in model.Session.query(subscribe_model.ActivitySummary)
+        .filter_by(object_id=object_id)
+        .order_by(subscribe_model.ActivitySummary.activity_type)]
+
+
 @pytest.mark.usefixtures('clean_db', 'with_plugins')
 class TestSendDailyNotificationsIfItsTimeTo(object):
 
@@ -423,12 +936,260 @@ class TestMostRecentWeeklyNotification(object):
                datetime.datetime(2020, 1, 24, 10, 0)), datetime.datetime(2020, 1, 24, 9, 0)  # a friday
 
 
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestIsItTimeToSend(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+        subscribe_notification._config = {}
+
+    def test_never_sent(self):
+        assert is_it_time_to_send(Frequency.MONTHLY.value)
+
+    def test_hourly(self):
+        subscribe_model.Subscribe.set_emails_last_sent(
+            Frequency.HOURLY.value, datetime.datetime(2020, 1, 24, 9, 0))
+        model.Session.commit()
+
+        assert not is_it_time_to_send(Frequency.HOURLY.value,
+                                      datetime.datetime(2020, 1, 24, 9, 59))
+        assert is_it_time_to_send(Frequency.HOURLY.value,
+                                  datetime.datetime(2020, 1, 24, 10, 0))
+
+    def test_monthly(self):
+        subscribe_model.Subscribe.set_emails_last_sent(
+            Frequency.MONTHLY.value, datetime.datetime(2020, 1, 1, 9, 0))
+        model.Session.commit()
+
+        assert not is_it_time_to_send(Frequency.MONTHLY.value,
+                                      datetime.datetime(2020, 1, 31, 23, 0))
+        assert is_it_time_to_send(Frequency.MONTHLY.value,
+                                  datetime.datetime(2020, 2, 1, 9, 0))
+
+    @pytest.mark.ckan_config('ckanext.subscribe.schedule.hourly',
+                             '*/15 * * * *')
+    def test_custom_schedule(self):
+        subscribe_model.Subscribe.set_emails_last_sent(
+            Frequency.HOURLY.value, datetime.datetime(2020, 1, 24, 9, 0))
+        model.Session.commit()
+
+        assert is_it_time_to_send(Frequency.HOURLY.value,
+                                  datetime.datetime(2020, 1, 24, 9, 15))
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestGetNextDueDatetime(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+        subscribe_notification._config = {}
+
+    @pytest.mark.ckan_config('ckanext.subscribe.schedule.hourly',
+                             '30 * * * *')
+    def test_scheduled(self):
+        assert get_next_due_datetime(datetime.datetime(2020, 1, 24, 9, 0)) \
+            == datetime.datetime(2020, 1, 24, 9, 30)
+
+    def test_retry(self):
+        now = datetime.datetime(2020, 1, 24, 9, 0)
+        subscribe_model.Delivery.record_failed(
+            'immediate test', 'a@a.com', 'message', 'deferred',
+            now + datetime.timedelta(minutes=5))
+        model.Session.commit()
+
+        assert get_next_due_datetime(now) == \
+            now + datetime.timedelta(minutes=5)
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestTimezones(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+        subscribe_notification._config = {}
+
+    def test_is_it_time_to_send_in_a_timezone(self):
+        # New York is UTC-5 in January, so 9am there is 2pm UTC
+        subscribe_model.Subscribe.set_emails_last_sent(
+            Frequency.DAILY.value, datetime.datetime(2020, 1, 23, 14, 0),
+            timezone='America/New_York')
+        model.Session.commit()
+
+        assert not is_it_time_to_send(Frequency.DAILY.value,
+                                      datetime.datetime(2020, 1, 24, 9, 0),
+                                      timezone='America/New_York')
+        assert is_it_time_to_send(Frequency.DAILY.value,
+                                  datetime.datetime(2020, 1, 24, 14, 0),
+                                  timezone='America/New_York')
+
+    def test_buckets_are_recorded_separately(self):
+        subscribe_model.Subscribe.set_emails_last_sent(
+            Frequency.DAILY.value, datetime.datetime(2020, 1, 24, 9, 0))
+        model.Session.commit()
+
+        assert not is_it_time_to_send(Frequency.DAILY.value,
+                                      datetime.datetime(2020, 1, 24, 10, 0))
+        assert is_it_time_to_send(Frequency.DAILY.value,
+                                  datetime.datetime(2020, 1, 24, 10, 0),
+                                  timezone='Asia/Tokyo')
+
+    def test_subscriptions_are_only_in_their_bucket(self):
+        dataset = factories.DatasetActivity()
+        factories.Subscription(dataset_id=dataset['id'], frequency='daily',
+                               email='ny@example.com',
+                               timezone='America/New_York')
+        factories.Subscription(dataset_id=dataset['id'], frequency='daily',
+                               email='utc@example.com')
+
+        default_bucket = get_notifications_by_frequency(
+            [Frequency.DAILY.value])
+        new_york_bucket = get_notifications_by_frequency(
+            [Frequency.DAILY.value], timezone='America/New_York')
+
+        assert list(default_bucket[Frequency.DAILY.value].keys()) == \
+            ['utc@example.com']
+        assert list(new_york_bucket[Frequency.DAILY.value].keys()) == \
+            ['ny@example.com']
+
+    def test_immediate_subscriptions_ignore_timezone(self):
+        dataset = factories.DatasetActivity()
+        factories.Subscription(dataset_id=dataset['id'],
+                               timezone='America/New_York')
+
+        notifies = get_immediate_notifications()
+
+        assert _get_activities(notifies) == [
+            ('bob@example.com', 'new package', dataset['id'])]
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestGetHourlyAndMonthlyNotifications(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+        subscribe_notification._config = {}
+
+    def test_hourly(self):
+        dataset = factories.DatasetActivity(
+            timestamp=datetime.datetime.now() - datetime.timedelta(minutes=30))
+        factories.Subscription(dataset_id=dataset['id'], frequency='hourly',
+                               created=datetime.datetime.now() -
+                               datetime.timedelta(hours=2))
+
+        notifies = get_notifications(Frequency.HOURLY.value)
+
+        assert _get_activities(notifies) == [
+            ('bob@example.com', 'new package', dataset['id'])]
+
+    def test_monthly_is_summarised(self):
+        dataset = factories.DatasetActivity(
+            timestamp=datetime.datetime.now() - datetime.timedelta(days=20))
+        factories.Activity(
+            object_id=dataset['id'], activity_type='changed package',
+            timestamp=datetime.datetime.now() - datetime.timedelta(days=10))
+        factories.Activity(
+            object_id=dataset['id'], activity_type='changed package',
+            timestamp=datetime.datetime.now() - datetime.timedelta(days=10))
+        factories.Subscription(dataset_id=dataset['id'], frequency='monthly',
+                               created=datetime.datetime.now() -
+                               datetime.timedelta(days=40))
+
+        notifies = get_notifications(Frequency.MONTHLY.value)
+
+        activities = notifies['bob@example.com'][0]['activities']
+        assert sorted((activity['activity_type'], activity['activity_count'])
+                      for activity in activities) == \
+            [('changed package', 2), ('new package', 1)]
+
+
+class TestGetSendSlot(object):
+
+    def test_stable_and_in_range(self):
+        slots = [get_send_slot('user{}@example.com'.format(i), 10)
+                 for i in range(100)]
+
+        assert slots == [get_send_slot('user{}@example.com'.format(i), 10)
+                         for i in range(100)]
+        assert set(slots) == set(range(10))
+
+    def test_case_insensitive(self):
+        assert get_send_slot('Bob@Example.com', 60) == \
+            get_send_slot('bob@example.com', 60)
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+@pytest.mark.ckan_config('ckanext.subscribe.send_window', '1:00:00')
+@pytest.mark.ckan_config('ckanext.subscribe.send_window_slots', '4')
+@pytest.mark.ckan_config('ckanext.subscribe.schedule.daily', '0 9 * * *')
+class TestSendWindow(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+        subscribe_notification._config = {}
+
+    def test_get_send_window(self):
+        cycle = datetime.datetime(2020, 1, 24, 9, 0)
+
+        assert get_send_window(Frequency.DAILY.value,
+                               datetime.datetime(2020, 1, 24, 9, 20)) == \
+            (cycle, 0, 2)
+        assert get_send_window(Frequency.DAILY.value,
+                               datetime.datetime(2020, 1, 24, 11, 0)) == \
+            (cycle, 0, 4)
+        # immediate and hourly notifications are not spread out
+        assert get_send_window(Frequency.IMMEDIATE.value,
+                               datetime.datetime(2020, 1, 24, 9, 20)) is None
+        assert get_send_window(Frequency.HOURLY.value,
+                               datetime.datetime(2020, 1, 24, 9, 20)) is None
+
+    @mock.patch('ckanext.subscribe.notification_email.send_notification_email')
+    def test_slots_are_sent_once(self, send_notification_email):
+        cycle = datetime.datetime(2020, 1, 24, 9, 0)
+        notifications_by_email = dict(
+            ('user{}@example.com'.format(i), ['notification'])
+            for i in range(20))
+
+        def emails_in_slots(first_slot, end_slot):
+            return set(email for email in notifications_by_email
+                       if first_slot <= get_send_slot(email, 4) < end_slot)
+
+        def emails_sent():
+            return set(call[0][1]
+                       for call in send_notification_email.call_args_list)
+
+        send_emails_in_slots(Frequency.DAILY.value, notifications_by_email,
+                             (cycle, 0, 2))
+
+        assert emails_sent() == emails_in_slots(0, 2)
+        assert subscribe_model.Subscribe.get_send_window_progress(
+            Frequency.DAILY.value) == (cycle, 2)
+        assert get_send_window(Frequency.DAILY.value,
+                               datetime.datetime(2020, 1, 24, 9, 50)) == \
+            (cycle, 2, 4)
+
+        send_notification_email.reset_mock()
+        send_emails_in_slots(Frequency.DAILY.value, notifications_by_email,
+                             (cycle, 2, 4))
+
+        assert emails_sent() == emails_in_slots(2, 4)
+        assert subscribe_model.Subscribe.get_send_window_progress(
+            Frequency.DAILY.value) == (None, 0)
+        assert subscribe_model.Subscribe.get_emails_last_sent(
+            Frequency.DAILY.value) == cycle
+
+
 @pytest.mark.usefixtures('clean_db', 'with_plugins')
 class TestSendEmails(object):
 
     def setup(self):
         helpers.reset_db()
         subscribe_model.setup()
+        subscribe_notification._config = {}
 
     @mock.patch('ckanext.subscribe.mailer.mail_recipient')
     def test_basic(self, mail_recipient):
@@ -452,6 +1213,205 @@ class TestSendEmails(object):
         body = mail_recipient.call_args[1]['body']
         assert 'new dataset' in body
 
+    @mock.patch('ckanext.subscribe.notification_email.send_notification_email')
+    def test_failure_doesnt_stop_the_others(self, send_notification_email):
+        send_notification_email.side_effect = [MailerException('deferred'),
+                                               0.5]
+        failed_emails = subscribe_notification.metrics['failed_emails']
+        sent_emails = subscribe_notification.metrics['sent_emails']
+
+        send_emails({'ann@example.com': [], 'bob@example.com': []})
+
+        assert send_notification_email.call_count == 2
+        assert subscribe_notification.metrics['failed_emails'] == \
+            failed_emails + 1
+        assert subscribe_notification.metrics['sent_emails'] == \
+            sent_emails + 1
+
+    @pytest.mark.ckan_config('ckanext.subscribe.mail_concurrency', '4')
+    @mock.patch('ckanext.subscribe.notification_email.'
+                'create_notification_email')
+    @mock.patch('ckanext.subscribe.mailer.send_message')
+    def test_concurrent(self, send_message, create_notification_email):
+        emails = ['{}@example.com'.format(i) for i in range(20)]
+
+        send_emails(dict((email, []) for email in emails))
+
+        assert sorted(call[0][1] for call in send_message.call_args_list) == \
+            sorted(emails)
+
+    @mock.patch('ckanext.subscribe.notification.get_transport')
+    @mock.patch('ckanext.subscribe.notification_email.'
+                'create_notification_email')
+    @mock.patch('ckanext.subscribe.mailer.send_batch')
+    def test_batched(self, send_batch, create_notification_email,
+                     get_transport):
+        get_transport.return_value.batch_size = 2
+        send_batch.side_effect = lambda batch: [
+            (0.0, MailerException('bounced') if email == 'ann@example.com'
+             else None)
+            for _, email in batch]
+        emails = ['{}@example.com'.format(name)
+                  for name in ('ann', 'bob', 'cat')]
+        failed_emails = subscribe_notification.metrics['failed_emails']
+        sent_emails = subscribe_notification.metrics['sent_emails']
+
+        send_emails(dict((email, []) for email in emails))
+
+        assert [len(call[0][0]) for call in send_batch.call_args_list] == \
+            [2, 1]
+        assert subscribe_notification.metrics['failed_emails'] == \
+            failed_emails + 1
+        assert subscribe_notification.metrics['sent_emails'] == \
+            sent_emails + 2
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestDeliveryLedger(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+        subscribe_notification._config = {}
+
+    @mock.patch('ckanext.subscribe.notification_email.send_notification_email')
+    def test_resumed_run_skips_emails_already_sent(self,
+                                                   send_notification_email):
+        dataset = factories.DatasetActivity(
+            timestamp=datetime.datetime.now() - datetime.timedelta(minutes=10))
+        factories.Subscription(dataset_id=dataset['id'], email='a@a.com')
+        factories.Subscription(dataset_id=dataset['id'], email='b@a.com')
+        # a run that was interrupted after emailing a@a.com
+        run_datetime = datetime.datetime.now() - datetime.timedelta(minutes=1)
+        subscribe_model.Subscribe.set_emails_last_sent(
+            Frequency.IMMEDIATE.value,
+            datetime.datetime.now() - datetime.timedelta(hours=1))
+        subscribe_model.Subscribe.set_run_in_progress(
+            Frequency.IMMEDIATE.value, run_datetime)
+        run = get_run_key(Frequency.IMMEDIATE.value, run_datetime)
+        subscribe_model.Delivery.record_sent(run, 'a@a.com')
+        model.Session.commit()
+
+        send_any_immediate_notifications()
+
+        emails = [call[0][1] for call in send_notification_email.call_args_list]
+        assert emails == ['b@a.com']
+        assert subscribe_model.Subscribe.get_emails_last_sent(
+            Frequency.IMMEDIATE.value) == run_datetime
+        assert subscribe_model.Subscribe.get_run_in_progress(
+            Frequency.IMMEDIATE.value) is None
+        assert not subscribe_model.Delivery.get_emails(run)
+
+    @mock.patch('ckanext.subscribe.notification_email.'
+                'create_notification_email')
+    @mock.patch('ckanext.subscribe.notification_email.send_notification_email')
+    def test_failed_email_is_retried(self, send_notification_email,
+                                     create_notification_email):
+        send_notification_email.side_effect = [MailerException('deferred'),
+                                               0]
+        create_notification_email.return_value = MIMEText('notification')
+
+        send_emails({'a@a.com': [], 'b@a.com': []}, run='immediate test')
+
+        retries = subscribe_model.Delivery.get_retries_due(
+            datetime.datetime.now() + datetime.timedelta(minutes=5))
+        assert len(retries) == 1
+        email = retries[0].email
+
+        with mock.patch('ckanext.subscribe.mailer.resend_message') \
+                as resend_message:
+            # not due yet
+            retry_failed_deliveries()
+            assert not resend_message.called
+
+            retry_failed_deliveries(
+                datetime.datetime.now() + datetime.timedelta(minutes=5))
+        resend_message.assert_called_once()
+        assert resend_message.call_args[0][1] == email
+        assert not subscribe_model.Delivery.get_retries_due(
+            datetime.datetime.now() + datetime.timedelta(days=1))
+
+    @pytest.mark.ckan_config('ckanext.subscribe.delivery_max_attempts', '2')
+    @mock.patch('ckanext.subscribe.mailer.resend_message')
+    def test_gives_up_after_max_attempts(self, resend_message):
+        resend_message.side_effect = MailerException('bounced')
+        now = datetime.datetime.now()
+        subscribe_model.Delivery.record_failed(
+            'immediate test', 'a@a.com', 'message', 'deferred', now)
+        model.Session.commit()
+
+        retry_failed_deliveries(now)
+
+        assert not subscribe_model.Delivery.get_retries_due(
+            now + datetime.timedelta(days=1))
+        assert not subscribe_model.Delivery.get_emails('immediate test')
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestWebhooks(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+        subscribe_notification._config = {}
+
+    @mock.patch('ckanext.subscribe.webhook.get_sender')
+    @mock.patch('ckanext.subscribe.notification_email.send_notification_email')
+    def test_webhook_instead_of_email(self, send_notification_email,
+                                      get_sender):
+        get_sender.return_value.post_many.side_effect = \
+            lambda webhooks: [None] * len(webhooks)
+        dataset = factories.DatasetActivity(
+            timestamp=datetime.datetime.now() - datetime.timedelta(minutes=10))
+        subscription = factories.Subscription(
+            dataset_id=dataset['id'], email='bot@example.com',
+            webhook_url='https://example.com/hook',
+            webhook_secret='0123456789abcdef')
+        factories.Subscription(dataset_id=dataset['id'],
+                               email='bob@example.com')
+        sent_webhooks = subscribe_notification.metrics['sent_webhooks']
+
+        send_any_immediate_notifications()
+
+        emails = [call[0][1] for call in send_notification_email.call_args_list]
+        assert emails == ['bob@example.com']
+        webhooks = get_sender.return_value.post_many.call_args[0][0]
+        assert len(webhooks) == 1
+        url, secret, body = webhooks[0]
+        assert url == 'https://example.com/hook'
+        assert secret == '0123456789abcdef'
+        payload = json.loads(body)
+        assert payload['subscription']['id'] == subscription['id']
+        assert 'webhook_secret' not in payload['subscription']
+        assert payload['activities'][0]['activity_type'] == 'new package'
+        assert subscribe_notification.metrics['sent_webhooks'] == \
+            sent_webhooks + 1
+
+    @mock.patch('ckanext.subscribe.webhook.get_sender')
+    def test_failed_webhook_is_retried(self, get_sender):
+        get_sender.return_value.post_many.return_value = \
+            [WebhookError('410 Gone')]
+        subscription = factories.Subscription(
+            webhook_url='https://example.com/hook', return_object=True)
+        notification = {'subscription': {'id': subscription.id,
+                                         'webhook_url': subscription.webhook_url},
+                        'activities': []}
+
+        send_emails({'bob@example.com': [notification]}, run='immediate test')
+
+        retry_time = datetime.datetime.now() + datetime.timedelta(minutes=5)
+        retries = subscribe_model.Delivery.get_retries_due(retry_time)
+        assert [retry.email for retry in retries] == \
+            ['webhook:' + subscription.id]
+
+        retry_failed_deliveries(retry_time)
+
+        get_sender.return_value.post.assert_called_once_with(
+            subscription.webhook_url, subscription.webhook_secret,
+            retries[0].message)
+        assert not subscribe_model.Delivery.get_retries_due(
+            retry_time + datetime.timedelta(days=1))
+
 
 def time_since_emails_last_sent(frequency):
     return (datetime.datetime.now() -
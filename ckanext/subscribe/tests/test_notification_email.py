@@ -16,6 +16,7 @@ from ckanext.subscribe.notification_email import (
     send_notification_email,
     get_notification_email_contents,
     get_notification_email_vars,
+    coalesce_activities,
     dataset_link_from_activity,
     dataset_href_from_activity,
 )
@@ -123,6 +124,7 @@ class TestGetNotificationEmailVars(SubscribeBase):
         assert email_vars['notifications'] == [{
             'activities': [{
                'activity_type': 'new dataset',
+               'activity_count': 1,
                'dataset_href': '{}/dataset/{}'
                .format(config.get('ckan.site_url'), dataset['name']),
                'dataset_link': literal(
@@ -132,7 +134,9 @@ class TestGetNotificationEmailVars(SubscribeBase):
             'object_link': '{}/dataset/{}'.format(config.get('ckan.site_url'), dataset['id']),
             'object_name': dataset['name'],
             'object_title': dataset['title'],
-            'object_type': 'dataset'}]
+            'object_type': 'dataset',
+            'more_count': 0,
+            'more_link': ''}]
 
     def test_group(self):
         group, activity = factories.GroupActivity(
@@ -154,13 +158,16 @@ class TestGetNotificationEmailVars(SubscribeBase):
         assert email_vars['notifications'] == [{
             'activities': [
                 {'activity_type': 'new group',
+                 'activity_count': 1,
                  'dataset_href': '',
                  'dataset_link': '',
                  'timestamp': activity.timestamp}],
             'object_link': '{}/group/{}'.format(config.get('ckan.site_url'), group['id']),
             'object_name': group['name'],
             'object_title': group['title'],
-            'object_type': 'group'}]
+            'object_type': 'group',
+            'more_count': 0,
+            'more_link': ''}]
 
     def test_org(self):
         org, activity = factories.OrganizationActivity(
@@ -181,13 +188,16 @@ class TestGetNotificationEmailVars(SubscribeBase):
 
         assert email_vars['notifications'] == [{
             'activities': [{'activity_type': 'new organization',
+                            'activity_count': 1,
                             'dataset_href': '',
                             'dataset_link': '',
                             'timestamp': activity.timestamp}],
             'object_link': '{}/organization/{}'.format(config.get('ckan.site_url'), org['id']),
             'object_name': org['name'],
             'object_title': org['title'],
-            'object_type': 'organization'}]
+            'object_type': 'organization',
+            'more_count': 0,
+            'more_link': ''}]
 
 
 # sample "changed package" activity for ckan 2.8
@@ -262,6 +272,51 @@ CUSTOM_ACTIVITY = {
 }
 
 
+class TestCoalesceActivities(object):
+    def test_basic(self):
+        earlier = datetime.datetime(2020, 1, 1, 9, 0)
+        later = datetime.datetime(2020, 1, 1, 10, 0)
+        activities = [
+            {'activity_type': 'changed dataset', 'activity_count': 1,
+             'dataset_href': 'x', 'timestamp': earlier},
+            {'activity_type': 'new dataset', 'activity_count': 1,
+             'dataset_href': 'y', 'timestamp': earlier},
+            {'activity_type': 'changed dataset', 'activity_count': 3,
+             'dataset_href': 'x', 'timestamp': later},
+        ]
+
+        assert coalesce_activities(activities) == [
+            {'activity_type': 'changed dataset', 'activity_count': 4,
+             'dataset_href': 'x', 'timestamp': later},
+            {'activity_type': 'new dataset', 'activity_count': 1,
+             'dataset_href': 'y', 'timestamp': earlier},
+        ]
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestMaxLinesPerEmail(object):
+    @pytest.mark.ckan_config('ckanext.subscribe.max_lines_per_email', '1')
+    def test_truncated(self):
+        subscription = {'object_type': 'dataset', 'object_id': 'dataset-id'}
+        activities = [
+            dict(CHANGED_PACKAGE_ACTIVITY),
+            dict(CHANGED_PACKAGE_ACTIVITY, activity_type='deleted package'),
+            dict(CHANGED_PACKAGE_ACTIVITY, activity_type='deleted package'),
+        ]
+
+        email_vars = get_notification_email_vars(
+            email='bob@example.com',
+            notifications=[{'subscription': subscription,
+                            'activities': activities}])
+
+        notification = email_vars['notifications'][0]
+        assert [activity['activity_type']
+                for activity in notification['activities']] == \
+            ['changed dataset']
+        assert notification['more_count'] == 2
+        assert notification['more_link'].endswith('/dataset-id')
+
+
 @pytest.mark.usefixtures('clean_db', 'with_plugins')
 class TestDatasetLinkFromActivity(object):
 
@@ -0,0 +1,88 @@
+# encoding: utf-8
+
+import pytest
+
+from ckanext.subscribe.ratelimit import (
+    TokenBucket,
+    RateLimiter,
+    parse_domain_rates,
+)
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTokenBucket(object):
+
+    def test_burst_then_steady_rate(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=2, capacity=2, clock=clock)
+
+        assert [bucket.reserve() for _ in range(5)] == \
+            [0.0, 0.0, 0.5, 1.0, 1.5]
+
+    def test_refills_up_to_capacity(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=2, capacity=2, clock=clock)
+        bucket.reserve()
+        bucket.reserve()
+
+        clock.now = 100.0
+
+        assert [bucket.reserve() for _ in range(3)] == [0.0, 0.0, 0.5]
+
+
+class TestRateLimiter(object):
+
+    def test_unlimited(self):
+        sleeps = []
+        limiter = RateLimiter(sleep=sleeps.append)
+
+        for _ in range(10):
+            assert limiter.acquire('bob@example.com') == 0
+            limiter.release('bob@example.com')
+
+        assert sleeps == []
+
+    def test_domain_rates(self):
+        sleeps = []
+        limiter = RateLimiter(
+            domain_rates={'gmail.com': 1, '*': 100}, sleep=sleeps.append)
+
+        waits = [limiter.acquire('bob@gmail.com') for _ in range(3)]
+
+        assert waits == [0.0, pytest.approx(1.0, abs=0.1),
+                         pytest.approx(2.0, abs=0.1)]
+        # other domains have their own bucket
+        assert limiter.acquire('bob@example.com') == 0
+        assert limiter.acquire('ann@GMAIL.COM') > 2
+
+    def test_domain_concurrency(self):
+        limiter = RateLimiter(domain_concurrency=1)
+
+        limiter.acquire('bob@gmail.com')
+        # another domain isn't held up
+        limiter.acquire('bob@example.com')
+        limiter.release('bob@gmail.com')
+        limiter.acquire('ann@gmail.com')
+
+        assert limiter.domain_semaphores['gmail.com'].acquire(False) is False
+
+
+class TestParseDomainRates(object):
+
+    def test_basic(self):
+        assert parse_domain_rates('gmail.com:5, Outlook.com:2.5 *:10') == \
+            {'gmail.com': 5.0, 'outlook.com': 2.5, '*': 10.0}
+
+    def test_empty(self):
+        assert parse_domain_rates('') == {}
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            parse_domain_rates('gmail.com')
@@ -0,0 +1,112 @@
+# encoding: utf-8
+
+import datetime
+
+import pytest
+
+from ckan import model
+from ckan.tests import helpers
+from ckan.tests.factories import Dataset, User
+
+from ckanext.subscribe import model as subscribe_model
+from ckanext.subscribe.resource_activity import (
+    ChangedResources,
+    get_changed_resource_ids,
+)
+
+
+class TestGetChangedResourceIds(object):
+
+    def test_added_removed_and_changed(self):
+        old = {'a': {'id': 'a', 'url': 'x'},
+               'b': {'id': 'b', 'url': 'x'},
+               'c': {'id': 'c', 'url': 'x'}}
+        new = {'a': {'id': 'a', 'url': 'x'},
+               'c': {'id': 'c', 'url': 'y'},
+               'd': {'id': 'd', 'url': 'x'}}
+
+        assert get_changed_resource_ids(old, new) == \
+            frozenset(['b', 'c', 'd'])
+
+    def test_reordering_is_not_a_change(self):
+        old = {'a': {'id': 'a', 'position': 0},
+               'b': {'id': 'b', 'position': 1}}
+        new = {'a': {'id': 'a', 'position': 1},
+               'b': {'id': 'b', 'position': 0}}
+
+        assert get_changed_resource_ids(old, new) == frozenset()
+
+
+def _create_activity(dataset, activity_type, resources, minutes_ago,
+                     user_id=None):
+    activity = model.Activity(
+        user_id=user_id or dataset['creator_user_id'],
+        object_id=dataset['id'],
+        activity_type=activity_type,
+        data={'package': dict(dataset, resources=resources)})
+    activity.timestamp = datetime.datetime.now() - \
+        datetime.timedelta(minutes=minutes_ago)
+    model.Session.add(activity)
+    model.Session.commit()
+    return activity
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestChangedResources(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+
+    def test_basic(self):
+        dataset = Dataset()
+        res_a = {'id': 'res-a', 'url': 'http://x.com/a.csv'}
+        res_b = {'id': 'res-b', 'url': 'http://x.com/b.csv'}
+        res_b_changed = dict(res_b, description='new')
+        new = _create_activity(dataset, 'new package', [res_a, res_b], 30)
+        changed_b = _create_activity(
+            dataset, 'changed package', [res_a, res_b_changed], 20)
+        changed_notes = _create_activity(
+            dataset, 'changed package', [res_a, res_b_changed], 10)
+        deleted = _create_activity(
+            dataset, 'deleted package', [res_a, res_b_changed], 5)
+
+        changed_resources = ChangedResources()
+        # the previous activity (new) is fetched
+        changed_resources.extract([changed_b, changed_notes, deleted])
+
+        assert changed_resources.get(changed_b) == frozenset(['res-b'])
+        assert changed_resources.get(changed_notes) == frozenset()
+        assert changed_resources.get(deleted) == frozenset(['res-a', 'res-b'])
+        assert changed_resources.get(new) == frozenset(['res-a', 'res-b'])
+
+    def test_activity_not_given_in_between(self):
+        # e.g. a harvester's edit, left out with ignore_activity_from_users
+        dataset = Dataset()
+        harvester = User()
+        res_a = {'id': 'res-a', 'url': 'http://x.com/a.csv'}
+        res_b = {'id': 'res-b', 'url': 'http://x.com/b.csv'}
+        res_a_changed = dict(res_a, description='new')
+        res_b_changed = dict(res_b, description='new')
+        _create_activity(dataset, 'new package', [res_a, res_b], 30)
+        changed_a = _create_activity(
+            dataset, 'changed package', [res_a_changed, res_b], 20)
+        _create_activity(
+            dataset, 'changed package', [res_a_changed, res_b_changed], 15,
+            user_id=harvester['id'])
+        changed_notes = _create_activity(
+            dataset, 'changed package', [res_a_changed, res_b_changed], 10)
+
+        changed_resources = ChangedResources()
+        changed_resources.extract([changed_a, changed_notes])
+
+        assert changed_resources.get(changed_a) == frozenset(['res-a'])
+        # the harvester changed res-b, not this activity
+        assert changed_resources.get(changed_notes) == frozenset()
+
+    def test_no_data(self):
+        dataset = Dataset()
+        activity = _create_activity(dataset, 'changed package', [], 5)
+        activity.data = None
+
+        assert ChangedResources().get(activity) is None
@@ -0,0 +1,109 @@
+# encoding: utf-8
+
+import pytest
+
+from ckan.tests import helpers
+from ckan.tests.factories import Dataset, Organization, Group
+
+from ckanext.subscribe import model as subscribe_model
+from ckanext.subscribe.saved_search import (
+    parse_query,
+    format_query,
+    get_query_title,
+    match_datasets,
+)
+from ckanext.subscribe.tests import factories
+
+
+class TestParseQuery(object):
+
+    def test_basic(self):
+        assert parse_query('tags:covid res_format:CSV') == \
+            [('res_format', 'CSV'), ('tags', 'covid')]
+
+    def test_quoted_and_duplicate(self):
+        assert parse_query('tags:"covid 19" tags:"covid 19"') == \
+            [('tags', 'covid 19')]
+
+    @pytest.mark.parametrize('query', [
+        '', '  ', 'covid', 'author:bob', 'tags:', 'tags:"covid',
+    ])
+    def test_invalid(self, query):
+        with pytest.raises(ValueError):
+            parse_query(query)
+
+    def test_format_round_trip(self):
+        query = format_query(parse_query('tags:"covid 19" groups:health'))
+
+        assert query == 'groups:health tags:"covid 19"'
+        assert format_query(parse_query(query)) == query
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestMatchDatasets(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+
+    def test_all_terms_must_match(self):
+        org = Organization()
+        subscription = factories.Subscription(
+            query='tags:covid res_format:csv organization:{}'
+            .format(org['name']))
+        dataset = Dataset(owner_org=org['id'], tags=[{'name': 'covid'}],
+                          resources=[{'url': 'http://x.com/a.csv',
+                                      'format': 'CSV'}])
+        no_csv = Dataset(owner_org=org['id'], tags=[{'name': 'covid'}])
+        other_org = Dataset(tags=[{'name': 'covid'}],
+                            resources=[{'url': 'http://x.com/a.csv',
+                                        'format': 'CSV'}])
+
+        matches = match_datasets([dataset['id'], no_csv['id'],
+                                  other_org['id']])
+
+        assert [(sub.id, package_id) for sub, package_id in matches] == \
+            [(subscription['id'], dataset['id'])]
+
+    def test_group(self):
+        group = Group()
+        subscription = factories.Subscription(
+            query='groups:{}'.format(group['name']))
+        dataset = Dataset(groups=[{'id': group['id']}])
+
+        matches = match_datasets([dataset['id']])
+
+        assert [(sub.id, package_id) for sub, package_id in matches] == \
+            [(subscription['id'], dataset['id'])]
+
+    def test_organization_renamed(self):
+        org = Organization()
+        subscription = factories.Subscription(
+            query='organization:{}'.format(org['name']))
+        helpers.call_action('organization_patch', {}, id=org['id'],
+                            name='renamed-org')
+        dataset = Dataset(owner_org=org['id'])
+
+        matches = match_datasets([dataset['id']])
+
+        assert [(sub.id, package_id) for sub, package_id in matches] == \
+            [(subscription['id'], dataset['id'])]
+        assert get_query_title(subscription['object_id']) == \
+            'organization:renamed-org'
+
+    def test_private_datasets_are_not_matched(self):
+        org = Organization()
+        factories.Subscription(query='tags:covid')
+        dataset = Dataset(owner_org=org['id'], private=True,
+                          tags=[{'name': 'covid'}])
+
+        assert match_datasets([dataset['id']]) == []
+
+    def test_subscription_filter(self):
+        factories.Subscription(query='tags:covid', frequency='weekly')
+        dataset = Dataset(tags=[{'name': 'covid'}])
+
+        assert match_datasets(
+            [dataset['id']],
+            subscribe_model.Subscription.frequency ==
+            subscribe_model.Frequency.DAILY.value) == []
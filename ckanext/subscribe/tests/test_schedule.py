@@ -0,0 +1,145 @@
+# encoding: utf-8
+
+import datetime
+
+import mock
+import pytest
+
+from ckanext.subscribe.schedule import Schedule, parse_field
+
+
+class TestParseField(object):
+
+    @pytest.mark.parametrize('field,expected', [
+        ('*', set(range(0, 24))),
+        ('5', set([5])),
+        ('1,3,5', set([1, 3, 5])),
+        ('9-12', set([9, 10, 11, 12])),
+        ('*/6', set([0, 6, 12, 18])),
+        ('10/5', set([10, 15, 20])),
+        ('0-10/5,22', set([0, 5, 10, 22])),
+    ])
+    def test_valid(self, field, expected):
+        assert parse_field(field, 0, 23) == expected
+
+    @pytest.mark.parametrize('field', ['24', '-1', 'x', '5-1', '*/0'])
+    def test_invalid(self, field):
+        with pytest.raises(ValueError):
+            parse_field(field, 0, 23)
+
+    def test_wrong_number_of_fields(self):
+        with pytest.raises(ValueError):
+            Schedule('0 9 * *')
+
+
+class TestMostRecent(object):
+    # 2020-01-24 is a Friday
+
+    @pytest.mark.parametrize('now,expected', [
+        # earlier that week
+        (datetime.datetime(2020, 1, 25), datetime.datetime(2020, 1, 24, 9, 0)),
+        # later that week
+        (datetime.datetime(2020, 1, 23), datetime.datetime(2020, 1, 17, 9, 0)),
+        # same day of week, earlier in the day
+        (datetime.datetime(2020, 1, 24, 8, 0),
+         datetime.datetime(2020, 1, 17, 9, 0)),
+        # same day of week, later in the day
+        (datetime.datetime(2020, 1, 24, 10, 0),
+         datetime.datetime(2020, 1, 24, 9, 0)),
+        # exactly the time
+        (datetime.datetime(2020, 1, 24, 9, 0, 30),
+         datetime.datetime(2020, 1, 24, 9, 0)),
+    ])
+    def test_weekly(self, now, expected):
+        assert Schedule('0 9 * * 5').most_recent(now) == expected
+
+    def test_hourly(self):
+        assert Schedule('30 * * * *').most_recent(
+            datetime.datetime(2020, 1, 24, 0, 10)) == \
+            datetime.datetime(2020, 1, 23, 23, 30)
+
+    def test_monthly(self):
+        assert Schedule('0 9 1 * *').most_recent(
+            datetime.datetime(2020, 3, 1, 8, 0)) == \
+            datetime.datetime(2020, 2, 1, 9, 0)
+
+    def test_day_of_month_or_day_of_week(self):
+        # as in cron, either will do when both are restricted
+        schedule = Schedule('0 0 1 * 1')
+        assert schedule.most_recent(datetime.datetime(2020, 1, 2)) == \
+            datetime.datetime(2020, 1, 1)
+        assert schedule.most_recent(datetime.datetime(2020, 1, 7)) == \
+            datetime.datetime(2020, 1, 6)
+
+    def test_sunday_is_0_or_7(self):
+        assert Schedule('0 0 * * 0').most_recent(
+            datetime.datetime(2020, 1, 24)) == \
+            Schedule('0 0 * * 7').most_recent(datetime.datetime(2020, 1, 24))
+
+    def test_leap_day(self):
+        assert Schedule('0 9 29 2 *').most_recent(
+            datetime.datetime(2027, 3, 1)) == \
+            datetime.datetime(2024, 2, 29, 9, 0)
+
+    def test_never(self):
+        assert Schedule('0 0 30 2 *').most_recent() is None
+
+    def test_searches_a_month_at_a_time(self):
+        schedule = Schedule('0 9 29 2 *')
+        with mock.patch.object(schedule, 'matching_days',
+                               wraps=schedule.matching_days) as matching_days:
+            assert schedule.period(datetime.datetime(2027, 3, 1)) == \
+                datetime.datetime(2024, 2, 29) - datetime.datetime(2020, 2, 29)
+            schedule.next_due(datetime.datetime(2027, 3, 1))
+
+        # a month at a time, for the two most recent and the next - not a day
+        # at a time
+        assert matching_days.call_count < 3 * 12 * 8
+
+
+class TestNextDue(object):
+
+    def test_later_today(self):
+        assert Schedule('0 9 * * *').next_due(
+            datetime.datetime(2020, 1, 24, 8, 59, 59)) == \
+            datetime.datetime(2020, 1, 24, 9, 0)
+
+    def test_not_now(self):
+        assert Schedule('0 9 * * *').next_due(
+            datetime.datetime(2020, 1, 24, 9, 0)) == \
+            datetime.datetime(2020, 1, 25, 9, 0)
+
+    def test_leap_day(self):
+        assert Schedule('0 9 29 2 *').next_due(
+            datetime.datetime(2024, 2, 29, 9, 0)) == \
+            datetime.datetime(2028, 2, 29, 9, 0)
+
+    def test_day_of_week(self):
+        # 2020-01-24 is a Friday
+        assert Schedule('0 9 * * 1').next_due(
+            datetime.datetime(2020, 1, 24)) == \
+            datetime.datetime(2020, 1, 27, 9, 0)
+
+    def test_next_year(self):
+        assert Schedule('0 9 1 * *').next_due(
+            datetime.datetime(2020, 12, 5)) == \
+            datetime.datetime(2021, 1, 1, 9, 0)
+
+
+class TestPeriod(object):
+
+    @pytest.mark.parametrize('spec,expected', [
+        ('15 * * * *', datetime.timedelta(hours=1)),
+        ('0 9 * * *', datetime.timedelta(days=1)),
+        ('0 9 * * 5', datetime.timedelta(days=7)),
+    ])
+    def test_basic(self, spec, expected):
+        assert Schedule(spec).period(datetime.datetime(2020, 1, 24, 12)) == \
+            expected
+
+    def test_monthly_varies(self):
+        schedule = Schedule('0 9 1 * *')
+        assert schedule.period(datetime.datetime(2020, 3, 5)) == \
+            datetime.timedelta(days=29)
+        assert schedule.period(datetime.datetime(2020, 4, 5)) == \
+            datetime.timedelta(days=31)
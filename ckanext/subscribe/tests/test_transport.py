@@ -0,0 +1,284 @@
+# encoding: utf-8
+
+import json
+import mailbox
+import os
+import stat
+import threading
+from email.mime.text import MIMEText
+
+import mock
+import pytest
+from six.moves import BaseHTTPServer
+
+from ckan.lib.mailer import MailerException
+
+from ckanext.subscribe import transport
+from ckanext.subscribe.transport import (
+    get_transport,
+    reset_transport,
+    MemoryTransport,
+    NullTransport,
+    MaildirTransport,
+    SendmailTransport,
+    PooledSMTPTransport,
+    HTTPBatchTransport,
+)
+
+
+def _message():
+    return MIMEText('Changes have occurred')
+
+
+class TestGetTransport(object):
+
+    def teardown(self):
+        reset_transport()
+
+    def test_default(self):
+        reset_transport()
+        assert isinstance(get_transport(), transport.SMTPTransport)
+
+    @pytest.mark.ckan_config('ckanext.subscribe.mail_transport', 'null')
+    def test_by_name(self):
+        reset_transport()
+        assert isinstance(get_transport(), NullTransport)
+
+    @pytest.mark.ckan_config('ckanext.subscribe.mail_transport',
+                             'ckanext.subscribe.transport:MemoryTransport')
+    def test_by_import_path(self):
+        reset_transport()
+        assert isinstance(get_transport(), MemoryTransport)
+
+    @pytest.mark.ckan_config('ckanext.subscribe.mail_transport', 'pigeon')
+    def test_unknown(self):
+        reset_transport()
+        with pytest.raises(ValueError):
+            get_transport()
+
+
+class TestMemoryTransport(object):
+
+    def test_send(self):
+        msg = _message()
+
+        MemoryTransport().send(msg, 'site@example.com', 'bob@example.com')
+
+        assert MemoryTransport.outbox[-1] == \
+            ('site@example.com', 'bob@example.com', msg)
+
+
+class TestMaildirTransport(object):
+
+    def test_send(self, tmpdir):
+        path = str(tmpdir.join('Maildir'))
+        with mock.patch.dict(transport.config,
+                             {'ckanext.subscribe.maildir_path': path}):
+            maildir_transport = MaildirTransport()
+
+        maildir_transport.send(_message(), 'site@example.com',
+                               'bob@example.com')
+
+        messages = list(mailbox.Maildir(path, factory=None))
+        assert len(messages) == 1
+        assert messages[0].get_payload() == 'Changes have occurred'
+
+
+class TestSendmailTransport(object):
+
+    def _sendmail(self, tmpdir, exit_code=0):
+        script = tmpdir.join('sendmail')
+        script.write('#!/bin/sh\ncat > "{}"\necho "$@" > "{}"\nexit {}\n'.format(
+            tmpdir.join('message'), tmpdir.join('args'), exit_code))
+        os.chmod(str(script), stat.S_IRWXU)
+        with mock.patch.dict(transport.config,
+                             {'ckanext.subscribe.sendmail_path': str(script)}):
+            return SendmailTransport()
+
+    def test_send(self, tmpdir):
+        self._sendmail(tmpdir).send(_message(), 'site@example.com',
+                                    'bob@example.com')
+
+        assert 'Changes have occurred' in tmpdir.join('message').read()
+        assert tmpdir.join('args').read().split() == \
+            ['-i', '-f', 'site@example.com', '--', 'bob@example.com']
+
+    def test_failure(self, tmpdir):
+        with pytest.raises(MailerException):
+            self._sendmail(tmpdir, exit_code=75).send(
+                _message(), 'site@example.com', 'bob@example.com')
+
+
+class TestPooledSMTPTransport(object):
+
+    @mock.patch.object(PooledSMTPTransport, 'smtp_class')
+    def test_connection_is_reused(self, smtp_class):
+        smtp_class.return_value.noop.return_value = (250, b'OK')
+        pool = PooledSMTPTransport()
+
+        for _ in range(3):
+            pool.send(_message(), 'site@example.com', 'bob@example.com')
+
+        assert smtp_class.call_count == 1
+        assert smtp_class.return_value.sendmail.call_count == 3
+
+    @mock.patch.object(PooledSMTPTransport, 'smtp_class')
+    def test_connection_is_replaced_after_an_error(self, smtp_class):
+        pool = PooledSMTPTransport()
+        smtp_class.return_value.sendmail.side_effect = [
+            transport.smtplib.SMTPServerDisconnected(), None]
+
+        with pytest.raises(MailerException):
+            pool.send(_message(), 'site@example.com', 'bob@example.com')
+        pool.send(_message(), 'site@example.com', 'bob@example.com')
+
+        assert smtp_class.call_count == 2
+
+    @mock.patch.object(PooledSMTPTransport, 'smtp_class')
+    def test_dropped_connection_is_replaced(self, smtp_class):
+        # the server drops the idle connection between the emails
+        smtp_class.return_value.noop.side_effect = \
+            transport.smtplib.SMTPServerDisconnected()
+        pool = PooledSMTPTransport()
+
+        pool.send(_message(), 'site@example.com', 'bob@example.com')
+        pool.send(_message(), 'site@example.com', 'bob@example.com')
+
+        assert smtp_class.call_count == 2
+        assert smtp_class.return_value.sendmail.call_count == 2
+
+    @mock.patch.object(PooledSMTPTransport, 'smtp_class')
+    @mock.patch.object(transport.time, 'time')
+    def test_idle_connection_is_closed(self, time_, smtp_class):
+        smtp_class.return_value.noop.return_value = (250, b'OK')
+        pool = PooledSMTPTransport()
+
+        time_.return_value = 1000.0
+        pool.send(_message(), 'site@example.com', 'bob@example.com')
+        time_.return_value = 1000.0 + pool.idle_timeout + 1
+        pool.send(_message(), 'site@example.com', 'bob@example.com')
+
+        assert smtp_class.call_count == 2
+        assert smtp_class.return_value.quit.call_count == 1
+        assert not smtp_class.return_value.noop.called
+
+
+class EmailAPIStandIn(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''A local stand-in for an email provider's bulk send API. It fails
+    emails to addresses starting "bounce".'''
+    requests = []
+    statuses = []
+    bodies = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        payload = json.loads(body.decode('utf8'))
+        self.requests.append((dict(self.headers), payload))
+        status = self.statuses.pop(0) if self.statuses else 200
+        results = [{'error': 'mailbox unavailable'}
+                   if message['to'][0].startswith('bounce') else {}
+                   for message in payload['messages']]
+        response = self.bodies.pop(0) if self.bodies else \
+            json.dumps({'results': results}).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def email_api():
+    EmailAPIStandIn.requests = []
+    EmailAPIStandIn.statuses = []
+    EmailAPIStandIn.bodies = []
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), EmailAPIStandIn)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:{}/send'.format(server.server_port)
+    server.shutdown()
+    server.server_close()
+
+
+class TestHTTPBatchTransport(object):
+
+    def _transport(self, url, **config):
+        config.setdefault('ckanext.subscribe.http_transport.url', url)
+        config.setdefault('ckanext.subscribe.http_transport.api_key', 'k3y')
+        with mock.patch.dict(transport.config, config):
+            return HTTPBatchTransport()
+
+    def _messages(self, emails):
+        return [(_message(), 'site@example.com', email) for email in emails]
+
+    def test_send_batch(self, email_api):
+        http_transport = self._transport(
+            email_api, **{'ckanext.subscribe.http_transport.batch_size': '2'})
+        emails = ['ann@example.com', 'bounce@example.com', 'bob@example.com']
+
+        errors = http_transport.send_batch(self._messages(emails))
+
+        assert [bool(error) for error in errors] == [False, True, False]
+        assert isinstance(errors[1], MailerException)
+        # in batches of 2
+        assert [[message['to'][0] for message in payload['messages']]
+                for _, payload in EmailAPIStandIn.requests] == \
+            [emails[:2], emails[2:]]
+        headers, payload = EmailAPIStandIn.requests[0]
+        assert headers['Authorization'] == 'Bearer k3y'
+        assert payload['messages'][0]['from'] == 'site@example.com'
+        assert 'Changes have occurred' in payload['messages'][0]['raw']
+
+    def test_retries_server_errors(self, email_api):
+        EmailAPIStandIn.statuses = [503]
+        http_transport = self._transport(email_api)
+
+        errors = http_transport.send_batch(
+            self._messages(['ann@example.com']))
+
+        assert errors == [None]
+        assert len(EmailAPIStandIn.requests) == 2
+        # the retry can be recognized as the same request
+        assert EmailAPIStandIn.requests[0][0]['Idempotency-Key'] == \
+            EmailAPIStandIn.requests[1][0]['Idempotency-Key']
+
+    def test_whole_batch_fails(self, email_api):
+        EmailAPIStandIn.statuses = [400]
+        http_transport = self._transport(email_api)
+
+        errors = http_transport.send_batch(
+            self._messages(['ann@example.com', 'bob@example.com']))
+
+        assert len(errors) == 2
+        assert all(isinstance(error, MailerException) for error in errors)
+
+    @pytest.mark.parametrize('body', [
+        b'OK',
+        b'{"sent": true}',
+        b'{"results": [{}]}',  # a result missing
+        b'{"results": [{}, "sent"]}',
+    ])
+    def test_response_not_understood(self, email_api, body):
+        EmailAPIStandIn.bodies = [body]
+        http_transport = self._transport(email_api)
+
+        errors = http_transport.send_batch(
+            self._messages(['ann@example.com', 'bob@example.com']))
+
+        assert len(errors) == 2
+        assert all(isinstance(error, MailerException) for error in errors)
+
+    def test_send_raises(self, email_api):
+        http_transport = self._transport(email_api)
+
+        with pytest.raises(MailerException):
+            http_transport.send(_message(), 'site@example.com',
+                                'bounce@example.com')
+
+    def test_needs_url(self):
+        with pytest.raises(ValueError):
+            self._transport('')
@@ -0,0 +1,165 @@
+# encoding: utf-8
+
+import hashlib
+import hmac
+import json
+import threading
+
+import mock
+import pytest
+from six.moves import BaseHTTPServer
+
+from ckanext.subscribe import webhook
+from ckanext.subscribe.webhook import (
+    WebhookSender,
+    WebhookError,
+    sign,
+)
+
+
+class WebhookReceiver(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''A local stand-in for a subscriber's webhook. Paths starting /gone
+    return 410.'''
+    requests = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.requests.append((self.path, dict(self.headers),
+                              body.decode('utf8')))
+        self.send_response(410 if self.path.startswith('/gone') else 204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def receiver():
+    WebhookReceiver.requests = []
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), WebhookReceiver)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:{}'.format(server.server_port)
+    server.shutdown()
+    server.server_close()
+
+
+class TestSign(object):
+
+    def test_sign(self):
+        body = json.dumps({'activities': []})
+
+        assert sign('s3cret', body) == 'sha256=' + hmac.new(
+            b's3cret', body.encode('utf8'), hashlib.sha256).hexdigest()
+
+
+class TestDeliveryKey(object):
+
+    def test_round_trip(self):
+        key = webhook.get_delivery_key('sub-1')
+
+        assert webhook.get_subscription_id(key) == 'sub-1'
+        assert webhook.get_subscription_id('bob@example.com') is None
+
+
+class TestWebhookSender(object):
+
+    def test_post_many(self, receiver):
+        sender = WebhookSender(concurrency=4, host_concurrency=2, retries=0,
+                               allow_private_hosts=True)
+        bodies = [webhook.create_body({'n': i}) for i in range(6)]
+        webhooks = [(receiver + '/hook', 'secret-{}'.format(i), body)
+                    for i, body in enumerate(bodies)]
+        webhooks.append((receiver + '/gone', 'secret', bodies[0]))
+
+        errors = sender.post_many(webhooks)
+
+        assert errors[:6] == [None] * 6
+        assert isinstance(errors[6], WebhookError)
+        assert len(WebhookReceiver.requests) == 7
+        for path, headers, body in WebhookReceiver.requests:
+            if path == '/hook':
+                i = json.loads(body)['n']
+                assert headers[webhook.SIGNATURE_HEADER] == \
+                    sign('secret-{}'.format(i), body)
+
+    def test_post_raises(self, receiver):
+        sender = WebhookSender(retries=0, allow_private_hosts=True)
+
+        with pytest.raises(WebhookError):
+            sender.post(receiver + '/gone', 'secret', '{}')
+
+    def test_connection_refused(self):
+        sender = WebhookSender(retries=0, timeout=5, allow_private_hosts=True)
+
+        errors = sender.post_many([('http://127.0.0.1:1/hook', 'secret',
+                                    '{}')])
+
+        assert isinstance(errors[0], WebhookError)
+
+    def test_private_host_refused(self, receiver):
+        sender = WebhookSender(retries=0)
+
+        with pytest.raises(WebhookError):
+            sender.post(receiver + '/hook', 'secret', '{}')
+        assert not WebhookReceiver.requests
+
+    def test_host_rebound_to_private_address_refused(self, receiver):
+        port = int(receiver.rsplit(':', 1)[1])
+        public = [(2, 1, 6, '', ('93.184.216.34', port))]
+        private = [(2, 1, 6, '', ('127.0.0.1', port))]
+        sender = WebhookSender(retries=0, timeout=5)
+
+        # resolves to a public address for the check, then a private one
+        with mock.patch('socket.getaddrinfo',
+                        side_effect=[public, private]):
+            with pytest.raises(WebhookError):
+                sender.post('http://hook.example.com:{}/hook'.format(port),
+                            'secret', '{}')
+        assert not WebhookReceiver.requests
+
+    def test_connects_to_the_checked_address(self, receiver):
+        port = int(receiver.rsplit(':', 1)[1])
+        sender = WebhookSender(retries=0, timeout=5)
+
+        with mock.patch.object(
+                webhook, 'get_public_addresses',
+                return_value=[(2, 1, 6, '', ('127.0.0.1', port))]):
+            sender.post('http://hook.example.com:{}/hook'.format(port),
+                        'secret', '{}')
+
+        path, headers, body = WebhookReceiver.requests[0]
+        assert headers['Host'] == 'hook.example.com:{}'.format(port)
+
+
+class TestCheckUrl(object):
+
+    @pytest.mark.parametrize('address', [
+        '127.0.0.1', '10.0.0.1', '172.16.0.1', '192.168.1.1',
+        '169.254.169.254', '0.0.0.0', '::1', 'fe80::1%eth0', 'fd00::1',
+        '::ffff:127.0.0.1'])
+    def test_private_addresses_refused(self, address):
+        with mock.patch('socket.getaddrinfo',
+                        return_value=[(None, None, None, '', (address, 0))]):
+            with pytest.raises(WebhookError):
+                webhook.check_url('http://hook.example.com/')
+
+    def test_public_address_allowed(self):
+        with mock.patch('socket.getaddrinfo',
+                        return_value=[(None, None, None, '',
+                                       ('93.184.216.34', 0))]):
+            webhook.check_url('http://hook.example.com/')
+
+    def test_any_private_address_refused(self):
+        with mock.patch('socket.getaddrinfo',
+                        return_value=[(None, None, None, '',
+                                       ('93.184.216.34', 0)),
+                                      (None, None, None, '',
+                                       ('10.0.0.1', 0))]):
+            with pytest.raises(WebhookError):
+                webhook.check_url('http://hook.example.com/')
+
+    def test_allow_private_hosts(self):
+        webhook.check_url('http://127.0.0.1/hook', allow_private_hosts=True)
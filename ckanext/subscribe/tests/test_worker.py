@@ -0,0 +1,114 @@
+# encoding: utf-8
+
+import datetime
+
+import mock
+import pytest
+
+from ckan import model
+from ckan.tests import helpers
+from ckan.tests.factories import Dataset
+
+from ckanext.subscribe import model as subscribe_model
+from ckanext.subscribe import notification as subscribe_notification
+from ckanext.subscribe import worker as subscribe_worker
+from ckanext.subscribe.worker import Worker
+from ckanext.subscribe.tests import factories
+
+
+class FakeWakeSource(object):
+    def __init__(self, on_wait=None):
+        self.waits = []
+        self.on_wait = on_wait
+        self.notifies = 0
+
+    def wait(self, timeout):
+        self.waits.append(timeout)
+        if self.on_wait:
+            self.on_wait()
+        return False
+
+    def notify(self):
+        self.notifies += 1
+
+    def interrupt(self):
+        pass
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestWorker(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+        subscribe_notification._config = {}
+
+    def test_backs_off_while_there_is_no_activity(self):
+        worker = Worker(wake_source=FakeWakeSource(), min_poll_interval=10,
+                        max_poll_interval=30)
+        worker.run_cycle()
+        assert worker.poll_interval == 20
+        worker.run_cycle()
+        assert worker.poll_interval == 30
+        worker.run_cycle()
+        assert worker.poll_interval == 30
+
+        dataset = factories.DatasetActivity()
+        factories.Subscription(dataset_id=dataset['id'])
+        worker.run_cycle()
+        assert worker.poll_interval == 10
+
+    def test_sleeps_until_next_due(self):
+        worker = Worker(wake_source=FakeWakeSource(), min_poll_interval=10,
+                        max_poll_interval=30)
+        with mock.patch.object(
+                subscribe_notification, 'get_next_due_datetime',
+                return_value=datetime.datetime.now() +
+                datetime.timedelta(seconds=5)):
+            assert 1 <= worker.get_sleep_seconds() <= 5
+
+    def test_sleeps_no_longer_than_the_poll_interval(self):
+        worker = Worker(wake_source=FakeWakeSource(), min_poll_interval=10,
+                        max_poll_interval=30)
+        with mock.patch.object(
+                subscribe_notification, 'get_next_due_datetime',
+                return_value=datetime.datetime.now() +
+                datetime.timedelta(days=1)):
+            assert worker.get_sleep_seconds() == 10
+
+    @mock.patch.object(Worker, '_handle_signals')
+    def test_stop(self, _handle_signals):
+        wake_source = FakeWakeSource()
+        worker = Worker(wake_source=wake_source)
+        wake_source.on_wait = worker.stop
+
+        worker.run()
+
+        assert len(wake_source.waits) == 1
+        assert worker.stopping
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestWakeWorkerAfterCommit(object):
+
+    def setup(self):
+        subscribe_worker.listen_for_commits()
+
+    def test_woken_once_per_commit(self):
+        wake_source = FakeWakeSource()
+        with mock.patch.object(subscribe_worker, 'get_wake_source',
+                               return_value=wake_source):
+            # calls several of the plugin's hooks
+            Dataset()
+
+        assert wake_source.notifies == 1
+
+    def test_not_woken_if_rolled_back(self):
+        wake_source = FakeWakeSource()
+        with mock.patch.object(subscribe_worker, 'get_wake_source',
+                               return_value=wake_source):
+            subscribe_worker.wake_worker_after_commit()
+            model.Session.rollback()
+            model.Session.commit()
+
+        assert wake_source.notifies == 0
@@ -0,0 +1,449 @@
+# encoding: utf-8
+
+'''
+Mail transports - how the mailer hands over each email. Chosen with
+ckanext.subscribe.mail_transport:
+
+* smtp - a new SMTP connection for each email (the default)
+* smtp_pool - SMTP connections that are kept open and reused
+* lmtp - LMTP e.g. to the local Postfix or Dovecot, over a unix socket
+* sendmail - pipes each email to the local sendmail command, to be queued by
+  the MTA, with no network handshake
+* maildir - writes each email to a Maildir, rather than sending it
+* memory - keeps the emails in a list (MemoryTransport.outbox)
+* null - discards the emails
+* http - posts the emails in batches to an email provider's bulk send API
+
+or the import path of a class with a send() method e.g. "mymodule:MyTransport".
+The maildir, memory and null transports are for load testing and benchmarking
+the rest of the notification pipeline without a real MTA.
+'''
+
+import abc
+import mailbox
+import smtplib
+import socket
+import subprocess
+import time
+import uuid
+
+import six
+from six.moves import queue
+
+import ckan.plugins as p
+from ckan.lib.mailer import MailerException
+
+log = __import__('logging').getLogger(__name__)
+config = p.toolkit.config
+asbool = p.toolkit.asbool
+
+_transport = None
+
+
+@six.add_metaclass(abc.ABCMeta)
+class Transport(object):
+    '''Base class for mail transports.'''
+    # the number of emails it is best to send in each send_batch() call
+    batch_size = 1
+
+    @abc.abstractmethod
+    def send(self, msg, mail_from, recipient_email):
+        '''Sends the email.
+
+        :param msg: an email.message.Message
+        :raises MailerException: if it can't be sent
+        '''
+
+    def send_batch(self, messages):
+        '''Sends several emails.
+
+        :param messages: list of (msg, mail_from, recipient_email)
+        :returns: list of the errors - for each email, a MailerException if it
+            could not be sent, else None
+        '''
+        errors = []
+        for msg, mail_from, recipient_email in messages:
+            try:
+                self.send(msg, mail_from, recipient_email)
+            except MailerException as e:
+                errors.append(e)
+            else:
+                errors.append(None)
+        return errors
+
+    def close(self):
+        '''Releases any resources held e.g. connections'''
+        pass
+
+
+class SMTPTransport(Transport):
+    '''Sends each email over a new SMTP connection, using CKAN's smtp.*
+    config.
+    '''
+    smtp_class = smtplib.SMTP
+
+    def __init__(self):
+        if 'smtp.test_server' in config:
+            # If 'smtp.test_server' is configured we assume we're running
+            # tests, and don't use the smtp.server, starttls, user, password
+            # etc. options.
+            self.server = config['smtp.test_server']
+            self.starttls = False
+            self.user = None
+            self.password = None
+        else:
+            self.server = config.get('smtp.server', 'localhost')
+            self.starttls = asbool(config.get('smtp.starttls'))
+            self.user = config.get('smtp.user')
+            self.password = config.get('smtp.password')
+
+    def send(self, msg, mail_from, recipient_email):
+        connection = self.connect()
+        try:
+            self.send_on(connection, msg, mail_from, recipient_email)
+        finally:
+            self.disconnect(connection)
+
+    def connect(self):
+        '''Returns a new connection to the server, ready to send on.'''
+        connection = self.smtp_class()
+        try:
+            connection.connect(self.server)
+        except socket.error as e:
+            log.exception(e)
+            raise MailerException(
+                'SMTP server could not be connected to: "%s" %s'
+                % (self.server, e))
+        try:
+            # Identify ourselves and prompt the server for supported features.
+            connection.ehlo()
+
+            # If 'smtp.starttls' is on in CKAN config, try to put the SMTP
+            # connection into TLS mode.
+            if self.starttls:
+                if connection.has_extn('STARTTLS'):
+                    connection.starttls()
+                    # Re-identify ourselves over TLS connection.
+                    connection.ehlo()
+                else:
+                    raise MailerException(
+                        'SMTP server does not support STARTTLS')
+
+            # If 'smtp.user' is in CKAN config, try to login to SMTP server.
+            if self.user:
+                assert self.password, (
+                    'If smtp.user is configured then smtp.password must be '
+                    'configured as well.')
+                connection.login(self.user, self.password)
+        except smtplib.SMTPException as e:
+            self.disconnect(connection)
+            msg = '%r' % e
+            log.exception(msg)
+            raise MailerException(msg)
+        except MailerException:
+            self.disconnect(connection)
+            raise
+        return connection
+
+    def send_on(self, connection, msg, mail_from, recipient_email):
+        try:
+            connection.sendmail(mail_from, [recipient_email], msg.as_string())
+            log.info('Sent email to {0}'.format(recipient_email))
+        except (smtplib.SMTPException, socket.error) as e:
+            msg = '%r' % e
+            log.exception(msg)
+            raise MailerException(msg)
+
+    def disconnect(self, connection):
+        try:
+            connection.quit()
+        except (smtplib.SMTPException, socket.error):
+            # e.g. the server has already dropped the connection
+            connection.close()
+
+
+class PooledSMTPTransport(SMTPTransport):
+    '''Keeps SMTP connections open and reuses them, saving the connection,
+    TLS and login handshakes for each email. Each connection is used by one
+    thread at a time, and is replaced after an error, or after sending
+    ckanext.subscribe.smtp_pool.max_messages emails (some servers limit how
+    many they'll take on one connection).
+
+    Servers drop connections that are left idle, so a connection idle for
+    longer than ckanext.subscribe.smtp_pool.idle_timeout seconds is closed
+    rather than reused, and one that is reused is first checked with a NOOP.
+    '''
+    def __init__(self):
+        super(PooledSMTPTransport, self).__init__()
+        self.max_messages = int(config.get(
+            'ckanext.subscribe.smtp_pool.max_messages', 100))
+        self.idle_timeout = float(config.get(
+            'ckanext.subscribe.smtp_pool.idle_timeout', 30))
+        # of (connection, messages_sent, time it was last used)
+        self.idle = queue.LifoQueue()
+
+    def send(self, msg, mail_from, recipient_email):
+        connection, messages_sent = self.get_connection()
+        try:
+            self.send_on(connection, msg, mail_from, recipient_email)
+        except MailerException:
+            # the connection may be broken, so don't reuse it
+            self.disconnect(connection)
+            raise
+        messages_sent += 1
+        if messages_sent >= self.max_messages:
+            self.disconnect(connection)
+        else:
+            self.idle.put((connection, messages_sent, time.time()))
+
+    def get_connection(self):
+        '''Returns a pooled connection that is still open, or else a new one,
+        and the number of emails sent on it so far.
+        '''
+        while True:
+            try:
+                connection, messages_sent, last_used = \
+                    self.idle.get_nowait()
+            except queue.Empty:
+                return self.connect(), 0
+            if time.time() - last_used > self.idle_timeout:
+                self.disconnect(connection)
+            elif self.is_open(connection):
+                return connection, messages_sent
+            else:
+                connection.close()
+
+    def is_open(self, connection):
+        try:
+            status, _ = connection.noop()
+        except (smtplib.SMTPException, socket.error):
+            return False
+        return status == 250
+
+    def close(self):
+        while True:
+            try:
+                connection, _, _ = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            self.disconnect(connection)
+
+
+class LMTPTransport(SMTPTransport):
+    '''Delivers over LMTP, to ckanext.subscribe.lmtp_server - a host:port or
+    the path of a unix socket.
+    '''
+    smtp_class = smtplib.LMTP
+
+    def __init__(self):
+        super(LMTPTransport, self).__init__()
+        self.server = config.get('ckanext.subscribe.lmtp_server',
+                                 '/var/run/dovecot/lmtp')
+        self.starttls = False
+
+
+class SendmailTransport(Transport):
+    '''Pipes each email to the sendmail command
+    (ckanext.subscribe.sendmail_path), which queues it with the local MTA.
+    '''
+    def __init__(self):
+        self.sendmail_path = config.get('ckanext.subscribe.sendmail_path',
+                                        '/usr/sbin/sendmail')
+
+    def send(self, msg, mail_from, recipient_email):
+        try:
+            process = subprocess.Popen(
+                [self.sendmail_path, '-i', '-f', mail_from, '--',
+                 recipient_email],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT)
+            output = process.communicate(six.ensure_binary(msg.as_string()))[0]
+        except OSError as e:
+            raise MailerException('Could not run sendmail "{}": {}'
+                                  .format(self.sendmail_path, e))
+        if process.returncode != 0:
+            raise MailerException('sendmail exited with {}: {}'.format(
+                process.returncode, six.ensure_text(output, errors='replace')))
+        log.info('Sent email to {0}'.format(recipient_email))
+
+
+class MaildirTransport(Transport):
+    '''Writes each email to the Maildir at ckanext.subscribe.maildir_path'''
+    def __init__(self):
+        path = config.get('ckanext.subscribe.maildir_path')
+        if not path:
+            raise ValueError('The maildir mail transport needs '
+                             'ckanext.subscribe.maildir_path to be set')
+        self.maildir = mailbox.Maildir(path, factory=None, create=True)
+
+    def send(self, msg, mail_from, recipient_email):
+        try:
+            self.maildir.add(msg)
+        except (IOError, OSError) as e:
+            raise MailerException('Could not write to the Maildir: {}'
+                                  .format(e))
+
+
+class HTTPBatchTransport(Transport):
+    '''Posts the emails in batches to an HTTP bulk send API, over keep-alive
+    connections, retrying on connection errors, 429 and 5xx responses.
+
+    The request is a POST to ckanext.subscribe.http_transport.url of JSON:
+    {"messages": [{"from": ..., "to": [...], "raw": <the MIME message>}, ...]}
+    with the header "Authorization: Bearer <api_key>" (if an api_key is
+    configured) and an Idempotency-Key, which is the same for retries of the
+    request. The 2xx response must be JSON with a result for each message, in
+    order: {"results": [{"error": "..."} or {}, ...]}, where a result with an
+    error means that message failed. If the response can't be parsed, or
+    doesn't have a result for each message, it isn't known which were sent, so
+    they are all counted as failed.
+    '''
+    def __init__(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.url = config.get('ckanext.subscribe.http_transport.url')
+        if not self.url:
+            raise ValueError('The http mail transport needs '
+                             'ckanext.subscribe.http_transport.url to be set')
+        self.api_key = config.get('ckanext.subscribe.http_transport.api_key')
+        self.batch_size = int(config.get(
+            'ckanext.subscribe.http_transport.batch_size', 500))
+        self.timeout = float(config.get(
+            'ckanext.subscribe.http_transport.timeout', 60))
+        retries = int(config.get(
+            'ckanext.subscribe.http_transport.retries', 3))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=int(config.get(
+            'ckanext.subscribe.mail_concurrency', 1)),
+            max_retries=get_http_retry(retries))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.requests = requests
+
+    def send(self, msg, mail_from, recipient_email):
+        error = self.send_batch([(msg, mail_from, recipient_email)])[0]
+        if error:
+            raise error
+
+    def send_batch(self, messages):
+        errors = []
+        for i in range(0, len(messages), self.batch_size):
+            errors.extend(self._post(messages[i:i + self.batch_size]))
+        return errors
+
+    def _post(self, messages):
+        headers = {'Idempotency-Key': str(uuid.uuid4())}
+        if self.api_key:
+            headers['Authorization'] = 'Bearer {}'.format(self.api_key)
+        payload = {'messages': [
+            {'from': mail_from, 'to': [recipient_email],
+             'raw': msg.as_string()}
+            for msg, mail_from, recipient_email in messages]}
+        try:
+            response = self.session.post(self.url, json=payload,
+                                         headers=headers,
+                                         timeout=self.timeout)
+            response.raise_for_status()
+        except self.requests.RequestException as e:
+            log.error('Email API request failed: {}'.format(e))
+            return [MailerException('Email API request failed: {}'
+                                    .format(e))] * len(messages)
+        try:
+            results = response.json()['results']
+        except (ValueError, KeyError, TypeError):
+            results = None
+        if not isinstance(results, list) or len(results) != len(messages) \
+                or not all(isinstance(result, dict) for result in results):
+            log.error('Email API response was not understood: {!r}'
+                      .format(response.text[:200]))
+            return [MailerException('Email API response was not understood')
+                    ] * len(messages)
+        errors = []
+        for (msg, mail_from, recipient_email), result in \
+                zip(messages, results):
+            error = result.get('error')
+            if error:
+                log.error('Email API could not send to {}: {}'.format(
+                    recipient_email, error))
+                errors.append(MailerException(error))
+            else:
+                log.info('Sent email to {0}'.format(recipient_email))
+                errors.append(None)
+        return errors
+
+    def close(self):
+        self.session.close()
+
+
+def get_http_retry(retries):
+    '''Returns the urllib3 Retry for HTTP requests (that aren't expected to
+    cause harm if repeated) - retrying connection errors and 429 and 5xx
+    responses, with exponential backoff.
+    '''
+    from urllib3.util.retry import Retry
+    kwargs = dict(total=retries, backoff_factor=0.5,
+                  status_forcelist=(429, 500, 502, 503, 504),
+                  raise_on_status=False)
+    # retry POSTs too
+    try:
+        return Retry(allowed_methods=None, **kwargs)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=False, **kwargs)
+
+
+class MemoryTransport(Transport):
+    '''Keeps the emails in the list MemoryTransport.outbox, as
+    (mail_from, recipient_email, msg).
+    '''
+    outbox = []
+
+    def send(self, msg, mail_from, recipient_email):
+        self.outbox.append((mail_from, recipient_email, msg))
+
+
+class NullTransport(Transport):
+    '''Discards the emails.'''
+    def send(self, msg, mail_from, recipient_email):
+        pass
+
+
+TRANSPORTS = {
+    'smtp': SMTPTransport,
+    'smtp_pool': PooledSMTPTransport,
+    'lmtp': LMTPTransport,
+    'sendmail': SendmailTransport,
+    'maildir': MaildirTransport,
+    'memory': MemoryTransport,
+    'null': NullTransport,
+    'http': HTTPBatchTransport,
+}
+
+
+def get_transport():
+    '''Returns the mail transport for this process, as configured by
+    ckanext.subscribe.mail_transport.
+    '''
+    global _transport
+    if _transport is None:
+        name = config.get('ckanext.subscribe.mail_transport', 'smtp')
+        if name in TRANSPORTS:
+            class_ = TRANSPORTS[name]
+        else:
+            module_name, _, class_name = name.partition(':')
+            if not class_name:
+                raise ValueError('Unknown mail transport "{}"'.format(name))
+            module = __import__(module_name, fromlist=[class_name])
+            class_ = getattr(module, class_name)
+        _transport = class_()
+    return _transport
+
+
+def reset_transport():
+    '''Closes the transport, so the next get_transport() call sets it up
+    afresh from the config.
+    '''
+    global _transport
+    if _transport is not None:
+        _transport.close()
+    _transport = None
@@ -0,0 +1,308 @@
+# encoding: utf-8
+
+'''
+Webhook notifications - for subscriptions with a webhook_url, the
+notifications are POSTed to it as JSON, rather than emailed. This suits
+subscribers that are systems rather than people.
+
+Each POST is of one subscription's notification - the subscription and its
+activities (or activity summaries), as they'd be dictized for an email. The
+body is signed with the subscription's webhook_secret: the header
+X-Subscribe-Signature is "sha256=" + the hex HMAC-SHA256 of the body.
+
+The POSTs are made concurrently, over keep-alive connections, with a limit on
+how many are made to each host at once. Connection errors and 429/5xx
+responses are retried straight away, and after that the delivery ledger
+retries them later, like emails.
+
+Webhooks are only POSTed to hosts on public addresses - a webhook URL whose
+host resolves to a loopback, private, link-local or other non-global address
+is refused, both when it is set and when each POST is made (it may resolve
+differently by then), and redirects aren't followed. Otherwise anyone could
+use a webhook to make the site send requests into its own network. The check
+at POST time is made as each connection is opened, and the connection is made
+to the addresses that were checked (PublicAddressAdapter), so the host can't
+resolve to a public address for the check and to a private one for the
+connection (DNS rebinding). For the same reason, webhooks aren't sent through
+a proxy given in the environment. A site whose subscribers are internal
+systems can allow private hosts with
+ckanext.subscribe.webhook_allow_private_hosts.
+'''
+
+import binascii
+import hashlib
+import hmac
+import ipaddress
+import json
+import os
+import socket
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+import six
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from urllib3.util import connection as urllib3_connection
+from six.moves.urllib.parse import urlparse
+from concurrent import futures
+
+import ckan.plugins as p
+
+from ckanext.subscribe.transport import get_http_retry
+
+log = __import__('logging').getLogger(__name__)
+config = p.toolkit.config
+
+SIGNATURE_HEADER = 'X-Subscribe-Signature'
+# webhooks are recorded in the delivery ledger under this prefix plus the
+# subscription id, in place of the email address
+DELIVERY_KEY_PREFIX = 'webhook:'
+
+_sender = None
+
+
+class WebhookError(Exception):
+    pass
+
+
+def get_delivery_key(subscription_id):
+    return DELIVERY_KEY_PREFIX + subscription_id
+
+
+def get_subscription_id(delivery_key):
+    '''Returns the subscription id of a webhook delivery key, or None if it is
+    not a webhook's (i.e. it is an email address).
+    '''
+    if delivery_key.startswith(DELIVERY_KEY_PREFIX):
+        return delivery_key[len(DELIVERY_KEY_PREFIX):]
+    return None
+
+
+def allow_private_hosts():
+    return p.toolkit.asbool(
+        config.get('ckanext.subscribe.webhook_allow_private_hosts', False))
+
+
+def check_url(url, allow_private_hosts=False):
+    '''Checks that webhooks may be POSTed to the URL - its host must resolve
+    only to public (global) addresses.
+
+    :raises WebhookError: if not
+    '''
+    host = urlparse(url).hostname
+    if not host:
+        raise WebhookError('Webhook URL has no host: {}'.format(url))
+    if allow_private_hosts:
+        return
+    get_public_addresses(host)
+
+
+def get_public_addresses(host, port=None):
+    '''Resolves the host, checking that all of its addresses are public.
+
+    :returns: the addresses, as returned by socket.getaddrinfo
+    :raises WebhookError: if it can't be resolved, or any address isn't public
+    '''
+    try:
+        address_infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    except (socket.error, UnicodeError) as e:
+        raise WebhookError('Webhook host {} could not be resolved: {}'
+                           .format(host, e))
+    for address_info in address_infos:
+        # strip any IPv6 scope e.g. "fe80::1%eth0"
+        ip = ipaddress.ip_address(
+            six.text_type(address_info[4][0].split('%')[0]))
+        if ip.version == 6 and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+        if not ip.is_global or ip.is_multicast:
+            raise WebhookError('Webhook host {} is not on a public address'
+                               .format(host))
+    return address_infos
+
+
+class PublicAddressConnectionMixin(object):
+    '''Makes the connection to one of the host's addresses, having checked
+    that they are all public, rather than letting it be resolved again.
+    '''
+    def _new_conn(self):
+        try:
+            address_infos = get_public_addresses(self.host, self.port)
+        except WebhookError as e:
+            raise NewConnectionError(self, str(e))
+        error = None
+        for address_info in address_infos:
+            try:
+                return urllib3_connection.create_connection(
+                    (address_info[4][0], self.port), self.timeout,
+                    source_address=self.source_address,
+                    socket_options=self.socket_options)
+            except socket.timeout:
+                raise ConnectTimeoutError(
+                    self, 'Connection to {} timed out. (connect timeout={})'
+                    .format(self.host, self.timeout))
+            except socket.error as e:
+                error = e
+        raise NewConnectionError(
+            self, 'Failed to establish a new connection: {}'.format(error))
+
+
+class PublicHTTPConnection(PublicAddressConnectionMixin, HTTPConnection):
+    pass
+
+
+class PublicHTTPSConnection(PublicAddressConnectionMixin, HTTPSConnection):
+    pass
+
+
+class PublicHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = PublicHTTPConnection
+
+
+class PublicHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = PublicHTTPSConnection
+
+
+class PublicAddressAdapter(HTTPAdapter):
+    '''A requests adapter whose connections are only made to public addresses
+    (see PublicAddressConnectionMixin). The original host is still used for
+    the Host header, SNI and the certificate check.
+    '''
+    def init_poolmanager(self, *args, **kwargs):
+        super(PublicAddressAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': PublicHTTPConnectionPool,
+            'https': PublicHTTPSConnectionPool,
+        }
+
+
+def create_secret():
+    '''Returns a random secret, for a webhook that wasn't given one.'''
+    return binascii.hexlify(os.urandom(32)).decode('ascii')
+
+
+def create_body(notification):
+    '''Returns the JSON body to POST for a notification
+    ({'subscription': {...}, 'activities': [...]}).
+    '''
+    return json.dumps(notification, default=six.text_type, sort_keys=True)
+
+
+def sign(secret, body):
+    return 'sha256=' + hmac.new(secret.encode('utf8'), body.encode('utf8'),
+                                hashlib.sha256).hexdigest()
+
+
+class WebhookSender(object):
+    '''POSTs webhooks, reusing connections.
+
+    :param concurrency: the most POSTs made at once
+    :param host_concurrency: the most POSTs made at once to any one host
+        (0 means no limit, other than concurrency)
+    :param timeout: seconds to wait for each response
+    :param retries: the number of times to retry a POST straight away
+    :param allow_private_hosts: POST to hosts on loopback, private etc
+        addresses too (see check_url)
+    '''
+    def __init__(self, concurrency=8, host_concurrency=2, timeout=30,
+                 retries=3, allow_private_hosts=False):
+        self.concurrency = concurrency
+        self.allow_private_hosts = allow_private_hosts
+        self.host_concurrency = host_concurrency
+        self.timeout = timeout
+        self.session = requests.Session()
+        if allow_private_hosts:
+            adapter_class = HTTPAdapter
+        else:
+            adapter_class = PublicAddressAdapter
+            # a proxy would resolve the host itself
+            self.session.trust_env = False
+        adapter = adapter_class(pool_maxsize=concurrency,
+                                max_retries=get_http_retry(retries))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.host_semaphores = {}
+        self.lock = threading.Lock()
+
+    def post(self, url, secret, body):
+        '''POSTs the body to the webhook.
+
+        :raises WebhookError: if it fails
+        '''
+        check_url(url, self.allow_private_hosts)
+        semaphore = self._get_host_semaphore(urlparse(url).netloc.lower())
+        if semaphore:
+            semaphore.acquire()
+        try:
+            response = self.session.post(
+                url, data=body.encode('utf8'),
+                headers={'Content-Type': 'application/json',
+                         SIGNATURE_HEADER: sign(secret or '', body)},
+                timeout=self.timeout,
+                # a redirect could be to anywhere, including a private host
+                allow_redirects=False)
+            response.raise_for_status()
+            if response.is_redirect:
+                raise requests.HTTPError(
+                    'Redirects are not followed ({} to {})'.format(
+                        response.status_code,
+                        response.headers.get('Location')))
+        except requests.RequestException as e:
+            raise WebhookError('Webhook POST to {} failed: {}'.format(url, e))
+        finally:
+            if semaphore:
+                semaphore.release()
+        log.info('Posted webhook to {}'.format(url))
+
+    def post_many(self, webhooks):
+        '''POSTs the webhooks concurrently.
+
+        :param webhooks: list of (url, secret, body)
+        :returns: list of the errors - for each webhook, a WebhookError if it
+            failed, else None
+        '''
+        def try_post(webhook):
+            try:
+                self.post(*webhook)
+            except WebhookError as e:
+                return e
+            return None
+
+        if self.concurrency <= 1 or len(webhooks) <= 1:
+            return [try_post(webhook) for webhook in webhooks]
+        executor = futures.ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            return list(executor.map(try_post, webhooks))
+        finally:
+            executor.shutdown()
+
+    def close(self):
+        self.session.close()
+
+    def _get_host_semaphore(self, host):
+        if not self.host_concurrency:
+            return None
+        with self.lock:
+            if host not in self.host_semaphores:
+                self.host_semaphores[host] = \
+                    threading.BoundedSemaphore(self.host_concurrency)
+            return self.host_semaphores[host]
+
+
+def get_sender():
+    '''Returns the webhook sender for this process, set up from the config.'''
+    global _sender
+    if _sender is None:
+        _sender = WebhookSender(
+            concurrency=int(config.get(
+                'ckanext.subscribe.webhook_concurrency', 8)),
+            host_concurrency=int(config.get(
+                'ckanext.subscribe.webhook_host_concurrency', 2)),
+            timeout=float(config.get(
+                'ckanext.subscribe.webhook_timeout', 30)),
+            retries=int(config.get(
+                'ckanext.subscribe.webhook_retries', 3)),
+            allow_private_hosts=allow_private_hosts(),
+        )
+    return _sender
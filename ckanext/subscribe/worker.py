@@ -0,0 +1,237 @@
+# encoding: utf-8
+
+'''
+A long-running worker that sends the notifications as they become due.
+
+After each cycle it works out when the next notifications are due (the
+scheduled frequencies, held immediate notifications, send window slots and
+retries) and sleeps until then. Immediate notifications are due whenever there
+is activity, so it also polls - backing off while there is no activity - and
+can be woken early by a wake source, such as Redis pub/sub, which the web
+processes notify when changes to datasets, groups and organizations are
+committed.
+
+The database session is removed after each cycle, so that its identity map
+doesn't grow over the life of the process. On SIGTERM (or SIGINT) it finishes
+the cycle it is on and exits.
+'''
+
+import datetime
+import signal
+import threading
+import time
+
+from sqlalchemy import event
+
+import ckan.plugins as p
+from ckan import model
+
+from ckanext.subscribe import notification
+
+log = __import__('logging').getLogger(__name__)
+config = p.toolkit.config
+
+_wake_source = None
+
+
+class SleepWakeSource(object):
+    '''Just sleeps - it can't be woken by other processes.'''
+    def __init__(self):
+        self.event = threading.Event()
+
+    def wait(self, timeout):
+        '''Waits for up to timeout seconds, or until notified or interrupted.
+
+        :returns: whether it was notified or interrupted
+        '''
+        woken = self.event.wait(timeout)
+        self.event.clear()
+        return bool(woken)
+
+    def notify(self):
+        pass
+
+    def interrupt(self):
+        self.event.set()
+
+
+class RedisWakeSource(object):
+    '''Uses CKAN's Redis pub/sub, so the web processes can wake the worker.'''
+    def __init__(self):
+        from ckan.lib.redis import connect_to_redis
+        self.redis = connect_to_redis()
+        self.channel = '{}:subscribe:wake'.format(
+            config.get('ckan.site_id'))
+        self.pubsub = None
+        self.interrupted = False
+
+    def wait(self, timeout):
+        if self.pubsub is None:
+            self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            self.pubsub.subscribe(self.channel)
+        deadline = time.time() + timeout
+        # (in short waits, so that an interrupt is noticed)
+        while not self.interrupted and time.time() < deadline:
+            message = self.pubsub.get_message(
+                timeout=min(1.0, max(deadline - time.time(), 0)))
+            if message:
+                return True
+        return self.interrupted
+
+    def notify(self):
+        self.redis.publish(self.channel, 'wake')
+
+    def interrupt(self):
+        self.interrupted = True
+
+
+WAKE_SOURCES = {
+    'sleep': SleepWakeSource,
+    'redis': RedisWakeSource,
+}
+
+
+def get_wake_source():
+    '''Returns the wake source configured by
+    ckanext.subscribe.worker.wake_source - "sleep" (the default), "redis" or
+    the import path of a class with the same methods as SleepWakeSource e.g.
+    "mymodule:MyWakeSource".
+    '''
+    global _wake_source
+    if _wake_source is None:
+        name = config.get('ckanext.subscribe.worker.wake_source', 'sleep')
+        if name in WAKE_SOURCES:
+            class_ = WAKE_SOURCES[name]
+        else:
+            module_name, _, class_name = name.partition(':')
+            module = __import__(module_name, fromlist=[class_name])
+            class_ = getattr(module, class_name)
+        _wake_source = class_()
+    return _wake_source
+
+
+def wake_worker():
+    '''Wakes the worker, if its wake source allows, so that it checks for
+    activity straight away. Called when datasets, groups and organizations
+    change.
+    '''
+    try:
+        get_wake_source().notify()
+    except Exception:
+        # notifications will still go, after the worker's poll interval
+        log.exception('Could not wake the subscribe worker')
+
+
+def wake_worker_after_commit():
+    '''Wakes the worker (see wake_worker) once the current transaction is
+    committed, so that the activity is there for it to find. However many
+    changes are made in the transaction, it is woken once.
+    '''
+    model.Session.info['subscribe_wake_worker'] = True
+
+
+def _after_commit(session):
+    if session.info.pop('subscribe_wake_worker', False):
+        wake_worker()
+
+
+def _after_rollback(session):
+    session.info.pop('subscribe_wake_worker', None)
+
+
+def listen_for_commits():
+    '''Sets up the session events for wake_worker_after_commit.'''
+    if not event.contains(model.Session, 'after_commit', _after_commit):
+        event.listen(model.Session, 'after_commit', _after_commit)
+        event.listen(model.Session, 'after_rollback', _after_rollback)
+
+
+class Worker(object):
+    '''Sends notifications as they become due, until stopped.
+
+    :param wake_source: what it waits on between cycles (default: the
+        configured one)
+    :param min_poll_interval: seconds to wait between cycles, while there is
+        activity
+    :param max_poll_interval: the longest it waits between cycles, having
+        backed off because there's been no activity
+    '''
+    def __init__(self, wake_source=None, min_poll_interval=None,
+                 max_poll_interval=None):
+        self.wake_source = wake_source or get_wake_source()
+        self.min_poll_interval = float(
+            min_poll_interval or config.get(
+                'ckanext.subscribe.worker.min_poll_interval', 10))
+        self.max_poll_interval = float(
+            max_poll_interval or config.get(
+                'ckanext.subscribe.worker.max_poll_interval', 60))
+        self.poll_interval = self.min_poll_interval
+        self.stopping = False
+
+    def run(self):
+        self._handle_signals()
+        log.info('Subscribe worker started')
+        while not self.stopping:
+            self.run_cycle()
+            if self.stopping:
+                break
+            sleep_seconds = self.get_sleep_seconds()
+            log.debug('Sleeping for {:.1f}s'.format(sleep_seconds))
+            if self.wake_source.wait(sleep_seconds) and not self.stopping:
+                log.debug('Woken')
+                self.poll_interval = self.min_poll_interval
+        log.info('Subscribe worker stopped')
+
+    def run_cycle(self):
+        '''Sends any notifications that are due.'''
+        active_cycles = notification.metrics['active_cycles']
+        try:
+            metrics = p.toolkit.get_action(
+                'subscribe_send_any_notifications')({
+                    'model': model,
+                    'ignore_auth': True},
+                {}
+            )
+            log.debug('Metrics: {}'.format(metrics))
+        except Exception:
+            # e.g. the database is restarting - try again next cycle
+            log.exception('Error sending notifications')
+            model.Session.rollback()
+        finally:
+            # so that the objects loaded don't build up in the session
+            model.Session.remove()
+        # back off polling while there is no activity (in any of the time
+        # zone buckets)
+        if notification.metrics['active_cycles'] > active_cycles:
+            self.poll_interval = self.min_poll_interval
+        else:
+            self.poll_interval = min(self.poll_interval * 2,
+                                     self.max_poll_interval)
+
+    def get_sleep_seconds(self):
+        '''Returns how long to sleep - until the next notifications are due,
+        or the poll interval, whichever is sooner.
+        '''
+        now = datetime.datetime.now()
+        try:
+            next_due = notification.get_next_due_datetime(now)
+        except Exception:
+            log.exception('Error working out when notifications are next due')
+            next_due = None
+        finally:
+            model.Session.remove()
+        sleep_seconds = self.poll_interval
+        if next_due is not None:
+            sleep_seconds = min(sleep_seconds,
+                                (next_due - now).total_seconds())
+        # (a minimum, to avoid spinning if something stays due)
+        return max(sleep_seconds, 1.0)
+
+    def stop(self, *args):
+        log.info('Subscribe worker stopping')
+        self.stopping = True
+        self.wake_source.interrupt()
+
+    def _handle_signals(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
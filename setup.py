@@ -58,9 +58,17 @@ setup(
 
     install_requires=[
         'enum34',
+        'futures; python_version < "3"',
+        'ipaddress; python_version < "3"',
+        'pytz',
         'six>=1.12.0',
     ],
 
+    extras_require={
+        # vectorized fan-out of activities to subscribers
+        'fast': ['numpy'],
+    },
+
     # If there are data files included in your packages that need to be
     # installed, specify them here.  If using Python 2.6 or less, then these
     # have to be included in MANIFEST.in as well.